@@ -0,0 +1,9 @@
+"""
+Benchmarks for the pyWSP messaging stack. Run the whole suite and get JSON:
+
+    python -m benchmarks --output results.json
+
+or run a single micro-benchmark module directly, e.g.:
+
+    python -m benchmarks.encoding
+"""
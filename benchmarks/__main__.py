@@ -0,0 +1,67 @@
+"""
+Run the whole benchmark suite and print the results as JSON:
+
+    python -m benchmarks [--quick] [--port PORT] [--output results.json]
+
+Every network benchmark runs against a server on 127.0.0.1 in the same
+process, so numbers are comparable between runs on the same machine.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from typing import Any, Dict
+
+import aiohttp
+
+from . import decoding, encoding, loopback
+
+
+async def run_loopback(port: int, quick: bool) -> Dict[str, Any]:
+    scale = 0.1 if quick else 1.0
+    return {
+        "echo_latency": await loopback.echo_latency(port, calls=int(2000 * scale)),
+        "api_throughput": await loopback.api_throughput(port, calls=int(10000 * scale)),
+        "api_throughput_pooled": await loopback.api_throughput(
+            port, calls=int(10000 * scale), pool_size=4),
+        "broadcast_fanout": await loopback.broadcast_fanout(
+            port, client_counts=(10, 50) if quick else (10, 100, 250)),
+        "idle_connection_memory": await loopback.idle_connection_memory(
+            port, connections=50 if quick else 200),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="smaller iteration counts, for smoke runs")
+    parser.add_argument("--port", type=int, default=11200, help="loopback port for network benchmarks")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    scale = 0.1 if args.quick else 1.0
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "aiohttp": aiohttp.__version__,
+            "timestamp": time.time(),
+            "quick": args.quick,
+        },
+        "encoding": encoding.run(scale),
+        "decoding": decoding.run(scale),
+        "loopback": asyncio.run(run_loopback(args.port, args.quick)),
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Compare MessageFactory decoder plans with the kwargs based create() path."""
+import json
+import timeit
+from typing import Any, Callable, Dict
+
+from pywsp import MessageFactory
+from pywsp.message import message_to_dict
+
+from .encoding import BarMessage, FooMessage, ZooMessage, make_flat, make_nested
+
+
+def decode_kwargs(factory: MessageFactory, message_type: str, data: Dict[str, Any]) -> Any:
+    """The create(**data) path, plus the conversion handlers used to do by hand."""
+    message = factory.create(message_type, **data)
+    if isinstance(message, ZooMessage):
+        message.zoo = {
+            key: BarMessage([FooMessage(**foo) for foo in bar["bar"]])
+            for key, bar in message.zoo.items()
+        }
+        message.foo = FooMessage(**message.foo)
+    return message
+
+
+def decode_plan(factory: MessageFactory, message_type: str, data: Dict[str, Any]) -> Any:
+    return factory.decode(message_type, data)
+
+
+def measure(decode: Callable[..., Any], factory: MessageFactory, message_type: str,
+            data: Dict[str, Any], number: int) -> float:
+    """Return the best per-call time in microseconds."""
+    timer = timeit.Timer(lambda: decode(factory, message_type, data))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def run(scale: float = 1.0) -> Dict[str, Any]:
+    """Return per-shape timings (microseconds per message) for both paths."""
+    factory = MessageFactory()
+    factory.register_message_types(FooMessage, BarMessage, ZooMessage)
+
+    results = { }
+    shapes = [
+        ("flat", make_flat(), 20000),
+        ("nested", make_nested(10), 200),
+        ("nested-4x", make_nested(20), 50),
+    ]
+    for name, msg, number in shapes:
+        message_type = msg._pywsp_message_type
+        data = json.loads(json.dumps(message_to_dict(msg)))
+        assert decode_kwargs(factory, message_type, data) == decode_plan(factory, message_type, data)
+        number = max(1, int(number * scale))
+        baseline = measure(decode_kwargs, factory, message_type, data, number)
+        plan = measure(decode_plan, factory, message_type, data, number)
+        results[name] = {
+            "kwargs_us": baseline,
+            "plan_us": plan,
+            "messages_per_second": 1e6 / plan,
+        }
+    return results
+
+
+def main() -> None:
+    for name, result in run().items():
+        baseline, plan = result["kwargs_us"], result["plan_us"]
+        print(f"{name:>10}: kwargs {baseline:9.2f}us  plan {plan:9.2f}us  "
+              f"ratio {baseline / plan:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Compare the compiled per-type encoders with the asdict() based path."""
+import json
+import timeit
+from dataclasses import asdict, is_dataclass
+from typing import Any, Callable, Dict, List
+
+from pywsp import message
+from pywsp.message import json_default, message_to_dict
+
+
+@message(type="foo")
+class FooMessage:
+    foo: str
+
+@message(type="bar")
+class BarMessage:
+    bar: List[FooMessage]
+
+@message(type="zoo")
+class ZooMessage:
+    zoo: Dict[str, BarMessage]
+    foo: FooMessage
+
+
+def make_flat() -> Any:
+    return FooMessage("foo")
+
+
+def make_nested(width: int = 10) -> Any:
+    return ZooMessage(
+        { f"bar{i}": BarMessage([FooMessage(f"foo{i}.{j}") for j in range(width)]) for i in range(width) },
+        FooMessage("foo"))
+
+
+def encode_asdict(message: Any) -> str:
+    envelope = { "@id": 1, "@type": message._pywsp_message_type, "data": message }
+    return json.dumps(envelope, default=lambda x: asdict(x) if is_dataclass(x) else x)
+
+
+def encode_compiled(message: Any) -> str:
+    envelope = { "@id": 1, "@type": message._pywsp_message_type, "data": message_to_dict(message) }
+    return json.dumps(envelope, default=json_default)
+
+
+def measure(encode: Callable[[Any], str], message: Any, number: int) -> float:
+    """Return the best per-call time in microseconds."""
+    timer = timeit.Timer(lambda: encode(message))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def run(scale: float = 1.0) -> Dict[str, Any]:
+    """Return per-shape timings (microseconds per message) for both paths."""
+    results = { }
+    shapes = [("flat", make_flat(), 20000), ("nested", make_nested(), 200)]
+    for name, msg, number in shapes:
+        assert encode_asdict(msg) == encode_compiled(msg)
+        number = max(1, int(number * scale))
+        baseline = measure(encode_asdict, msg, number)
+        compiled = measure(encode_compiled, msg, number)
+        results[name] = {
+            "asdict_us": baseline,
+            "compiled_us": compiled,
+            "bytes": len(encode_compiled(msg)),
+            "messages_per_second": 1e6 / compiled,
+        }
+    return results
+
+
+def main() -> None:
+    for name, result in run().items():
+        baseline, compiled = result["asdict_us"], result["compiled_us"]
+        print(f"{name:>8}: asdict {baseline:9.2f}us  compiled {compiled:9.2f}us  "
+              f"speedup {baseline / compiled:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
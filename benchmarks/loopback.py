@@ -0,0 +1,222 @@
+"""End-to-end benchmarks over a loopback server: latency, throughput, fan-out, memory."""
+import asyncio
+import gc
+import time
+import tracemalloc
+from typing import Any, Dict, List, Sequence
+
+from pywsp import (
+    MessageFactory, WebSocket, WebSocketApiClient, WebSocketApiServer, WebSocketConnectionCallback,
+    WebSocketMessageCallback, WebSocketServer, api, message
+)
+
+HOST = "127.0.0.1"
+URL = "/bench"
+
+
+@message(type="echo_request")
+class EchoRequest:
+    payload: str
+
+@message(type="echo_response")
+class EchoResponse:
+    payload: str
+
+@message(type="event")
+class EventMessage:
+    sequence: int
+    payload: str
+
+
+class EchoServer(WebSocketApiServer):
+    def __init__(self, port: int) -> None:
+        super().__init__(HOST, port, URL)
+
+    @api(input=EchoRequest, output=EchoResponse)
+    async def echo(self, payload):
+        return payload
+
+
+class EchoClient(WebSocketApiClient):
+    async def echo(self, payload: str) -> Any:
+        return await self.api_call(EchoRequest, EchoResponse, payload)
+
+
+class _AcceptAll(WebSocketConnectionCallback, WebSocketMessageCallback):
+    def on_new_connection(self, ws: WebSocket) -> None:
+        ws.register_callback(self)
+
+    async def on_new_message(self, ws: WebSocket, message: Any) -> None:
+        pass
+
+
+class _Counter(WebSocketMessageCallback):
+    def __init__(self, target: int, done: asyncio.Event, counts: List[int]) -> None:
+        self._target = target
+        self._done = done
+        self._counts = counts
+
+    async def on_new_message(self, ws: WebSocket, message: Any) -> None:
+        self._counts[0] += 1
+        if self._counts[0] >= self._target:
+            self._done.set()
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _url(port: int) -> str:
+    return f"http://{HOST}:{port}{URL}"
+
+
+async def echo_latency(port: int, calls: int = 2000, payload_size: int = 64) -> Dict[str, Any]:
+    """Sequential api_call round trips."""
+    server = EchoServer(port)
+    await server.start()
+    client = EchoClient(_url(port))
+    payload = "x" * payload_size
+    try:
+        await client.echo(payload)  # Connect and warm up
+        samples = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            await client.echo(payload)
+            samples.append(time.perf_counter() - start)
+    finally:
+        await client.close()
+        await server.close()
+
+    return {
+        "calls": calls,
+        "payload_bytes": payload_size,
+        "p50_us": percentile(samples, 0.50) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+        "max_us": max(samples) * 1e6,
+    }
+
+
+async def api_throughput(
+        port: int,
+        calls: int = 10000,
+        concurrency: int = 100,
+        pool_size: int = 1) -> Dict[str, Any]:
+    """Concurrent api_calls multiplexed over pool_size sockets."""
+    server = EchoServer(port)
+    await server.start()
+    client = EchoClient(_url(port), pool_size=pool_size)
+    remaining = [calls]
+
+    async def worker() -> None:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await client.echo("x")
+
+    try:
+        await client.echo("x")
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.close()
+        await server.close()
+
+    return {
+        "calls": calls,
+        "concurrency": concurrency,
+        "pool_size": pool_size,
+        "seconds": elapsed,
+        "calls_per_second": calls / elapsed,
+    }
+
+
+async def _connect_clients(factory: MessageFactory, port: int, count: int, callback_for) -> List[WebSocket]:
+    clients = []
+    for index in range(count):
+        ws = WebSocket(factory)
+        ws.register_callback(callback_for(index))
+        await ws.connect(_url(port))
+        clients.append(ws)
+    return clients
+
+
+async def broadcast_fanout(
+        port: int,
+        client_counts: Sequence[int] = (10, 100, 250),
+        rounds: int = 5,
+        payload_size: int = 256) -> Dict[str, Any]:
+    """Time from broadcast() until every client has received the message."""
+    results = { }
+    for count in client_counts:
+        factory = MessageFactory()
+        factory.register_message_types(EventMessage)
+        server = WebSocketServer(factory)
+        server.register_callback(_AcceptAll())
+        await server.start_listening(HOST, port, URL)
+
+        done = asyncio.Event()
+        counts = [0]
+        clients = await _connect_clients(factory, port, count, lambda _: _Counter(count, done, counts))
+        while len(server.clients) < count:
+            await asyncio.sleep(0.01)
+
+        samples = []
+        try:
+            for sequence in range(rounds):
+                done.clear()
+                counts[0] = 0
+                start = time.perf_counter()
+                await server.broadcast(EventMessage(sequence, "x" * payload_size))
+                await done.wait()
+                samples.append(time.perf_counter() - start)
+        finally:
+            for ws in clients:
+                await ws.close()
+            await server.close()
+
+        results[str(count)] = {
+            "clients": count,
+            "p50_ms": percentile(samples, 0.50) * 1e3,
+            "max_ms": max(samples) * 1e3,
+        }
+    return results
+
+
+async def idle_connection_memory(port: int, connections: int = 200) -> Dict[str, Any]:
+    """Python heap growth per idle connection, server and client ends combined."""
+    factory = MessageFactory()
+    server = WebSocketServer(factory)
+    server.register_callback(_AcceptAll())
+    await server.start_listening(HOST, port, URL)
+
+    # Share one session so we measure sockets, not ClientSession overhead
+    from aiohttp import ClientSession
+    session = ClientSession()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    clients = []
+    try:
+        for _ in range(connections):
+            ws = WebSocket(factory, session=session)
+            ws.register_callback(_AcceptAll())
+            await ws.connect(_url(port))
+            clients.append(ws)
+        while len(server.clients) < connections:
+            await asyncio.sleep(0.01)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+        for ws in clients:
+            await ws.close()
+        await session.close()
+        await server.close()
+
+    growth = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return {
+        "connections": connections,
+        "bytes_per_connection": growth / connections,
+    }
@@ -1,9 +1,16 @@
 """PyWSP - Python WebSocket Protocol"""
 __version__ = "0.4.0"
 
-from .api import api, WebSocketApiClient, WebSocketApiServer
+from .admission import RateLimit
+from .api import api, WebSocketApiClient, WebSocketApiServer, WebSocketError
+from .attachment import AttachmentStream
+from .cache import CachePolicy
 from .callback import WebSocketConnectionCallback, WebSocketMessageCallback
+from .codec import Codec, JsonCodec, MsgpackCodec, OrjsonCodec
 from .factory import MessageFactory
-from .message import message
+from .message import RawData, message
+from .metrics import Metrics
 from .server import WebSocketServer
+from .session import ReconnectPolicy
 from .socket import WebSocket
+from .workers import WorkerPool
@@ -0,0 +1,61 @@
+"""Admission control for incoming messages: rate limits and load shedding.
+
+Messages over a limit aren't queued: the sender gets a WebSocketErrorMessage
+right away, with a code saying why and a hint of when to retry.
+"""
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+# How long overloaded servers ask clients to wait before retrying (seconds)
+DEFAULT_OVERLOAD_RETRY_AFTER = 0.5
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """rate messages per second on average, in bursts of up to burst messages."""
+    rate: float
+    burst: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if self.rate <= 0:
+            raise ValueError("rate must be positive")
+        if self.burst is not None and self.burst < 1:
+            raise ValueError("burst must be at least 1")
+
+
+class TokenBucket:
+    def __init__(self, limit: RateLimit) -> None:
+        self._rate = limit.rate
+        self._capacity = float(limit.burst if limit.burst is not None else max(1, int(limit.rate)))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; return 0 on success, else how long until one is available."""
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+
+class InFlightLimit:
+    """Caps the handlers running at once across every socket sharing it."""
+    def __init__(self, limit: int, retry_after: float = DEFAULT_OVERLOAD_RETRY_AFTER) -> None:
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        self.limit = limit
+        self.retry_after = retry_after
+        self.count = 0
+
+    def try_acquire(self) -> bool:
+        if self.count >= self.limit:
+            return False
+        self.count += 1
+        return True
+
+    def release(self) -> None:
+        self.count -= 1
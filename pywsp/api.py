@@ -1,30 +1,135 @@
+from aiohttp import ClientSession
 import asyncio
+import functools
 import inspect
+import itertools
 import logging
-
-from dataclasses import asdict
-from typing import Any
-
+import sys
+import time
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import fields
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Set, Tuple, Union
+
+from .admission import RateLimit
+from .attachment import (
+    DEFAULT_ATTACHMENT_CHUNK_SIZE, DEFAULT_MAX_ATTACHMENT_SIZE, DEFAULT_MAX_PENDING_ATTACHMENT_SIZE, has_binary_fields
+)
+from .cache import CachePolicy, ResultCache, cache_key
 from .callback import WebSocketConnectionCallback, WebSocketMessageCallback
-from .const import INPUT_MESSAGE_TYPE, OUTPUT_MESSAGE_TYPE
+from .codec import Codec
+from .const import (
+    API_CACHE_POLICY, API_COALESCE, API_EXECUTOR, INPUT_MESSAGE_TYPE, MESSAGE_CREDIT, MESSAGE_ID, MESSAGE_REPLY_TO,
+    OUTPUT_MESSAGE_TYPE, OVERFLOW_BLOCK, PYWSP_COMPRESS, PYWSP_MESSAGE_TYPE
+)
+from .exceptions import WebSocketConnectionClosed
 from .factory import MessageFactory
-from .message import WebSocketErrorMessage
+from .message import (
+    WebSocketErrorMessage, WebSocketStreamCancelMessage, WebSocketStreamCreditMessage,
+    WebSocketStreamEndMessage, message_to_dict
+)
+from .metrics import Metrics
 from .server import WebSocketServer
-from .socket import WebSocket
+from .session import DEFAULT_SESSION_TIMEOUT, ReconnectPolicy
+from .socket import DEFAULT_BATCH_MAX_BYTES, DEFAULT_MAX_MSG_SIZE, Frame, WebSocket
 
 _LOGGER = logging.getLogger(__name__)
 
+# Items a streamed response may have in flight before the client grants more
+DEFAULT_STREAM_WINDOW = 16
+
+_NOT_CACHED = object()
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+
+def api(
+        *,
+        input,
+        output,
+        cache: Union[bool, CachePolicy, None] = None,
+        coalesce: bool = False,
+        executor: Union[str, Executor, None] = None):
+    """Expose a method of a WebSocketApiServer subclass as an API.
+
+    cache memoizes the method's results, keyed by the request's field
+    values: True for the default CachePolicy, or a CachePolicy. Only use it
+    for methods whose result depends on their arguments alone.
+
+    coalesce makes identical requests arriving while the method is already
+    running for them wait for that call instead of starting their own
+    (single-flight); the result is encoded once and sent to every requester.
 
-def api(*, input, output):
+    executor runs the method off the event loop, for handlers that block or
+    are CPU bound; such methods are plain functions, not coroutines. "thread"
+    and "process" use the server's own pools (see WebSocketApiServer), or
+    pass any concurrent.futures.Executor. Process pool methods must be
+    static methods, and their arguments and result are pickled.
+    """
     def wrap(func):
         setattr(func, INPUT_MESSAGE_TYPE, input)
         setattr(func, OUTPUT_MESSAGE_TYPE, output)
+        if (cache or coalesce) and inspect.isasyncgenfunction(func):
+            raise TypeError(f"streaming method {func.__name__} can't be cached or coalesced")
+        if executor is not None:
+            if executor not in (EXECUTOR_THREAD, EXECUTOR_PROCESS) and not isinstance(executor, Executor):
+                raise ValueError(f"invalid executor {executor!r}")
+            if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+                raise TypeError(f"method {func.__name__} runs in an executor and can't be async")
+            setattr(func, API_EXECUTOR, executor)
+        if cache:
+            setattr(func, API_CACHE_POLICY, CachePolicy() if cache is True else cache)
+        if coalesce:
+            setattr(func, API_COALESCE, True)
         return func
     return wrap
 
 
 class WebSocketError(RuntimeError):
-    pass
+    """A request failed on the server."""
+    @property
+    def error(self) -> Optional[WebSocketErrorMessage]:
+        """The server's error message, when it sent one."""
+        error = self.args[0] if self.args else None
+        return error if isinstance(error, WebSocketErrorMessage) else None
+
+    @property
+    def retry_after(self) -> Optional[float]:
+        """Seconds after which the request may be retried, if the server said so."""
+        error = self.error
+        return error.retry_after if error is not None else None
+
+
+class _Stream:
+    """Server side state of one streamed response."""
+    def __init__(self, credits: Optional[int]) -> None:
+        # None means the client doesn't do flow control
+        self.credits = credits
+        self.task: Optional["asyncio.Task[None]"] = None
+        self._granted = asyncio.Event()
+
+    def grant(self, credits: int) -> None:
+        if self.credits is not None:
+            self.credits += credits
+            self._granted.set()
+
+    async def acquire(self) -> None:
+        if self.credits is None:
+            return
+        while self.credits <= 0:
+            self._granted.clear()
+            await self._granted.wait()
+        self.credits -= 1
+
+
+class _Flight:
+    """One running call of a coalesced @api method, shared by identical requests."""
+    def __init__(self, task: "asyncio.Task[Any]") -> None:
+        self.task = task
+        # The response's data section, built once and encoded once per codec
+        self.data: Any = None
+        self.encoded: Dict[Codec, Frame] = { }
 
 
 class WebSocketApiServer(WebSocketConnectionCallback, WebSocketMessageCallback):
@@ -35,17 +140,86 @@ class WebSocketApiServer(WebSocketConnectionCallback, WebSocketMessageCallback):
             url: str,
             *,
             # method_map: Dict[Any, Any],
-            message_factory: MessageFactory = None) -> None:
+            message_factory: MessageFactory = None,
+            max_concurrency: Optional[int] = None,
+            ordering_key: Optional[Callable[[Any], Optional[Hashable]]] = None,
+            codecs: Optional[Sequence[Codec]] = None,
+            batch_window: Optional[float] = None,
+            batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+            send_queue_size: Optional[int] = None,
+            overflow_policy: str = OVERFLOW_BLOCK,
+            compress: bool = True,
+            compress_min_size: Optional[int] = None,
+            max_msg_size: int = DEFAULT_MAX_MSG_SIZE,
+            heartbeat: Optional[float] = None,
+            metrics: Optional[Metrics] = None,
+            reuse_port: bool = False,
+            attachment_chunk_size: int = DEFAULT_ATTACHMENT_CHUNK_SIZE,
+            attachment_stream_threshold: Optional[int] = None,
+            max_attachment_size: int = DEFAULT_MAX_ATTACHMENT_SIZE,
+            max_pending_attachment_size: int = DEFAULT_MAX_PENDING_ATTACHMENT_SIZE,
+            compact_envelopes: bool = False,
+            rate_limit: Optional[RateLimit] = None,
+            type_rate_limits: Optional[Dict[str, RateLimit]] = None,
+            max_in_flight: Optional[int] = None,
+            max_connections: Optional[int] = None,
+            idle_timeout: Optional[float] = None,
+            session_buffer_size: Optional[int] = None,
+            session_timeout: float = DEFAULT_SESSION_TIMEOUT,
+            thread_pool_size: Optional[int] = None,
+            process_pool_size: Optional[int] = None) -> None:
 
         self._address = address
         self._port = port
         self._url = url
+        self._reuse_port = reuse_port
 
         self._message_factory = message_factory or MessageFactory()
         self._method_map = { }
-
-        self._wss = WebSocketServer((self._message_factory))
+        # Result caches of the methods asking for one, by input type
+        self._caches: Dict[type, ResultCache] = { }
+        # Input types of coalesced methods, and their calls in progress
+        self._coalesced: Set[type] = set()
+        self._flights: Dict[Tuple[type, Hashable], _Flight] = { }
+        # Pools for @api(executor="thread"/"process") methods, created on first
+        # use (None sizes mean the concurrent.futures defaults)
+        self._thread_pool_size = thread_pool_size
+        self._process_pool_size = process_pool_size
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._metrics = metrics
+        # Streamed responses in progress, per socket and request id
+        self._streams: Dict[WebSocket, Dict[int, _Stream]] = { }
+
+        self._wss = WebSocketServer(
+            self._message_factory,
+            max_concurrency=max_concurrency,
+            ordering_key=ordering_key,
+            codecs=codecs,
+            batch_window=batch_window,
+            batch_max_bytes=batch_max_bytes,
+            send_queue_size=send_queue_size,
+            overflow_policy=overflow_policy,
+            compress=compress,
+            compress_min_size=compress_min_size,
+            max_msg_size=max_msg_size,
+            heartbeat=heartbeat,
+            metrics=metrics,
+            attachment_chunk_size=attachment_chunk_size,
+            attachment_stream_threshold=attachment_stream_threshold,
+            max_attachment_size=max_attachment_size,
+            max_pending_attachment_size=max_pending_attachment_size,
+            compact_envelopes=compact_envelopes,
+            rate_limit=rate_limit,
+            type_rate_limits=type_rate_limits,
+            max_in_flight=max_in_flight,
+            max_connections=max_connections,
+            idle_timeout=idle_timeout,
+            session_buffer_size=session_buffer_size,
+            session_timeout=session_timeout)
         self._wss.register_callback(self)
+        self._wss.register_control_handler(WebSocketStreamCreditMessage, self._on_stream_credit)
+        self._wss.register_control_handler(WebSocketStreamCancelMessage, self._on_stream_cancel)
 
         self._build_message_factory()
 
@@ -69,13 +243,77 @@ class WebSocketApiServer(WebSocketConnectionCallback, WebSocketMessageCallback):
                 self._message_factory.register_message_types(input, output)
                 call = getattr(self, method.__name__, None)
                 assert call is not None
+                if (getattr(method, API_EXECUTOR, None) == EXECUTOR_PROCESS
+                        and not isinstance(inspect.getattr_static(self, method.__name__), staticmethod)):
+                    # Bound methods would drag the whole server into the pickle
+                    raise TypeError(f"process pool method {method.__name__} must be a static method")
                 self._method_map[input] = call
+                policy = getattr(method, API_CACHE_POLICY, None)
+                if policy is not None:
+                    self._caches[input] = ResultCache(policy)
+                if getattr(method, API_COALESCE, False):
+                    self._coalesced.add(input)
+
+    def get_cache(self, input_type: type) -> Optional[ResultCache]:
+        """The result cache of the method taking input_type, if it has one."""
+        return self._caches.get(input_type)
+
+    def invalidate_cache(self, request: Any) -> None:
+        """Forget cached results.
+
+        Pass an input message type to drop every result of its method, or an
+        input message to drop the result cached for those field values.
+        """
+        if isinstance(request, type):
+            cache = self._caches.get(request)
+            if cache is not None:
+                cache.invalidate()
+            return
+        cache = self._caches.get(type(request))
+        if cache is not None:
+            key = cache_key({field.name: getattr(request, field.name) for field in fields(request)})
+            if key is not None:
+                cache.invalidate(key)
+
+    @property
+    def server(self) -> WebSocketServer:
+        return self._wss
 
     async def start(self) -> None:
-        await self._wss.start_listening(self._address, self._port, self._url)
+        await self._wss.start_listening(self._address, self._port, self._url, reuse_port=self._reuse_port)
 
     async def close(self) -> None:
         await self._wss.close()
+        self._shutdown_pools()
+
+    async def shutdown(self) -> None:
+        await self._wss.shutdown()
+        self._shutdown_pools()
+
+    def _shutdown_pools(self) -> None:
+        # Don't block the loop on calls still running; they finish on their own
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool = self._process_pool = None
+
+    def _executor(self, executor: Union[str, Executor]) -> Executor:
+        if executor == EXECUTOR_THREAD:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(self._thread_pool_size, thread_name_prefix="pywsp-api")
+            return self._thread_pool
+        if executor == EXECUTOR_PROCESS:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(self._process_pool_size)
+            return self._process_pool
+        assert isinstance(executor, Executor)
+        return executor
+
+    async def broadcast(self, message: Any, **kwargs: Any) -> int:
+        return await self._wss.broadcast(message, **kwargs)
+
+    async def publish(self, topic: str, message: Any, **kwargs: Any) -> int:
+        return await self._wss.publish(topic, message, **kwargs)
 
     def on_new_connection(self, ws: WebSocket) -> None:
         _LOGGER.debug("new connection with socket %s", ws)
@@ -83,56 +321,413 @@ class WebSocketApiServer(WebSocketConnectionCallback, WebSocketMessageCallback):
 
     async def on_closing(self, ws: WebSocket) -> None:
         _LOGGER.debug("closing socket %s", ws)
+        for stream in self._streams.pop(ws, { }).values():
+            if stream.task is not None:
+                stream.task.cancel()
+
+    async def _on_stream_credit(self, ws: WebSocket, message: WebSocketStreamCreditMessage) -> None:
+        # Credits for a stream that already ended are simply dropped
+        stream = self._streams.get(ws, { }).get(message.stream)
+        if stream is not None:
+            stream.grant(message.credits)
+
+    async def _on_stream_cancel(self, ws: WebSocket, message: WebSocketStreamCancelMessage) -> None:
+        stream = self._streams.get(ws, { }).pop(message.stream, None)
+        if stream is not None and stream.task is not None:
+            _LOGGER.debug("stream %s cancelled by %s", message.stream, ws.peer_info)
+            stream.task.cancel()
+
+    def _start_stream(
+            self,
+            ws: WebSocket,
+            request_id: int,
+            method: Callable,
+            args: Dict[str, Any],
+            credit: Optional[int]) -> None:
+        # Run the generator in its own task so the socket keeps reading (and
+        # receiving credits) while the stream waits for the client.
+        stream = _Stream(credit)
+        self._streams.setdefault(ws, { })[request_id] = stream
+        stream.task = asyncio.create_task(
+            self._run_stream(ws, request_id, method, args, stream),
+            name="WebSocketApiServer_stream")
+
+    async def _run_stream(
+            self,
+            ws: WebSocket,
+            request_id: int,
+            method: Callable,
+            args: Dict[str, Any],
+            stream: _Stream) -> None:
+        outputClass = getattr(method, OUTPUT_MESSAGE_TYPE)
+        start = time.perf_counter()
+        generator = method(**args)
+        error = None
+        try:
+            while True:
+                # Wait for credit before producing the item, so a slow client
+                # also slows the generator down
+                await stream.acquire()
+                try:
+                    result = await generator.__anext__()
+                except StopAsyncIteration:
+                    break
+                await ws.send_message(outputClass(result), reply_to=request_id)
+        except Exception as e:
+            _LOGGER.error("error streaming %s: %s", method.__name__, e)
+            error = str(e) or type(e).__name__
+        finally:
+            await generator.aclose()
+            streams = self._streams.get(ws, { })
+            if streams.get(request_id) is stream:
+                del streams[request_id]
+            if self._metrics is not None:
+                self._metrics.api_handler_seconds.observe(time.perf_counter() - start, method.__name__)
+
+        if ws.connected():
+            await ws.send_message(WebSocketStreamEndMessage(error), reply_to=request_id)
+
+    async def _call(self, method: Callable, args: Dict[str, Any]) -> Any:
+        if self._metrics is None:
+            return await self._invoke(method, args)
+        start = time.perf_counter()
+        try:
+            return await self._invoke(method, args)
+        finally:
+            self._metrics.api_handler_seconds.observe(time.perf_counter() - start, method.__name__)
+
+    def _invoke(self, method: Callable, args: Dict[str, Any]) -> Awaitable[Any]:
+        executor = getattr(method, API_EXECUTOR, None)
+        if executor is None:
+            return method(**args)
+        if executor == EXECUTOR_PROCESS:
+            # Received attachments are views of socket buffers; pickle copies
+            args = {
+                name: bytes(value) if isinstance(value, memoryview) else value
+                for name, value in args.items()
+            }
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor(executor), functools.partial(method, **args))
+
+    def _join_flight(
+            self,
+            method: Callable,
+            args: Dict[str, Any],
+            message_type: type,
+            key: Hashable,
+            cache: Optional[ResultCache]) -> _Flight:
+        flight = self._flights.get((message_type, key))
+        if flight is not None:
+            return flight
+
+        def done(task: "asyncio.Task[Any]") -> None:
+            del self._flights[message_type, key]
+            # Retrieving the exception also keeps asyncio from logging it
+            # when every requester went away before the call ended
+            if task.cancelled() or task.exception() is not None:
+                return
+            if cache is not None:
+                cache.put(key, task.result())
+
+        # The call runs in its own task so no single requester owns it
+        flight = _Flight(asyncio.create_task(self._call(method, args), name="WebSocketApiServer_flight"))
+        flight.task.add_done_callback(done)
+        self._flights[message_type, key] = flight
+        return flight
+
+    async def _reply_coalesced(self, ws: WebSocket, request_id: int, method: Callable, flight: _Flight) -> None:
+        # Shielded: a requester going away mustn't cancel the call for the others
+        result = await asyncio.shield(flight.task)
+        outputClass = getattr(method, OUTPUT_MESSAGE_TYPE)
+        if flight.data is None:
+            flight.data = message_to_dict(outputClass(result))
+        if has_binary_fields(flight.data):
+            # Binary fields travel as attachments, which need the full send path
+            await ws.send_message(outputClass(result), reply_to=request_id)
+            return
+        encoded = flight.encoded.get(ws.codec)
+        if encoded is None:
+            encoded = flight.encoded[ws.codec] = ws.codec.encode(flight.data)
+        await ws.send_encoded(
+            getattr(outputClass, PYWSP_MESSAGE_TYPE),
+            encoded,
+            reply_to=request_id,
+            compress=getattr(outputClass, PYWSP_COMPRESS, None))
 
     async def on_new_message(self, ws: WebSocket, message: Any) -> None:
         message_type = type(message)
         method = self._method_map.get(message_type, None)
+        # Always set on received messages
+        request_id: int = getattr(message, MESSAGE_ID)
         _LOGGER.debug("new message: %s; method: %s", message, method)
 
         if method is None:
             _LOGGER.error("unsupported message type '%s'", message_type.__name__)
             error = WebSocketErrorMessage(error_message=f"unsupported message type {message_type}")
-            asyncio.get_running_loop().call_soon(ws.send_message(error))
+            await ws.send_message(error, reply_to=request_id)
+            return
+
+        # Shallow on purpose: nested messages reach the method as message objects
+        args = {field.name: getattr(message, field.name) for field in fields(message)}
+        if inspect.isasyncgenfunction(method):
+            self._start_stream(ws, request_id, method, args, getattr(message, MESSAGE_CREDIT, None))
             return
 
-        args = asdict(message)
-        result = await method(**args)
+        cache = self._caches.get(message_type)
+        coalesce = message_type in self._coalesced
+        key = cache_key(args) if cache is not None or coalesce else None
+        result = _NOT_CACHED
+        if cache is not None and key is not None:
+            result = cache.get(key, _NOT_CACHED)
+            if self._metrics is not None:
+                outcome = "miss" if result is _NOT_CACHED else "hit"
+                self._metrics.api_cache_requests.inc(method.__name__, outcome)
+
+        if result is _NOT_CACHED:
+            if coalesce and key is not None:
+                flight = self._join_flight(method, args, message_type, key, cache)
+                await self._reply_coalesced(ws, request_id, method, flight)
+                return
+            result = await self._call(method, args)
+            if cache is not None and key is not None:
+                # Only successful results are cached; exceptions propagate above
+                cache.put(key, result)
         _LOGGER.debug("result: %s", result)
 
         # Build response message
         outputClass = getattr(method, OUTPUT_MESSAGE_TYPE, None)
         assert outputClass is not None
         response = outputClass(result)
-        await ws.send_message(response)
+        await ws.send_message(response, reply_to=request_id)
 
 
 
 class WebSocketApiClient(WebSocketMessageCallback):
-    def __init__(self, url, *, message_factory=None):
+    """Client for WebSocketApiServer.
+
+    Calls are multiplexed over a pool of up to pool_size sockets to the same
+    URL, all sharing one ClientSession. Each call goes to the socket with the
+    fewest calls in flight; sockets are opened on demand and dead ones are
+    replaced the next time they're picked.
+    """
+    def __init__(
+            self,
+            url,
+            *,
+            message_factory=None,
+            timeout: Optional[float] = None,
+            codecs: Optional[Sequence[Codec]] = None,
+            pool_size: int = 1,
+            session: Optional[ClientSession] = None,
+            batch_window: Optional[float] = None,
+            batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+            compress: bool = False,
+            compress_min_size: Optional[int] = None,
+            max_msg_size: int = DEFAULT_MAX_MSG_SIZE,
+            heartbeat: Optional[float] = None,
+            attachment_chunk_size: int = DEFAULT_ATTACHMENT_CHUNK_SIZE,
+            attachment_stream_threshold: Optional[int] = None,
+            max_attachment_size: int = DEFAULT_MAX_ATTACHMENT_SIZE,
+            max_pending_attachment_size: int = DEFAULT_MAX_PENDING_ATTACHMENT_SIZE,
+            compact_envelopes: bool = False,
+            reconnect: Optional[ReconnectPolicy] = None):
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+
         self._message_factory = message_factory or MessageFactory()
         self._url = url
-        self._ws = WebSocket(self._message_factory)
-        self._ws.register_callback(self)
-        self._future = asyncio.Future()
-
-    async def _ensure_connected(self):
-        if not self._ws.connected():
-            await self._ws.connect(self._url)
+        self._timeout = timeout
+        self._codecs = codecs
+        self._session = session
+        self._owns_session = session is None
+        self._batch_window = batch_window
+        self._batch_max_bytes = batch_max_bytes
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._max_msg_size = max_msg_size
+        self._heartbeat = heartbeat
+        self._attachment_chunk_size = attachment_chunk_size
+        self._attachment_stream_threshold = attachment_stream_threshold
+        self._max_attachment_size = max_attachment_size
+        self._max_pending_attachment_size = max_pending_attachment_size
+        self._compact_envelopes = compact_envelopes
+        # Sockets reconnect on their own. Calls and streams in flight when the
+        # connection dropped fail: their requests may never have got through
+        self._reconnect = reconnect
+        self._sockets: List[Optional[WebSocket]] = [None] * pool_size
+        # Shared so ids are unique across the pool
+        self._message_ids = itertools.count(1)
+        # Calls in flight per socket, keyed by the '@id' of the request message
+        self._pending: Dict[WebSocket, Dict[int, "asyncio.Future[Any]"]] = { }
+        # Streamed responses in progress per socket: request id -> received items
+        self._streams: Dict[WebSocket, Dict[int, "asyncio.Queue[Any]"]] = { }
+        # Response types expected by each call in flight, for peers that don't set '@reply_to'
+        self._expected: Dict[int, Tuple[type, ...]] = { }
+        # Sockets whose peer has set '@reply_to' on a response
+        self._correlated: Set[WebSocket] = set()
+        # Gets the messages that aren't responses (e.g. broadcasts)
+        self._callback: Optional[WebSocketMessageCallback] = None
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return sum(len(calls) for calls in self._pending.values())
+
+    def register_callback(self, callback: WebSocketMessageCallback) -> None:
+        """Have callback receive the messages that aren't responses to a call."""
+        self._callback = callback
+
+    def _load(self, index: int) -> int:
+        ws = self._sockets[index]
+        if ws is not None and ws.reconnecting:
+            # Only picked when every socket is reconnecting
+            return sys.maxsize
+        if ws is None or not ws.connected():
+            return 0
+        return len(self._pending.get(ws, ()))
+
+    async def _acquire_socket(self) -> WebSocket:
+        index = min(range(len(self._sockets)), key=self._load)
+        ws = self._sockets[index]
+        if ws is not None and ws.connected():
+            return ws
+
+        async with self._connect_lock:
+            # Pick again: loads may have changed while we waited for the lock
+            index = min(range(len(self._sockets)), key=self._load)
+            ws = self._sockets[index]
+            if ws is not None and ws.connected():
+                return ws
+            if ws is not None and ws.reconnecting:
+                raise WebSocketConnectionClosed(f"reconnecting to {self._url}")
+            if ws is not None:
+                await self._discard_socket(ws)
+
+            if self._session is None:
+                self._session = ClientSession()
+            ws = WebSocket(
+                self._message_factory,
+                session=self._session,
+                codecs=self._codecs,
+                message_ids=self._message_ids,
+                batch_window=self._batch_window,
+                batch_max_bytes=self._batch_max_bytes,
+                compress=self._compress,
+                compress_min_size=self._compress_min_size,
+                max_msg_size=self._max_msg_size,
+                heartbeat=self._heartbeat,
+                attachment_chunk_size=self._attachment_chunk_size,
+                attachment_stream_threshold=self._attachment_stream_threshold,
+                max_attachment_size=self._max_attachment_size,
+                max_pending_attachment_size=self._max_pending_attachment_size,
+                compact_envelopes=self._compact_envelopes,
+                reconnect=self._reconnect)
+            ws.register_callback(self)
+            await ws.connect(self._url)
+            if not ws.connected():
+                raise WebSocketConnectionClosed(f"unable to connect to {self._url}")
+            self._pending[ws] = { }
+            self._streams[ws] = { }
+            self._sockets[index] = ws
+            return ws
+
+    async def _discard_socket(self, ws: WebSocket) -> None:
+        self._fail_pending(ws)
+        self._pending.pop(ws, None)
+        self._streams.pop(ws, None)
+        self._correlated.discard(ws)
+        await ws.close()
+
+    def _fail_pending(self, ws: WebSocket) -> None:
+        for future in self._pending.get(ws, { }).values():
+            if not future.done():
+                future.set_exception(WebSocketConnectionClosed(f"connection to {self._url} closed"))
+        for queue in self._streams.get(ws, { }).values():
+            queue.put_nowait(WebSocketConnectionClosed(f"connection to {self._url} closed"))
 
     async def on_new_message(self, ws: "WebSocket", message: Any) -> None:
-        self._future.set_result(message)
+        pending = self._pending.get(ws, { })
+        request_id = getattr(message, MESSAGE_REPLY_TO, None)
+        queue = self._streams.get(ws, { }).get(request_id) if request_id is not None else None
+        if queue is not None:
+            queue.put_nowait(message)
+            return
+
+        if request_id is None:
+            request_id = self._match_uncorrelated(ws, message)
+            if request_id is None:
+                # Not a response: a broadcast, a published message or similar
+                if self._callback is not None:
+                    await self._callback.on_new_message(ws, message)
+                else:
+                    _LOGGER.debug("no callback for message: %s", message)
+                return
+        else:
+            self._correlated.add(ws)
+
+        future = pending.pop(request_id, None)
+        if future is None:
+            _LOGGER.warning("discarding response to unknown request %s: %s", request_id, message)
+            return
+        if not future.done():
+            future.set_result(message)
+
+    def _match_uncorrelated(self, ws: WebSocket, message: Any) -> Optional[int]:
+        """The oldest call message could answer, if the peer never sets '@reply_to'."""
+        if ws in self._correlated:
+            return None
+        for request_id in self._pending.get(ws, { }):
+            if isinstance(message, self._expected.get(request_id, ())):
+                return request_id
+        return None
+
+    async def on_closing(self, ws: "WebSocket") -> None:
+        self._fail_pending(ws)
+
+    async def on_reconnected(self, ws: "WebSocket", resumed: bool) -> None:
+        # Even a resumed session only replays what the server sent: requests
+        # lost on the way aren't resent, and the server ended our streams
+        # when the connection dropped
+        self._fail_pending(ws)
+        self._pending.get(ws, { }).clear()
+        self._streams.get(ws, { }).clear()
 
     async def close(self):
-        await self._ws.close()
+        for calls in self._pending.values():
+            for future in calls.values():
+                future.cancel()
+        self._pending.clear()
+        for streams in self._streams.values():
+            for queue in streams.values():
+                queue.put_nowait(WebSocketConnectionClosed("client closed"))
+        self._streams.clear()
+        self._correlated.clear()
+        for ws in self._sockets:
+            if ws is not None:
+                await ws.close()
+        self._sockets = [None] * len(self._sockets)
+        if self._session is not None and self._owns_session:
+            await self._session.close()
+            self._session = None
 
     async def api_call(self, request_message_type, response_message_type, *args, **kwargs):
-        await self._ensure_connected()
+        ws = await self._acquire_socket()
 
         self._message_factory.register_message_types(response_message_type)
-        request = request_message_type(*args, *kwargs)
-
-        await self._ws.send_message(request)
-        response = await self._future
+        request = request_message_type(*args, **kwargs)
+
+        # Register the call before sending so a fast response can't beat us to it
+        message_id = ws.next_message_id()
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending[ws]
+        pending[message_id] = future
+        self._expected[message_id] = (response_message_type, WebSocketErrorMessage)
+        try:
+            await ws.send_message(request, message_id=message_id)
+            response = await asyncio.wait_for(future, self._timeout)
+        finally:
+            pending.pop(message_id, None)
+            self._expected.pop(message_id, None)
 
         if isinstance(response, WebSocketErrorMessage):
             raise WebSocketError(response)
@@ -140,3 +735,59 @@ class WebSocketApiClient(WebSocketMessageCallback):
             raise TypeError(f"unexpected response message type '{type(response)}'")
 
         return response
+
+    async def api_stream(
+            self,
+            request_message_type,
+            response_message_type,
+            *args,
+            window: int = DEFAULT_STREAM_WINDOW,
+            **kwargs) -> AsyncIterator[Any]:
+        """Call a streaming @api method, yielding its responses as they arrive.
+
+        At most `window` responses are in flight at any time: more are
+        requested as the caller consumes them. Leaving the loop early cancels
+        the stream on the server.
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+
+        ws = await self._acquire_socket()
+        self._message_factory.register_message_types(response_message_type, WebSocketStreamEndMessage)
+        request = request_message_type(*args, **kwargs)
+
+        message_id = ws.next_message_id()
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        streams = self._streams[ws]
+        streams[message_id] = queue
+        finished = False
+        try:
+            await ws.send_message(request, message_id=message_id, credit=window)
+            consumed = 0
+            while True:
+                response = await asyncio.wait_for(queue.get(), self._timeout)
+                if isinstance(response, Exception):
+                    finished = True
+                    raise response
+                if isinstance(response, WebSocketStreamEndMessage):
+                    finished = True
+                    if response.error is not None:
+                        raise WebSocketError(response.error)
+                    return
+                if isinstance(response, WebSocketErrorMessage):
+                    finished = True
+                    raise WebSocketError(response)
+                if not isinstance(response, response_message_type):
+                    raise TypeError(f"unexpected response message type '{type(response)}'")
+
+                yield response
+
+                # Hand credits back in chunks rather than one message per item
+                consumed += 1
+                if consumed * 2 >= window:
+                    await ws.send_message(WebSocketStreamCreditMessage(message_id, consumed))
+                    consumed = 0
+        finally:
+            streams.pop(message_id, None)
+            if not finished and ws.connected():
+                await ws.send_message(WebSocketStreamCancelMessage(message_id))
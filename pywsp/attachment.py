@@ -0,0 +1,173 @@
+"""Binary attachments sent as separate frames next to their message.
+
+Top level message fields holding bytes, bytearray or memoryview values are
+taken out of the envelope before it's encoded and listed under
+"@attachments" instead; their contents follow the envelope as binary frames
+of at most chunk_size bytes, each starting with a small header:
+
+    b"PWSA" | attachment id (uint32) | flags (uint8) | data
+
+The receiver puts the field back before decoding the message, as a
+memoryview over the received data. Attachments that fit in one chunk are a
+view of the frame itself; larger ones are reassembled into a bytearray that
+grows as chunks arrive. That way memory is only taken for data that actually
+came in, not for sizes a peer merely announced, at the cost of a copy each
+time the bytearray outgrows its allocation (amortized, as with list appends).
+Receivers can also ask for big attachments to be streamed instead, in which
+case the field holds an AttachmentStream.
+"""
+import asyncio
+import struct
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from .const import MESSAGE_ATTACHMENTS
+from .exceptions import WebSocketInvalidMessage
+
+ATTACHMENT_MAGIC = b"PWSA"
+CHUNK_FINAL = 0x01
+
+DEFAULT_ATTACHMENT_CHUNK_SIZE = 256 * 1024
+DEFAULT_MAX_ATTACHMENT_SIZE = 64 * 1024 * 1024
+# Total size of the buffered attachments a connection may be receiving at once
+DEFAULT_MAX_PENDING_ATTACHMENT_SIZE = 4 * DEFAULT_MAX_ATTACHMENT_SIZE
+
+_CHUNK_HEADER = struct.Struct("!4sIB")
+
+_BINARY_TYPES = (bytes, bytearray, memoryview)
+
+
+def is_attachment_chunk(frame: Union[str, bytes]) -> bool:
+    # Binary codecs always encode envelopes as maps, which never start with the magic
+    return not isinstance(frame, str) and frame[:4] == ATTACHMENT_MAGIC
+
+
+def has_binary_fields(data: Any) -> bool:
+    """Whether split_attachments() would take anything out of this data section."""
+    return isinstance(data, dict) and any(isinstance(value, _BINARY_TYPES) for value in data.values())
+
+
+def split_attachments(envelope: Dict[str, Any], attachment_ids: Iterator[int], chunk_size: int) -> List[bytes]:
+    """Move binary fields out of envelope; return the chunk frames carrying them."""
+    data = envelope["data"]
+    if not isinstance(data, dict):
+        return []
+    chunks: List[bytes] = []
+    attachments = None
+    for field, value in data.items():
+        if not isinstance(value, _BINARY_TYPES):
+            continue
+        if attachments is None:
+            attachments = envelope[MESSAGE_ATTACHMENTS] = { }
+        attachment_id = next(attachment_ids)
+        view = memoryview(value).cast("B")
+        attachments[field] = { "id": attachment_id, "size": len(view) }
+        chunks.extend(chunk_frames(attachment_id, view, chunk_size))
+    if attachments is not None:
+        for field in attachments:
+            data[field] = None
+        # Keep data the last member of the envelope
+        envelope["data"] = envelope.pop("data")
+    return chunks
+
+
+def chunk_frames(attachment_id: int, view: memoryview, chunk_size: int) -> Iterator[bytes]:
+    size = len(view)
+    offset = 0
+    while True:
+        end = min(offset + chunk_size, size)
+        flags = CHUNK_FINAL if end == size else 0
+        yield b"".join((_CHUNK_HEADER.pack(ATTACHMENT_MAGIC, attachment_id, flags), view[offset:end]))
+        if end == size:
+            return
+        offset = end
+
+
+def parse_chunk(frame: bytes) -> Tuple[int, bool, memoryview]:
+    """Split a chunk frame into (attachment id, final, data); data is a view of frame."""
+    _, attachment_id, flags = _CHUNK_HEADER.unpack_from(frame)
+    return attachment_id, bool(flags & CHUNK_FINAL), memoryview(frame)[_CHUNK_HEADER.size:]
+
+
+class AttachmentStream:
+    """An attachment delivered chunk by chunk while it's still arriving.
+
+        async for chunk in message.blob:
+            f.write(chunk)
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._chunks: "asyncio.Queue[Union[memoryview, Exception, None]]" = asyncio.Queue()
+        # Bytes received but not read yet
+        self.buffered = 0
+        self.finished = False
+
+    def feed(self, chunk: memoryview) -> None:
+        self.buffered += len(chunk)
+        self._chunks.put_nowait(chunk)
+
+    def close(self) -> None:
+        self.finished = True
+        self._chunks.put_nowait(None)
+
+    def abort(self, error: Exception) -> None:
+        self.finished = True
+        self._chunks.put_nowait(error)
+
+    async def __aiter__(self) -> AsyncIterator[memoryview]:
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.buffered -= len(chunk)
+            yield chunk
+
+    async def read(self) -> bytearray:
+        """Wait for the whole attachment and return it."""
+        buffer = bytearray()
+        async for chunk in self:
+            buffer += chunk
+        return buffer
+
+
+class PendingMessage:
+    """An envelope waiting for its buffered attachments."""
+    def __init__(self, payload: Dict[str, Any]) -> None:
+        self.payload = payload
+        self.remaining = 0
+        # Whether some of its attachments are streamed
+        self.streaming = False
+
+
+class IncomingAttachment:
+    """Receiving side of one buffered attachment.
+
+    The buffer grows as chunks arrive rather than being allocated up front,
+    so announcing a big attachment doesn't cost anything until it's sent.
+    """
+    def __init__(self, message: PendingMessage, field: str, size: int) -> None:
+        self.message = message
+        self.field = field
+        self.size = size
+        self._buffer: Optional[bytearray] = None
+        self._received = 0
+
+    @property
+    def buffered(self) -> int:
+        """Bytes of memory held for this attachment."""
+        return len(self._buffer) if self._buffer is not None else 0
+
+    def feed(self, chunk: memoryview, final: bool) -> Optional[memoryview]:
+        """Add a chunk; return the complete attachment after the final one."""
+        end = self._received + len(chunk)
+        if end > self.size or (final and end != self.size):
+            raise WebSocketInvalidMessage(f"attachment size mismatch (expected {self.size} bytes)")
+        if final and self._buffer is None:
+            # Single chunk: hand out a view of the frame, no copy at all
+            return chunk
+        if self._buffer is None:
+            self._buffer = bytearray()
+        self._buffer += chunk
+        self._received = end
+        return memoryview(self._buffer) if final else None
@@ -0,0 +1,81 @@
+"""Result caching for @api methods."""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields, is_dataclass
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 60.0
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    """How an @api method caches its results.
+
+    Up to max_size results are kept, least recently used first out; each one
+    expires ttl seconds after it was computed (None to never expire).
+    """
+    max_size: int = DEFAULT_CACHE_SIZE
+    ttl: Optional[float] = DEFAULT_CACHE_TTL
+
+
+def cache_key(args: Dict[str, Any]) -> Optional[Hashable]:
+    """Key for a call with the given arguments, or None if it can't be cached."""
+    try:
+        key = _freeze(args)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if is_dataclass(value) and not isinstance(value, type):
+        return (type(value),) + tuple(_freeze(getattr(value, field.name)) for field in fields(value))
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    # Anything else (raw data, buffers, ...) makes the call uncacheable
+    raise TypeError(f"uncacheable value of type {type(value).__name__}")
+
+
+class ResultCache:
+    """LRU cache with per-entry expiry; counts hits and misses."""
+    def __init__(self, policy: CachePolicy) -> None:
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiry time or None, result), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires is None or expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            del self._entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key: Hashable, result: Any) -> None:
+        ttl = self.policy.ttl
+        self._entries[key] = (None if ttl is None else time.monotonic() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.policy.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop one entry, or all of them when key is None."""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
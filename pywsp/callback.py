@@ -16,3 +16,15 @@ class WebSocketMessageCallback(ABC):
     @abstractmethod
     async def on_new_message(self, ws: "WebSocket", message: Any) -> None:
         pass
+
+    async def on_closing(self, ws: "WebSocket") -> None:
+        """Called when a client socket's message loop ends."""
+        pass
+
+    async def on_reconnected(self, ws: "WebSocket", resumed: bool) -> None:
+        """Called when a client socket with a reconnect policy is connected again.
+
+        resumed is True when the server replayed everything sent while we were
+        away; otherwise messages may have been lost and state may need a resync.
+        """
+        pass
@@ -0,0 +1,223 @@
+import json
+import re
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from .const import MESSAGE_TYPE_BATCH
+from .message import batch_envelope, json_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SUBPROTOCOL_JSON = "pywsp.json"
+SUBPROTOCOL_MSGPACK = "pywsp.msgpack"
+
+
+class Codec(ABC):
+    """Turns message envelopes into WebSocket frame payloads and back.
+
+    The codec used on a connection is picked through the Sec-WebSocket-Protocol
+    handshake, so subprotocol names the wire format. Codecs sharing a
+    subprotocol (like JsonCodec and OrjsonCodec) are interchangeable.
+    """
+    subprotocol: str
+    # Binary codecs produce bytes and are sent as BINARY frames; text codecs
+    # produce str and are sent as TEXT frames.
+    binary: bool
+
+    @abstractmethod
+    def encode(self, envelope: Union[Dict[str, Any], List[Any]]) -> Union[str, bytes]:
+        pass
+
+    @abstractmethod
+    def decode(self, data: Union[str, bytes]) -> Any:
+        pass
+
+    def decode_header(self, frame: Union[str, bytes]) -> Optional[Tuple[Dict[str, Any], Any]]:
+        """Decode an envelope except for its data section.
+
+        Returns the other envelope fields and the data section still encoded
+        (for decode_data()), or None if the frame can't be split cheaply, in
+        which case it has to go through decode().
+        """
+        return None
+
+    def decode_data(self, data: Any) -> Any:
+        """Decode a data section split off by decode_header()."""
+        return self.decode(data)
+
+    def splice(self, header: Dict[str, Any], data: Union[str, bytes]) -> Union[str, bytes]:
+        """Build an envelope from its header and a data section already encoded.
+
+        data comes from encode(), so one encoding of a message's data can go
+        out in envelopes with different headers.
+        """
+        return self.encode({ **header, "data": self.decode(data) })
+
+    def join(self, frames: Sequence[Union[str, bytes]]) -> Union[str, bytes]:
+        """Pack frames produced by encode() into one batch frame."""
+        return self.encode(batch_envelope([self.decode(frame) for frame in frames]))
+
+
+# What pyWSP writes before "data": members holding numbers, strings without
+# escapes, booleans or null. Anything else isn't split.
+_JSON_HEADER = re.compile(
+    r'\s*\{((?:\s*"[^"\\]*"\s*:\s*(?:-?\d+(?:\.\d+)?|"[^"\\]*"|true|false|null)\s*,)*)\s*"data"\s*:')
+
+
+def _split_json_envelope(frame: Union[str, bytes]) -> Optional[Tuple[Dict[str, Any], str]]:
+    """Parse the members of a JSON envelope up to "data".
+
+    pyWSP writes data last, so the rest of the document is the data section.
+    Frames that put fields after data get a data section decode_data() fails
+    on, sending the caller back to a full decode.
+    """
+    if not isinstance(frame, str):
+        return None
+    match = _JSON_HEADER.match(frame)
+    if match is None:
+        return None
+    members = match.group(1)
+    header = json.loads(f"{{{members[:-1]}}}") if members else { }
+    end = frame.rfind("}")
+    if end < match.end():
+        return None
+    return header, frame[match.end():end]
+
+
+def _splice_json(header: str, data: str) -> str:
+    # Reopen the header object and append data as its last member
+    return f'{header[:-1]}, "data": {data}}}' if len(header) > 2 else f'{{"data": {data}}}'
+
+
+_JSON_BATCH_PREFIX = f'{{"@id": 0, "@type": "{MESSAGE_TYPE_BATCH}", "data": {{"messages": ['
+_JSON_BATCH_SUFFIX = "]}}"
+
+
+class JsonCodec(Codec):
+    subprotocol = SUBPROTOCOL_JSON
+    binary = False
+
+    def encode(self, envelope: Union[Dict[str, Any], List[Any]]) -> str:
+        return json.dumps(envelope, default=json_default)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def decode_header(self, frame: Union[str, bytes]) -> Optional[Tuple[Dict[str, Any], Any]]:
+        return _split_json_envelope(frame)
+
+    def splice(self, header: Dict[str, Any], data: Union[str, bytes]) -> str:
+        return _splice_json(self.encode(header), data)
+
+    def join(self, frames: Sequence[Union[str, bytes]]) -> str:
+        # Each frame already is a JSON document; splice them into an array
+        return _JSON_BATCH_PREFIX + ", ".join(frames) + _JSON_BATCH_SUFFIX
+
+
+class OrjsonCodec(Codec):
+    subprotocol = SUBPROTOCOL_JSON
+    binary = False
+
+    def __init__(self) -> None:
+        if orjson is None:
+            raise RuntimeError("OrjsonCodec requires the 'orjson' package")
+
+    def encode(self, envelope: Union[Dict[str, Any], List[Any]]) -> str:
+        return orjson.dumps(envelope, default=json_default).decode()
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def decode_header(self, frame: Union[str, bytes]) -> Optional[Tuple[Dict[str, Any], Any]]:
+        return _split_json_envelope(frame)
+
+    def splice(self, header: Dict[str, Any], data: Union[str, bytes]) -> str:
+        return _splice_json(self.encode(header), data)
+
+    def join(self, frames: Sequence[Union[str, bytes]]) -> str:
+        return _JSON_BATCH_PREFIX + ", ".join(frames) + _JSON_BATCH_SUFFIX
+
+
+class MsgpackCodec(Codec):
+    subprotocol = SUBPROTOCOL_MSGPACK
+    binary = True
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise RuntimeError("MsgpackCodec requires the 'msgpack' package")
+
+    def encode(self, envelope: Union[Dict[str, Any], List[Any]]) -> bytes:
+        return msgpack.packb(envelope, default=json_default)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            data = data.encode()
+        return msgpack.unpackb(data, raw=False)
+
+    def decode_header(self, frame: Union[str, bytes]) -> Optional[Tuple[Dict[str, Any], Any]]:
+        # Maps can be walked key by key, and skipping a value doesn't build it
+        if isinstance(frame, str):
+            return None
+        header: Dict[str, Any] = { }
+        data = None
+        try:
+            unpacker = msgpack.Unpacker(raw=False)
+            unpacker.feed(frame)
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key == "data":
+                    start = unpacker.tell()
+                    unpacker.skip()
+                    data = memoryview(frame)[start:unpacker.tell()]
+                else:
+                    header[key] = unpacker.unpack()
+        except Exception:
+            return None
+        if data is None:
+            return None
+        return header, data
+
+    def splice(self, header: Dict[str, Any], data: Union[str, bytes]) -> bytes:
+        packer = msgpack.Packer(default=json_default)
+        parts = [packer.pack_map_header(len(header) + 1)]
+        for key, value in header.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        parts.append(packer.pack("data"))
+        parts.append(data)
+        return b"".join(parts)
+
+    def join(self, frames: Sequence[Union[str, bytes]]) -> bytes:
+        # Packed values concatenate; only the array header needs writing
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+        prefix = msgpack.packb(batch_envelope([]))
+        # batch_envelope([]) ends with an empty array (0x90); swap in our header
+        return prefix[:-1] + header + b"".join(frames)
+
+
+DEFAULT_CODEC: Codec = JsonCodec()
+
+
+def select_codec(codecs: Iterable[Codec], subprotocol: Optional[str]) -> Codec:
+    """Return the codec for a negotiated subprotocol.
+
+    Peers that didn't negotiate one are assumed to speak plain JSON.
+    """
+    for codec in codecs:
+        if codec.subprotocol == subprotocol:
+            return codec
+    return DEFAULT_CODEC
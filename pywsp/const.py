@@ -2,11 +2,64 @@ from typing import Final
 
 MESSAGE_ID: Final = "@id"
 MESSAGE_TYPE: Final = "@type"
+MESSAGE_REPLY_TO: Final = "@reply_to"
+# Initial flow control credits for a streamed response, sent with the request
+MESSAGE_CREDIT: Final = "@credit"
+# Binary fields sent as separate frames: field -> { "id": ..., "size": ... }
+MESSAGE_ATTACHMENTS: Final = "@attachments"
+# Set on delta encoded messages: the @id of the message they're relative to
+MESSAGE_DELTA: Final = "@delta"
 
 MESSAGE_TYPE_EVENT: Final = "event"
 
+# Message types starting with this prefix are reserved for pyWSP's own control
+# messages, which are handled by the library instead of the application.
+CONTROL_MESSAGE_PREFIX: Final = "pywsp."
+MESSAGE_TYPE_SUBSCRIBE: Final = "pywsp.subscribe"
+MESSAGE_TYPE_UNSUBSCRIBE: Final = "pywsp.unsubscribe"
+MESSAGE_TYPE_CAPABILITIES: Final = "pywsp.capabilities"
+MESSAGE_TYPE_BATCH: Final = "pywsp.batch"
+MESSAGE_TYPE_REGISTRY: Final = "pywsp.registry"
+MESSAGE_TYPE_ERROR: Final = "pywsp.error"
+MESSAGE_TYPE_SESSION: Final = "pywsp.session"
+MESSAGE_TYPE_STREAM_CREDIT: Final = "pywsp.stream_credit"
+MESSAGE_TYPE_STREAM_CANCEL: Final = "pywsp.stream_cancel"
+MESSAGE_TYPE_STREAM_END: Final = "pywsp.stream_end"
+
+# Clients list the optional protocol features they understand in this handshake
+# header; the server answers with a capabilities control message.
+CAPABILITIES_HEADER: Final = "X-PyWSP-Capabilities"
+CAPABILITY_BATCH: Final = "batch"
+CAPABILITY_COMPACT: Final = "compact"
+CAPABILITY_RESUME: Final = "resume"
+
+# Sent by reconnecting clients to resume their session: its id, and the @id of
+# the last message received in it
+SESSION_HEADER: Final = "X-PyWSP-Session"
+LAST_ID_HEADER: Final = "X-PyWSP-Last-Id"
+
 PYWSP_MESSAGE_ID = "_pywsp_message_id"
 PYWSP_MESSAGE_TYPE = "_pywsp_message_type"
+PYWSP_COMPRESS = "_pywsp_compress"
+PYWSP_MAX_SIZE = "_pywsp_max_size"
+PYWSP_RAW = "_pywsp_raw"
+PYWSP_DELTA = "_pywsp_delta"
 
 INPUT_MESSAGE_TYPE = "input_message_type"
 OUTPUT_MESSAGE_TYPE = "output_message_type"
+API_CACHE_POLICY = "api_cache_policy"
+API_COALESCE = "api_coalesce"
+API_EXECUTOR = "api_executor"
+
+# WebSocketErrorMessage codes
+ERROR_UNSPECIFIED: Final = 0
+# Over a rate limit; retry_after says when a token frees up
+ERROR_RATE_LIMITED: Final = 429
+# Too many handlers running on the server; retry_after is a hint
+ERROR_OVERLOADED: Final = 503
+
+# What a WebSocket does when its bounded send queue is full
+OVERFLOW_BLOCK: Final = "block"
+OVERFLOW_DROP_OLDEST: Final = "drop-oldest"
+OVERFLOW_DROP_NEWEST: Final = "drop-newest"
+OVERFLOW_DISCONNECT: Final = "disconnect"
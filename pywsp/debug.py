@@ -0,0 +1,12 @@
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def dump_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    """Log every pending task on the loop along with its current stack."""
+    for task in asyncio.all_tasks(loop):
+        _LOGGER.debug("task: %s", task)
+        for frame in task.get_stack():
+            _LOGGER.debug("    %s:%d %s", frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
@@ -0,0 +1,125 @@
+"""Delta encoding for @message(delta=True) types.
+
+Each socket remembers the data section it last sent for every (type, key)
+pair, key being the value of the type's delta_key field (if it has one).
+The next message for the same pair only carries the top level fields that
+changed, plus the key, and names the message it's relative to under "@delta":
+
+    { "@id": 12, "@type": "telemetry", "@delta": 7, "data": { "device": "a", "temp": 21.5 } }
+
+The receiver fills in the missing fields from message 7. A delta whose base
+the receiver doesn't have (because a message was dropped on the way, say) is
+discarded, and every keyframe_interval messages the whole data section is
+sent again, so the two sides can't drift apart for long.
+"""
+import copy
+import logging
+from typing import Any, Dict, Hashable, NamedTuple, Optional, Tuple
+
+from .const import MESSAGE_DELTA, MESSAGE_ID, MESSAGE_TYPE
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_KEYFRAME_INTERVAL = 50
+
+# Values that can be kept as they are, without a copy
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None), bytes)
+
+_MISSING = object()
+
+
+class DeltaSpec(NamedTuple):
+    """How a message type is delta encoded (what @message(delta=True) sets)."""
+    key: Optional[str]
+    keyframe_interval: int
+
+
+def _snapshot(value: Any) -> Any:
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    # Lists and dicts go out without being copied, so the caller may still change them
+    return copy.deepcopy(value)
+
+
+class _Base:
+    __slots__ = ("message_id", "data", "deltas")
+
+    def __init__(self, message_id: int, data: Dict[str, Any]) -> None:
+        self.message_id = message_id
+        self.data = data
+        # Deltas sent since the last keyframe
+        self.deltas = 0
+
+
+class DeltaEncoder:
+    """Sending side: the last data sent per message type and key."""
+    def __init__(self) -> None:
+        self._sent: Dict[str, Dict[Hashable, _Base]] = { }
+
+    def encode(self, envelope: Dict[str, Any], spec: DeltaSpec) -> None:
+        """Turn envelope into a delta against the last one of its kind, if there's one."""
+        data = envelope["data"]
+        if data.__class__ is not dict:
+            return
+        key = data.get(spec.key) if spec.key is not None else None
+        sent = self._sent.setdefault(envelope[MESSAGE_TYPE], { })
+        base = sent.get(key)
+        snapshot = data.copy()
+        if base is None or base.deltas + 1 >= spec.keyframe_interval:
+            # Keyframe: the whole data section goes out
+            for name, value in data.items():
+                if value.__class__ not in _IMMUTABLE_TYPES:
+                    snapshot[name] = _snapshot(value)
+            sent[key] = _Base(envelope[MESSAGE_ID], snapshot)
+            return
+
+        changed = { }
+        if spec.key is not None:
+            changed[spec.key] = key
+        previous = base.data
+        for name, value in data.items():
+            if value.__class__ not in _IMMUTABLE_TYPES:
+                snapshot[name] = _snapshot(value)
+            if previous.get(name, _MISSING) != value:
+                changed[name] = value
+        envelope[MESSAGE_DELTA] = base.message_id
+        # Keep data the last member of the envelope
+        del envelope["data"]
+        envelope["data"] = changed
+        base.message_id = envelope[MESSAGE_ID]
+        base.data = snapshot
+        base.deltas += 1
+
+    def reset(self, message_type: Optional[str] = None) -> None:
+        """Send the next message of message_type (or of any type) in full."""
+        if message_type is None:
+            self._sent.clear()
+        else:
+            self._sent.pop(message_type, None)
+
+
+class DeltaDecoder:
+    """Receiving side: the last full data section received per message type and key."""
+    def __init__(self) -> None:
+        # type -> key -> (message id, data)
+        self._received: Dict[str, Dict[Hashable, Tuple[int, Dict[str, Any]]]] = { }
+
+    def apply(self, payload: Dict[str, Any], spec: DeltaSpec) -> Optional[Dict[str, Any]]:
+        """The full data section of payload, or None if its base is missing."""
+        data = payload["data"]
+        if data.__class__ is not dict:
+            return data
+        key = data.get(spec.key) if spec.key is not None else None
+        received = self._received.setdefault(payload[MESSAGE_TYPE], { })
+        base_id = payload.get(MESSAGE_DELTA)
+        if base_id is not None:
+            base = received.get(key)
+            if base is None or base[0] != base_id:
+                _LOGGER.warning(
+                    "discarding '%s' delta against message %s, which we don't have",
+                    payload[MESSAGE_TYPE], base_id)
+                return None
+            data = { **base[1], **data }
+        received[key] = (payload[MESSAGE_ID], data)
+        # Keep our own top level: decoders may hold on to what they're given
+        return dict(data)
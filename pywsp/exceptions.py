@@ -7,3 +7,9 @@ class WebSocketInvalidMessage(WebSocketException):
 
 class WebSocketUnsupportedMessageType(WebSocketException):
     """Unsupported message type."""
+
+class WebSocketConnectionClosed(WebSocketException):
+    """Connection closed before a response arrived."""
+
+class WebSocketSendQueueFull(WebSocketException):
+    """Send queue overflowed and the connection was dropped."""
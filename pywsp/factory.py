@@ -1,12 +1,37 @@
-from dataclasses import dataclass
-from typing import Any, Dict
+from dataclasses import fields, is_dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union, get_args, get_origin, get_type_hints
+import collections.abc
+import itertools
+import types
+
+from .const import PYWSP_DELTA, PYWSP_MESSAGE_TYPE, PYWSP_RAW
+from .exceptions import WebSocketInvalidMessage, WebSocketUnsupportedMessageType
+
+Decoder = Callable[[Any], Any]
+
+_PRIMITIVE_TYPES = (str, int, float, bool, type(None))
+_LIST_TYPES = (list, collections.abc.Sequence, collections.abc.MutableSequence)
+_SET_TYPES = (set, collections.abc.Set, collections.abc.MutableSet)
+_MAPPING_TYPES = (dict, collections.abc.Mapping, collections.abc.MutableMapping)
+# PEP 604 unions (X | None) only exist on Python 3.10+
+_UNION_TYPES = (Union, getattr(types, "UnionType", Union))
+# How many levels of nested containers and messages get written out in a
+# decoder; deeper ones go through their own decoder
+_MAX_INLINE_DEPTH = 6
 
-from .const import PYWSP_MESSAGE_TYPE
-from .exceptions import WebSocketUnsupportedMessageType
 
 class MessageFactory:
-    def __init__(self) -> None:
+    def __init__(self, *, strict: bool = False) -> None:
         self._registry: Dict[str, Any] = { }
+        # Registration order gives each type a stable index for compact envelopes
+        self._type_names: List[str] = []
+        # Bumped on every change, so sockets know when to announce the registry again
+        self.version = 0
+        # Decoder plans, built on first use for each class (registered or nested)
+        self._decoders: Dict[type, Decoder] = { }
+        self._strict = strict
+        # Whether any registered type is raw (sockets then keep data sections encoded)
+        self.has_raw_types = False
 
     def register_message_types(self, *message_types: Any) -> None:
         for cls in message_types:
@@ -14,8 +39,37 @@ class MessageFactory:
             if type is None:
                 raise TypeError(f"class {cls} is not compliant with pyWSP -- "
                     "is it missing the @message decorator?")
-            self._registry[type] = cls
+            if type not in self._registry:
+                self._type_names.append(type)
+            if self._registry.get(type) is not cls:
+                self._registry[type] = cls
+                self.version += 1
+            if getattr(cls, PYWSP_RAW, False):
+                self.has_raw_types = True
+
+
+    def get_message_class(self, message_type: str) -> Optional[type]:
+        return self._registry.get(message_type)
 
+    def type_at(self, index: int) -> Optional[str]:
+        """Message type with the given compact index."""
+        return self._type_names[index] if 0 <= index < len(self._type_names) else None
+
+    def layouts(self) -> List[Tuple[str, Optional[List[str]]]]:
+        """(type, field names) for every registered type, in index order.
+
+        This is what a peer needs to send us compact envelopes: the index of
+        each type and the order in which to list its fields. Raw types have
+        no field list, since their data section is kept as is, and neither do
+        delta encoded ones, whose deltas only carry some of their fields.
+        """
+        layouts: List[Tuple[str, Optional[List[str]]]] = []
+        for name in self._type_names:
+            cls = self._registry[name]
+            positional = not getattr(cls, PYWSP_RAW, False) and getattr(cls, PYWSP_DELTA, None) is None
+            names = [field.name for field in fields(cls) if field.init] if positional else None
+            layouts.append((name, names))
+        return layouts
 
     def create(self, message_type: str, **kwargs: Any) -> Any:
         if message_type not in self._registry:
@@ -23,3 +77,231 @@ class MessageFactory:
 
         message_class = self._registry[message_type]
         return message_class(**kwargs)
+
+    def decode(self, message_type: str, data: Dict[str, Any]) -> Any:
+        """Build a message from its decoded JSON data, nested messages included.
+
+        Unknown fields are ignored, or rejected with WebSocketInvalidMessage
+        when the factory is strict.
+        """
+        if message_type not in self._registry:
+            raise WebSocketUnsupportedMessageType(message_type)
+
+        return self._get_decoder(self._registry[message_type])(data)
+
+    def _get_decoder(self, cls: type) -> Decoder:
+        decoder = self._decoders.get(cls)
+        if decoder is None:
+            # Placeholder for self-referencing classes while the plan is built
+            self._decoders[cls] = lambda data: self._decoders[cls](data)
+            try:
+                decoder = self._decoders[cls] = self._build_decoder(cls)
+            except:
+                del self._decoders[cls]
+                raise
+        return decoder
+
+    def _build_decoder(self, cls: type) -> Decoder:
+        if getattr(cls, PYWSP_RAW, False):
+            # The socket hands raw messages their data section as a RawData
+            return cls
+
+        try:
+            hints = get_type_hints(cls)
+        except (NameError, TypeError):
+            hints = { }
+
+        plan: List[Tuple[str, Optional[Decoder]]] = [
+            (field.name, self._value_decoder(hints.get(field.name, Any)))
+            for field in fields(cls) if field.init
+        ]
+        names = frozenset(name for name, _ in plan)
+
+        def other(data: Any) -> Any:
+            if data is None or isinstance(data, cls):
+                return data
+            raise WebSocketInvalidMessage(
+                f"expected an object for '{cls.__name__}', got {type(data).__name__}")
+
+        def reject(data: Dict[str, Any]) -> None:
+            unknown = data.keys() - names
+            raise WebSocketInvalidMessage(
+                f"unknown fields for '{cls.__name__}': {', '.join(sorted(unknown))}")
+
+        def partial(data: Dict[str, Any]) -> Any:
+            # Some fields are missing; let the class defaults (or errors) kick in
+            kwargs = { }
+            for name, converter in plan:
+                if name in data:
+                    value = data[name]
+                    kwargs[name] = value if converter is None else converter(value)
+            return cls(**kwargs)
+
+        # Generate a straight-line function for the common case where every field
+        # is present, so decoding is a single call per nested object.
+        namespace: Dict[str, Any] = {
+            "_cls": cls, "_names": names, "_other": other, "_reject": reject, "_partial": partial,
+        }
+        arguments = []
+        counter = itertools.count()
+        for index, (name, converter) in enumerate(plan):
+            if converter is None:
+                arguments.append(f"{name}=data[{name!r}]")
+            else:
+                namespace[f"_convert{index}"] = converter
+                expression = self._inline(hints.get(name, Any), f"data[{name!r}]", namespace, counter, 1)
+                arguments.append(f"{name}={expression}")
+
+        # Compact envelopes carry the fields as a list, in plan order
+        positional = [
+            f"{name}=data[{index}]" if converter is None else f"{name}=_convert{index}(data[{index}])"
+            for index, (name, converter) in enumerate(plan)
+        ]
+        namespace["_positional_error"] = lambda data: WebSocketInvalidMessage(
+            f"expected {len(plan)} fields for '{cls.__name__}', got {len(data)}")
+
+        lines = [
+            "def positional(data):",
+            f"    if len(data) != {len(plan)}:",
+            "        raise _positional_error(data)",
+            f"    return _cls({', '.join(positional)})",
+            "",
+            "def decode(data):",
+            "    if data.__class__ is not dict:",
+            "        if data.__class__ is list:",
+            "            return positional(data)",
+            "        return _other(data)",
+        ]
+        if self._strict:
+            lines += [
+                "    if not data.keys() <= _names:",
+                "        _reject(data)",
+            ]
+        lines += [
+            "    try:",
+            f"        return _cls({', '.join(arguments)})",
+            "    except KeyError:",
+            "        return _partial(data)",
+        ]
+        exec("\n".join(lines) + "\n", namespace)
+        decoder: Decoder = namespace["decode"]
+        decoder.__qualname__ = f"{cls.__qualname__}.<decoder>"
+        return decoder
+
+    def _nested_decoder(self, cls: type) -> Decoder:
+        return self._get_decoder(cls)
+
+    def _inline(
+            self,
+            tp: Any,
+            source: str,
+            namespace: Dict[str, Any],
+            counter: Iterator[int],
+            depth: int,
+            in_loop: bool = False) -> str:
+        """Python expression converting the JSON value source to tp.
+
+        Lists, dicts, optionals and nested messages are written out in place
+        rather than called through their converters, saving a call per item.
+        Nested messages missing fields raise KeyError, which sends the whole
+        message down the decoder's partial path.
+        """
+        converter = self._value_decoder(tp)
+        if converter is None:
+            return source
+        n = next(counter)
+        namespace[f"_c{n}"] = converter
+        if depth > _MAX_INLINE_DEPTH:
+            return f"_c{n}({source})"
+
+        if source.isidentifier():
+            value = bound = source
+        elif in_loop:
+            # Names bound inside a comprehension become closure cells, which
+            # costs more than looking the value up again
+            value = bound = source
+        else:
+            value = f"_v{n}"
+            bound = f"({value} := {source})"
+
+        if isinstance(tp, type) and is_dataclass(tp):
+            if self._strict or getattr(tp, PYWSP_RAW, False):
+                # Strict decoders check for unknown fields; raw ones keep the data as is
+                return f"_c{n}({source})"
+            try:
+                hints = get_type_hints(tp)
+            except (NameError, TypeError):
+                return f"_c{n}({source})"
+            namespace[f"_t{n}"] = tp
+            arguments = ", ".join(
+                f"{field.name}="
+                f"{self._inline(hints.get(field.name, Any), f'{value}[{field.name!r}]', namespace, counter, depth + 1, in_loop)}"
+                for field in fields(tp) if field.init)
+            return f"(_t{n}({arguments}) if {bound}.__class__ is dict else _c{n}({value}))"
+
+        origin = get_origin(tp)
+        args = get_args(tp)
+        if origin in _UNION_TYPES:
+            # Only Optional[X] gets a converter
+            option = next(arg for arg in args if arg is not type(None))
+            inner = self._inline(option, value, namespace, counter, depth, in_loop)
+            return f"(None if {bound} is None else {inner})"
+        item = f"_i{n}"
+        if origin in _LIST_TYPES:
+            inner = self._inline(args[0], item, namespace, counter, depth + 1, True)
+            return f"[{inner} for {item} in {source}]"
+        if origin in _MAPPING_TYPES:
+            inner = self._inline(args[1], item, namespace, counter, depth + 1, True)
+            return f"{{_k{n}: {inner} for _k{n}, {item} in {source}.items()}}"
+        return f"_c{n}({source})"
+
+    def _value_decoder(self, tp: Any) -> Optional[Decoder]:
+        """Build a converter for JSON values of type tp, or None if they're used as-is."""
+        if tp in _PRIMITIVE_TYPES or tp is Any:
+            return None
+        if isinstance(tp, type) and is_dataclass(tp):
+            return self._nested_decoder(tp)
+
+        origin = get_origin(tp)
+        args = get_args(tp)
+        if origin in _UNION_TYPES:
+            options = [arg for arg in args if arg is not type(None)]
+            if len(options) != 1:
+                return None
+            inner = self._value_decoder(options[0])
+            if inner is None:
+                return None
+            return lambda value: None if value is None else inner(value)
+
+        if origin in _LIST_TYPES:
+            inner = self._value_decoder(args[0]) if args else None
+            if inner is None:
+                return None
+            return lambda value: [inner(item) for item in value]
+
+        if origin is tuple:
+            if len(args) == 2 and args[1] is Ellipsis:
+                inner = self._value_decoder(args[0])
+                if inner is None:
+                    return tuple
+                return lambda value: tuple(inner(item) for item in value)
+            inners = [self._value_decoder(arg) for arg in args]
+            if not any(inners):
+                return tuple
+            return lambda value: tuple(
+                item if inner is None else inner(item) for inner, item in zip(inners, value))
+
+        if origin in _SET_TYPES or origin is frozenset:
+            container = frozenset if origin is frozenset else set
+            inner = self._value_decoder(args[0]) if args else None
+            if inner is None:
+                return container
+            return lambda value: container(inner(item) for item in value)
+
+        if origin in _MAPPING_TYPES:
+            inner = self._value_decoder(args[1]) if len(args) == 2 else None
+            if inner is None:
+                return None
+            return lambda value: {key: inner(item) for key, item in value.items()}
+
+        return None
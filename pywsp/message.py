@@ -1,24 +1,102 @@
-from dataclasses import dataclass
-from typing import Any, Callable, Dict, Optional, Type, TypeVar, Union
+from dataclasses import dataclass, fields, is_dataclass
+from typing import (
+    TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar, Union, get_args, get_origin,
+    get_type_hints, overload
+)
+import collections.abc
+import types
 
-from .const import MESSAGE_ID, MESSAGE_TYPE, PYWSP_MESSAGE_ID, PYWSP_MESSAGE_TYPE
+from .const import (
+    CONTROL_MESSAGE_PREFIX, ERROR_UNSPECIFIED, MESSAGE_CREDIT, MESSAGE_ID, MESSAGE_REPLY_TO, MESSAGE_TYPE,
+    MESSAGE_TYPE_BATCH, MESSAGE_TYPE_CAPABILITIES, MESSAGE_TYPE_ERROR, MESSAGE_TYPE_REGISTRY,
+    MESSAGE_TYPE_SESSION, MESSAGE_TYPE_STREAM_CANCEL, MESSAGE_TYPE_STREAM_CREDIT, MESSAGE_TYPE_STREAM_END,
+    MESSAGE_TYPE_SUBSCRIBE, MESSAGE_TYPE_UNSUBSCRIBE, PYWSP_COMPRESS, PYWSP_DELTA, PYWSP_MAX_SIZE,
+    PYWSP_MESSAGE_ID, PYWSP_MESSAGE_TYPE, PYWSP_RAW
+)
+from .delta import DEFAULT_KEYFRAME_INTERVAL, DeltaDecoder, DeltaSpec
 from .factory import MessageFactory
 
-@dataclass
-class WebSocketErrorMessage:
-    error_code: int = 0
-    error_message: str = ""
-
 T = TypeVar("T")
 
-def message(cls: Optional[Type[T]] = None, *, type: str) -> Union[Callable[[Type[T]], Type[T]], Type[T]]:
-    """Decorator used to tag message classes (dataclasses) used with WebSocket."""
+if TYPE_CHECKING:
+    from typing_extensions import dataclass_transform
+else:
+    # Only tells type checkers that message classes are dataclasses
+    def dataclass_transform(**kwargs: Any) -> Callable[[T], T]:
+        return lambda decorator: decorator
+
+@overload
+def message(
+        cls: None = None,
+        *,
+        type: str,
+        compress: Optional[bool] = ...,
+        max_size: Optional[int] = ...,
+        raw: bool = ...,
+        delta: bool = ...,
+        delta_key: Optional[str] = ...,
+        keyframe_interval: int = ...) -> Callable[[Type[T]], Type[T]]: ...
+
+@overload
+def message(
+        cls: Type[T],
+        *,
+        type: str,
+        compress: Optional[bool] = ...,
+        max_size: Optional[int] = ...,
+        raw: bool = ...,
+        delta: bool = ...,
+        delta_key: Optional[str] = ...,
+        keyframe_interval: int = ...) -> Type[T]: ...
+
+@dataclass_transform()
+def message(
+        cls: Optional[Type[T]] = None,
+        *,
+        type: str,
+        compress: Optional[bool] = None,
+        max_size: Optional[int] = None,
+        raw: bool = False,
+        delta: bool = False,
+        delta_key: Optional[str] = None,
+        keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL) -> Union[Callable[[Type[T]], Type[T]], Type[T]]:
+    """Decorator used to tag message classes (dataclasses) used with WebSocket.
+
+    compress overrides the socket's compression policy for this type: True
+    always compresses (when the connection negotiated it), False never does and
+    None leaves it to the socket's size threshold.
+
+    Incoming frames of this type bigger than max_size bytes are rejected before
+    their data is decoded.
+
+    raw classes have a single field holding the whole data section. When
+    sending, it can be any encodable value; received messages get a RawData
+    that is only decoded when asked to.
+
+    delta types are sent as deltas against the last message of the type sent
+    on the same connection: only the fields that changed go out. delta_key
+    names a field (holding a hashable value) that tells instances apart, e.g.
+    a device id, so each one gets deltas against its own previous value.
+    Every keyframe_interval messages, all the fields are sent again.
+    """
     def wrap(cls: Type[T]) -> Type[T]:
         # First, we wrap the class in dataclass since we want all that goodness
         cls = dataclass(cls)
+        if raw and len(fields(cls)) != 1:
+            raise TypeError(f"raw message class {cls.__name__} must have exactly one field")
+        if delta and raw:
+            raise TypeError(f"raw message class {cls.__name__} can't be delta encoded")
+        if delta_key is not None and delta_key not in {field.name for field in fields(cls)}:
+            raise TypeError(f"delta_key '{delta_key}' isn't a field of {cls.__name__}")
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1")
 
         setattr(cls, PYWSP_MESSAGE_ID, -1)
         setattr(cls, PYWSP_MESSAGE_TYPE, type)
+        setattr(cls, PYWSP_COMPRESS, compress)
+        setattr(cls, PYWSP_MAX_SIZE, max_size)
+        setattr(cls, PYWSP_RAW, raw)
+        setattr(cls, PYWSP_DELTA, DeltaSpec(delta_key, keyframe_interval) if delta else None)
         if cls.__annotations__:
             cls.__annotations__.update({
                 PYWSP_MESSAGE_ID: "int",
@@ -35,15 +113,285 @@ def message(cls: Optional[Type[T]] = None, *, type: str) -> Union[Callable[[Type
     return wrap(cls)
 
 
+@message(type=MESSAGE_TYPE_ERROR)
+class WebSocketErrorMessage:
+    """Sent in reply to a request that failed or was refused.
+
+    retry_after is set when the request may succeed if sent again after that
+    many seconds (e.g. when rate limited).
+    """
+    error_code: int = ERROR_UNSPECIFIED
+    error_message: str = ""
+    retry_after: Optional[float] = None
+
+@message(type=MESSAGE_TYPE_SUBSCRIBE)
+class WebSocketSubscribeMessage:
+    topics: List[str]
+
+@message(type=MESSAGE_TYPE_UNSUBSCRIBE)
+class WebSocketUnsubscribeMessage:
+    topics: List[str]
+
+@message(type=MESSAGE_TYPE_CAPABILITIES)
+class WebSocketCapabilitiesMessage:
+    capabilities: List[str]
+
+@message(type=MESSAGE_TYPE_REGISTRY)
+class WebSocketRegistryMessage:
+    """The sender's message types, as [type, [field, ...]] in compact index order."""
+    types: List[Any]
+
+@message(type=MESSAGE_TYPE_SESSION)
+class WebSocketSessionMessage:
+    """The session a connection belongs to; resumed is False if it starts afresh."""
+    session: str
+    resumed: bool
+
+@message(type=MESSAGE_TYPE_STREAM_CREDIT)
+class WebSocketStreamCreditMessage:
+    """Lets the server send `credits` more items of the stream started by request `stream`."""
+    stream: int
+    credits: int
+
+@message(type=MESSAGE_TYPE_STREAM_CANCEL)
+class WebSocketStreamCancelMessage:
+    stream: int
+
+@message(type=MESSAGE_TYPE_STREAM_END)
+class WebSocketStreamEndMessage:
+    """Last message of a streamed response (sent with reply_to set to the request)."""
+    error: Optional[str] = None
+
+
+class RawData:
+    """Data section of a raw message, decoded on first use.
+
+    raw is the still-encoded section as it appeared in the frame (None when
+    the message had to be decoded up front, e.g. as part of a batch).
+    """
+    __slots__ = ("raw", "_decode", "_value", "_decoded")
+
+    def __init__(self, raw: Any, decode: Callable[[Any], Any]) -> None:
+        self.raw = raw
+        self._decode = decode
+        self._value: Any = None
+        self._decoded = False
+
+    @classmethod
+    def from_value(cls, value: Any) -> "RawData":
+        return cls(None, lambda raw: value)
+
+    def decode(self) -> Any:
+        if not self._decoded:
+            self._value = self._decode(self.raw)
+            self._decoded = True
+        return self._value
+
+    def __reduce__(self) -> Any:
+        # Crossing into another process (e.g. an @api process pool): send the
+        # decoded value, since the decoder belongs to this process's socket
+        return (RawData.from_value, (self.decode(),))
+
+    def __repr__(self) -> str:
+        return f"RawData({self.raw!r})"
+
+
+def batch_envelope(envelopes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Wrap already built envelopes into a single batch envelope."""
+    return {
+        MESSAGE_ID: 0,
+        MESSAGE_TYPE: MESSAGE_TYPE_BATCH,
+        "data": { "messages": envelopes },
+    }
+
+
+# Envelope members a compact envelope can carry
+_COMPACT_MEMBERS = frozenset((MESSAGE_ID, MESSAGE_TYPE, MESSAGE_REPLY_TO, "data"))
+
+
+def compact_envelope(envelope: Dict[str, Any], layout: Tuple[int, Tuple[str, ...]]) -> Optional[List[Any]]:
+    """Rewrite an envelope as [type index, id, [field values], reply_to?].
+
+    layout is the receiver's (type index, field names) for the message type.
+    Returns None when the envelope doesn't fit: extra envelope members (like
+    attachments), a non-object data section or fields the layout lacks.
+    """
+    data = envelope["data"]
+    if not envelope.keys() <= _COMPACT_MEMBERS or data.__class__ is not dict:
+        return None
+    type_index, names = layout
+    if len(data) != len(names):
+        return None
+    try:
+        values = [data[name] for name in names]
+    except KeyError:
+        return None
+    compact = [type_index, envelope[MESSAGE_ID], values]
+    if MESSAGE_REPLY_TO in envelope:
+        compact.append(envelope[MESSAGE_REPLY_TO])
+    return compact
+
+
+def is_control_message(message: Any) -> bool:
+    """Whether message is one of pyWSP's reserved control messages."""
+    return getattr(message, PYWSP_MESSAGE_TYPE, "").startswith(CONTROL_MESSAGE_PREFIX)
+
+
+Encoder = Callable[[Any], Any]
+
+# Compiled to-dict functions, one per message class. Built lazily on first use so
+# forward references between message classes have a chance to resolve.
+_ENCODERS: Dict[type, Encoder] = { }
+
+_PRIMITIVE_TYPES = (str, int, float, bool, type(None))
+_SEQUENCE_TYPES = (list, tuple, collections.abc.Sequence, collections.abc.MutableSequence)
+_SET_TYPES = (set, frozenset, collections.abc.Set, collections.abc.MutableSet)
+_MAPPING_TYPES = (dict, collections.abc.Mapping, collections.abc.MutableMapping)
+# PEP 604 unions (X | None) only exist on Python 3.10+
+_UNION_TYPES = (Union, getattr(types, "UnionType", Union))
+
+
+def get_encoder(cls: type) -> Encoder:
+    """Return the cached to-dict function for a message (or any dataclass) type."""
+    encoder = _ENCODERS.get(cls)
+    if encoder is None:
+        if getattr(cls, PYWSP_RAW, False):
+            encoder = _ENCODERS[cls] = _raw_encoder(fields(cls)[0].name)
+        else:
+            encoder = _ENCODERS[cls] = _compile_encoder(cls)
+    return encoder
+
+
+def _raw_encoder(name: str) -> Encoder:
+    def encode(obj: Any) -> Any:
+        value = getattr(obj, name)
+        return value.decode() if isinstance(value, RawData) else value
+    return encode
+
+
+def message_to_dict(message: Any) -> Dict[str, Any]:
+    """Convert a message into a JSON-ready dict.
+
+    Unlike dataclasses.asdict(), only nested message objects are converted;
+    lists and dicts holding plain values are passed through without copying.
+    """
+    return get_encoder(type(message))(message)
+
+
+def json_default(obj: Any) -> Any:
+    """``default`` hook for json.dumps() covering values typed as Any."""
+    if is_dataclass(obj) and not isinstance(obj, type):
+        return get_encoder(type(obj))(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _encode_nested(cls: type) -> Encoder:
+    def encode(value: Any) -> Any:
+        if value is None:
+            return None
+        return get_encoder(cls)(value)
+    return encode
+
+
+def _value_encoder(tp: Any) -> Optional[Encoder]:
+    """Build a converter for values of type tp, or None if they go out as-is."""
+    if tp in _PRIMITIVE_TYPES or tp is Any:
+        return None
+    if isinstance(tp, type) and is_dataclass(tp):
+        return _encode_nested(tp)
+
+    origin = get_origin(tp)
+    args = get_args(tp)
+    if origin in _UNION_TYPES:
+        options = [arg for arg in args if arg is not type(None)]
+        if len(options) != 1:
+            # Let json_default sort out whatever shows up at runtime
+            return None
+        inner = _value_encoder(options[0])
+        if inner is None:
+            return None
+        return lambda value: None if value is None else inner(value)
+
+    if origin is tuple and not (len(args) == 2 and args[1] is Ellipsis):
+        # Fixed length: each position has its own type
+        inners = [_value_encoder(arg) for arg in args]
+        if not any(inners):
+            return None
+        return lambda value: [
+            item if inner is None else inner(item) for inner, item in zip(inners, value)]
+
+    if origin in _SEQUENCE_TYPES or origin in _SET_TYPES:
+        inner = _value_encoder(args[0]) if args else None
+        if inner is not None:
+            return lambda value: [inner(item) for item in value]
+        if origin in _SET_TYPES:
+            return list
+        return None
+
+    if origin in _MAPPING_TYPES:
+        inner = _value_encoder(args[1]) if len(args) == 2 else None
+        if inner is not None:
+            return lambda value: {key: inner(item) for key, item in value.items()}
+        return None
+
+    return None
+
+
+def _compile_encoder(cls: type) -> Encoder:
+    try:
+        hints = get_type_hints(cls)
+    except (NameError, TypeError):
+        # Unresolvable annotations: pass the fields through, json_default still
+        # takes care of nested message objects.
+        hints = { }
+
+    namespace: Dict[str, Any] = { }
+    items = []
+    for index, field in enumerate(fields(cls)):
+        converter = _value_encoder(hints.get(field.name, Any))
+        if converter is None:
+            expression = f"obj.{field.name}"
+        else:
+            namespace[f"_convert{index}"] = converter
+            expression = f"_convert{index}(obj.{field.name})"
+        items.append(f"{field.name!r}: {expression}")
+
+    source = f"def encode(obj):\n    return {{{', '.join(items)}}}\n"
+    exec(source, namespace)
+    encoder: Encoder = namespace["encode"]
+    encoder.__qualname__ = f"{cls.__qualname__}.<encoder>"
+    return encoder
+
+
 def deserialize_message(
         message_payload: Dict[str, Any],
-        factory: MessageFactory) -> Any:
+        factory: MessageFactory,
+        deltas: Optional[DeltaDecoder] = None) -> Any:
+    """Build the message in a decoded envelope.
 
+    deltas holds what was received so far on the connection, for rebuilding
+    delta encoded messages; returns None for a delta that can't be applied.
+    """
     assert MESSAGE_ID in message_payload
     assert MESSAGE_TYPE in message_payload
     message_type: str = message_payload[MESSAGE_TYPE]
     data = message_payload["data"]
-    message = factory.create(message_type, **data)
+    cls = factory.get_message_class(message_type)
+    if not isinstance(data, RawData) and getattr(cls, PYWSP_RAW, False):
+        # Came through a path that decoded everything (e.g. a batch)
+        data = RawData.from_value(data)
+    spec = getattr(cls, PYWSP_DELTA, None)
+    if spec is not None and deltas is not None:
+        data = deltas.apply(message_payload, spec)
+        if data is None:
+            return None
+    message = factory.decode(message_type, data)
     setattr(message, MESSAGE_ID, message_payload[MESSAGE_ID])
     setattr(message, MESSAGE_TYPE, message_payload[MESSAGE_TYPE])
+    if MESSAGE_REPLY_TO in message_payload:
+        setattr(message, MESSAGE_REPLY_TO, message_payload[MESSAGE_REPLY_TO])
+    if MESSAGE_CREDIT in message_payload:
+        setattr(message, MESSAGE_CREDIT, message_payload[MESSAGE_CREDIT])
     return message
@@ -0,0 +1,182 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+# Latency buckets in seconds, from 10us (encoding a small message) up to 10s
+# (a slow handler)
+DEFAULT_BUCKETS = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0
+)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = { }
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class GaugeFunction:
+    """Gauge whose value is computed when metrics are collected.
+
+    Functions added later (e.g. by several servers sharing one Metrics) are
+    summed into the same value.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function: Callable[[], float]) -> None:
+        self.name = name
+        self.help = help
+        self._functions = [function]
+
+    def add(self, function: Callable[[], float]) -> None:
+        self._functions.append(function)
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {sum(function() for function in self._functions)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = { }
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> Iterator[str]:
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_label = f'le="{le}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, bucket_label)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total[0]}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+Collector = Union[Counter, GaugeFunction, Histogram]
+
+
+class Metrics:
+    """Counters and histograms for the main pyWSP paths.
+
+    Pass an instance to WebSocketServer, WebSocketApiServer or WebSocket to
+    turn instrumentation on; without one, every hook is a single None check.
+    """
+    def __init__(self) -> None:
+        self.messages_received = Counter(
+            "pywsp_messages_received_total", "Messages received, by message type.", ("type",))
+        self.messages_sent = Counter(
+            "pywsp_messages_sent_total", "Messages sent, by message type.", ("type",))
+        self.bytes_received = Counter(
+            "pywsp_bytes_received_total", "Frame payload bytes received.")
+        self.bytes_sent = Counter(
+            "pywsp_bytes_sent_total", "Frame payload bytes sent.")
+        self.encode_seconds = Histogram(
+            "pywsp_encode_seconds", "Time spent encoding outgoing messages.", ("type",))
+        self.decode_seconds = Histogram(
+            "pywsp_decode_seconds", "Time spent decoding incoming messages.", ("type",))
+        self.handler_seconds = Histogram(
+            "pywsp_handler_seconds", "Time spent in message handlers.", ("type",))
+        self.api_handler_seconds = Histogram(
+            "pywsp_api_handler_seconds", "Time spent in @api methods.", ("method",))
+        self.api_cache_requests = Counter(
+            "pywsp_api_cache_requests_total", "@api calls looked up in a result cache, by outcome.",
+            ("method", "result"))
+        self.messages_rejected = Counter(
+            "pywsp_messages_rejected_total", "Messages refused before reaching a handler, by type and reason.",
+            ("type", "reason"))
+        self.handler_errors = Counter(
+            "pywsp_handler_errors_total", "Exceptions raised by message handlers.", ("type",))
+        self.active_connections = Gauge(
+            "pywsp_active_connections", "Currently open server connections.")
+        self.connections_refused = Counter(
+            "pywsp_connections_refused_total", "Connections refused for being over max_connections.")
+        self.idle_closes = Counter(
+            "pywsp_idle_closes_total", "Connections closed after idle_timeout without traffic.")
+        self._collectors: List[Collector] = [
+            self.messages_received, self.messages_sent, self.bytes_received, self.bytes_sent,
+            self.encode_seconds, self.decode_seconds, self.handler_seconds,
+            self.api_handler_seconds, self.api_cache_requests, self.messages_rejected, self.handler_errors,
+            self.active_connections, self.connections_refused, self.idle_closes,
+        ]
+
+    def register(self, collector: Collector) -> None:
+        """Add another Counter, Gauge, GaugeFunction or Histogram to the output.
+
+        A GaugeFunction named like one already registered is folded into it,
+        so each metric family is only exported once.
+        """
+        if isinstance(collector, GaugeFunction):
+            for existing in self._collectors:
+                if isinstance(existing, GaugeFunction) and existing.name == collector.name:
+                    for function in collector._functions:
+                        existing.add(function)
+                    return
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for collector in self._collectors:
+            lines.append(f"# HELP {collector.name} {collector.help}")
+            lines.append(f"# TYPE {collector.name} {collector.kind}")
+            lines.extend(collector.samples())
+        return "\n".join(lines) + "\n"
@@ -1,28 +1,410 @@
 from aiohttp import web
 from aiohttp.web import Request, StreamResponse
+import asyncio
+import itertools
 import logging
-from typing import Any, Dict, List, Tuple
+import time
+import uuid
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Set, Tuple, Union
 
+from .admission import InFlightLimit, RateLimit
+from .attachment import (
+    DEFAULT_ATTACHMENT_CHUNK_SIZE, DEFAULT_MAX_ATTACHMENT_SIZE, DEFAULT_MAX_PENDING_ATTACHMENT_SIZE, split_attachments
+)
 from .callback import WebSocketConnectionCallback
+from .codec import Codec, select_codec
+from .const import (
+    CAPABILITIES_HEADER, CAPABILITY_COMPACT, CAPABILITY_RESUME, LAST_ID_HEADER, MESSAGE_ID, MESSAGE_TYPE,
+    OVERFLOW_BLOCK, PYWSP_COMPRESS, SESSION_HEADER
+)
 from .factory import MessageFactory
-from .socket import WebSocket
+from .message import WebSocketSessionMessage, WebSocketSubscribeMessage, WebSocketUnsubscribeMessage, compact_envelope
+from .metrics import PROMETHEUS_CONTENT_TYPE, GaugeFunction, Metrics
+from .session import DEFAULT_SESSION_TIMEOUT, Session
+from .socket import DEFAULT_BATCH_MAX_BYTES, DEFAULT_MAX_MSG_SIZE, WebSocket
+
+if TYPE_CHECKING:
+    from .workers import WorkerChannel
 
 _LOGGER = logging.getLogger(__name__)
 
+DEFAULT_BROADCAST_TIMEOUT = 5.0
+
 class WebSocketServer:
-    def __init__(self, factory: MessageFactory):
+    def __init__(
+            self,
+            factory: MessageFactory,
+            *,
+            max_concurrency: Optional[int] = None,
+            ordering_key: Optional[Callable[[Any], Optional[Hashable]]] = None,
+            codecs: Optional[Sequence[Codec]] = None,
+            batch_window: Optional[float] = None,
+            batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+            send_queue_size: Optional[int] = None,
+            overflow_policy: str = OVERFLOW_BLOCK,
+            compress: bool = True,
+            compress_min_size: Optional[int] = None,
+            max_msg_size: int = DEFAULT_MAX_MSG_SIZE,
+            heartbeat: Optional[float] = None,
+            metrics: Optional[Metrics] = None,
+            metrics_path: Optional[str] = "/metrics",
+            attachment_chunk_size: int = DEFAULT_ATTACHMENT_CHUNK_SIZE,
+            attachment_stream_threshold: Optional[int] = None,
+            max_attachment_size: int = DEFAULT_MAX_ATTACHMENT_SIZE,
+            max_pending_attachment_size: int = DEFAULT_MAX_PENDING_ATTACHMENT_SIZE,
+            compact_envelopes: bool = False,
+            rate_limit: Optional[RateLimit] = None,
+            type_rate_limits: Optional[Dict[str, RateLimit]] = None,
+            max_in_flight: Optional[int] = None,
+            max_connections: Optional[int] = None,
+            idle_timeout: Optional[float] = None,
+            session_buffer_size: Optional[int] = None,
+            session_timeout: float = DEFAULT_SESSION_TIMEOUT):
         self._callback: WebSocketConnectionCallback
         self._site: web.BaseSite
 
         self._factory = factory
-        self.clients: List[WebSocket] = []
+        self._max_concurrency = max_concurrency
+        self._ordering_key = ordering_key
+        # Codecs accepted, in order of preference. Clients that don't ask for a
+        # subprotocol get plain JSON.
+        self._codecs = list(codecs or [])
+        self._message_ids = itertools.count(1)
+        self._batch_window = batch_window
+        self._batch_max_bytes = batch_max_bytes
+        self._send_queue_size = send_queue_size
+        self._overflow_policy = overflow_policy
+        # permessage-deflate is only used with clients that ask for it
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._max_msg_size = max_msg_size
+        self._heartbeat = heartbeat
+        # Like message ids, attachment ids for broadcasts come from one counter
+        self._attachment_ids = itertools.count(1)
+        self._attachment_chunk_size = attachment_chunk_size
+        self._attachment_stream_threshold = attachment_stream_threshold
+        self._max_attachment_size = max_attachment_size
+        self._max_pending_attachment_size = max_pending_attachment_size
+        self._compact_envelopes = compact_envelopes
+        # Admission control: rate_limit and type_rate_limits apply to each
+        # connection; max_in_flight caps the handlers running across all of them
+        self._rate_limit = rate_limit
+        self._type_rate_limits = type_rate_limits
+        self._in_flight_limit = InFlightLimit(max_in_flight) if max_in_flight is not None else None
+        # Connection lifecycle. heartbeat (above) pings peers and drops the ones
+        # that stop answering; idle_timeout closes connections without any
+        # message traffic for that long; past max_connections, new connections
+        # are refused before the WebSocket upgrade.
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        # Upgrades in progress, counted against max_connections
+        self._handshakes = 0
+        # Resumable sessions (opt-in) for clients that reconnect on their own.
+        # Each keeps the last session_buffer_size messages sent in it, and
+        # outlives its connection by session_timeout seconds.
+        if session_buffer_size is not None and session_buffer_size < 1:
+            raise ValueError("session_buffer_size must be at least 1")
+        self._session_buffer_size = session_buffer_size
+        self._session_timeout = session_timeout
+        self._sessions: Dict[str, Session] = { }
+        # Instrumentation is off unless a Metrics instance is given; metrics_path
+        # is where start_listening() serves them (None to not serve them).
+        self._metrics = metrics
+        self._metrics_path = metrics_path
+        if metrics is not None:
+            metrics.register(GaugeFunction(
+                "pywsp_send_queue_depth",
+                "Frames waiting in send queues, across all connections.",
+                lambda: sum(ws.send_queue_depth for ws in self._clients)))
+            metrics.register(GaugeFunction(
+                "pywsp_dropped_messages",
+                "Messages dropped by the send queues of open connections.",
+                lambda: sum(ws.dropped_messages for ws in self._clients)))
+            metrics.register(GaugeFunction(
+                "pywsp_buffered_bytes",
+                "Bytes buffered by open connections (send queues, batches, attachments).",
+                lambda: sum(ws.buffered_bytes for ws in self._clients)))
+        # Subscription index: topic -> subscribers, plus the reverse mapping so a
+        # closing connection can be dropped without scanning every topic.
+        self._subscribers: Dict[str, Set[WebSocket]] = { }
+        self._topics: Dict[WebSocket, Set[str]] = { }
+        # Open connections, in connection order (a dict for O(1) removal)
+        self._clients: Dict[WebSocket, None] = { }
+        # Handlers for control messages the server doesn't handle itself
+        self._control_handlers: Dict[type, Callable[[WebSocket, Any], Awaitable[None]]] = { }
+        # Set when running under a WorkerPool: carries broadcasts and publishes
+        # to the connections held by the other workers
+        self._channel: Optional["WorkerChannel"] = None
+
+        self._factory.register_message_types(WebSocketSubscribeMessage, WebSocketUnsubscribeMessage)
+
+    @property
+    def clients(self) -> List[WebSocket]:
+        """The open connections, oldest first."""
+        return list(self._clients)
 
     def register_callback(self, callback: WebSocketConnectionCallback) -> None:
         self._callback = callback
 
+    def register_control_handler(
+            self,
+            message_type: type,
+            handler: Callable[[WebSocket, Any], Awaitable[None]]) -> None:
+        """Route control messages of message_type (a "pywsp." type) to handler."""
+        self._factory.register_message_types(message_type)
+        self._control_handlers[message_type] = handler
+
+    def attach_channel(self, channel: "WorkerChannel") -> None:
+        self._channel = channel
+
     async def close(self) -> None:
         await self._site.stop()
 
+    async def shutdown(self) -> None:
+        """Stop accepting connections, then close the open ones gracefully."""
+        await self.close()
+        await asyncio.gather(*[ws.close() for ws in list(self._clients)], return_exceptions=True)
+
+    async def broadcast(
+            self,
+            message: Any,
+            *,
+            filter: Optional[Callable[[WebSocket], bool]] = None,
+            timeout: Optional[float] = DEFAULT_BROADCAST_TIMEOUT) -> int:
+        """Send a message to every connected client (or those passing filter).
+
+        The message is encoded once per codec in use and the same frame is sent
+        to every recipient concurrently. A recipient that doesn't take the frame
+        within timeout seconds is skipped. Returns the number of clients the
+        message was delivered to.
+
+        Under a WorkerPool, broadcasts without a filter also reach the clients
+        of the other workers (which aren't counted in the result).
+        """
+        recipients = [
+            ws for ws in self._clients
+            if ws.connected() and (filter is None or filter(ws))
+        ]
+        return await self._send_to(recipients, message, timeout, forward=filter is None)
+
+    async def publish(
+            self,
+            topic: str,
+            message: Any,
+            *,
+            timeout: Optional[float] = DEFAULT_BROADCAST_TIMEOUT) -> int:
+        """Send a message to the clients subscribed to topic.
+
+        Works like broadcast(), but only touches the topic's subscribers.
+        """
+        recipients = [ws for ws in self._subscribers.get(topic, ()) if ws.connected()]
+        return await self._send_to(recipients, message, timeout, topic=topic, forward=True)
+
+    def subscribe(self, ws: WebSocket, *topics: str) -> None:
+        for topic in topics:
+            self._subscribers.setdefault(topic, set()).add(ws)
+        self._topics.setdefault(ws, set()).update(topics)
+
+    def unsubscribe(self, ws: WebSocket, *topics: str) -> None:
+        """Remove ws from topics, or from every topic if none are given."""
+        subscribed = self._topics.get(ws)
+        if not subscribed:
+            return
+        for topic in (topics or list(subscribed)):
+            subscribed.discard(topic)
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(ws)
+                if not subscribers:
+                    del self._subscribers[topic]
+        if not subscribed:
+            del self._topics[ws]
+
+    def subscribers(self, topic: str) -> Set[WebSocket]:
+        return set(self._subscribers.get(topic, ()))
+
+    async def _handle_control_message(self, ws: WebSocket, message: Any) -> None:
+        if isinstance(message, WebSocketSubscribeMessage):
+            _LOGGER.debug("%s subscribing to %s", ws.peer_info, message.topics)
+            self.subscribe(ws, *message.topics)
+        elif isinstance(message, WebSocketUnsubscribeMessage):
+            _LOGGER.debug("%s unsubscribing from %s", ws.peer_info, message.topics)
+            if message.topics:
+                self.unsubscribe(ws, *message.topics)
+        elif type(message) in self._control_handlers:
+            await self._control_handlers[type(message)](ws, message)
+        else:
+            _LOGGER.warning("ignoring unsupported control message %s", message)
+
+    async def _send_to(
+            self,
+            recipients: List[WebSocket],
+            message: Any,
+            timeout: Optional[float],
+            *,
+            topic: Optional[str] = None,
+            forward: bool = False) -> int:
+        # Unfiltered broadcasts and publishes also reach sessions whose client is away
+        detached = forward and any(session.away for session in self._sessions.values())
+        channel = self._channel if forward else None
+        if not recipients and channel is None and not detached:
+            return 0
+
+        start = time.perf_counter()
+        envelope = WebSocket.make_envelope(message, next(self._message_ids))
+        chunks = split_attachments(envelope, self._attachment_ids, self._attachment_chunk_size)
+        compress = getattr(message, PYWSP_COMPRESS, None)
+        if detached:
+            self._buffer_detached(envelope, chunks, topic)
+        if channel is not None:
+            await channel.forward(envelope, chunks, topic=topic, compress=compress, timeout=timeout)
+        return await self._send_envelope(recipients, envelope, chunks, compress, timeout, start)
+
+    async def deliver_forwarded(
+            self,
+            envelope: Dict[str, Any],
+            chunks: List[bytes],
+            *,
+            topic: Optional[str],
+            compress: Optional[bool],
+            timeout: Optional[float]) -> int:
+        """Send an envelope forwarded by another worker to our own clients."""
+        if topic is None:
+            recipients = [ws for ws in self._clients if ws.connected()]
+        else:
+            recipients = [ws for ws in self._subscribers.get(topic, ()) if ws.connected()]
+        # Ids are only unique per worker, so restamp it with one of ours
+        envelope[MESSAGE_ID] = next(self._message_ids)
+        if self._sessions:
+            self._buffer_detached(envelope, chunks, topic)
+        return await self._send_envelope(recipients, envelope, chunks, compress, timeout, time.perf_counter())
+
+    async def _send_envelope(
+            self,
+            recipients: List[WebSocket],
+            envelope: Dict[str, Any],
+            chunks: List[bytes],
+            compress: Optional[bool],
+            timeout: Optional[float],
+            start: float) -> int:
+        if not recipients:
+            return 0
+
+        # One frame per codec and compact layout in use among the recipients
+        frames: Dict[Tuple[Codec, Any], Union[str, bytes, List[Union[str, bytes]]]] = { }
+        message_type = envelope[MESSAGE_TYPE]
+        sends = []
+        for ws in recipients:
+            layout = None if chunks else ws.compact_layout(message_type)
+            frame = frames.get((ws.codec, layout))
+            if frame is None:
+                wire = envelope if layout is None else compact_envelope(envelope, layout) or envelope
+                frame = ws.codec.encode(wire)
+                # Attachment chunks are codec independent and shared by everyone
+                frame = frames[ws.codec, layout] = [frame, *chunks] if chunks else frame
+            # Shared frames are always full, so later deltas on ws need a new base
+            ws.reset_deltas(message_type)
+            sends.append(asyncio.wait_for(
+                ws.send_frame(frame, compress=compress, message_id=envelope[MESSAGE_ID]), timeout))
+        if self._metrics is not None:
+            self._metrics.encode_seconds.observe(time.perf_counter() - start, envelope[MESSAGE_TYPE])
+
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        delivered = 0
+        for ws, result in zip(recipients, results):
+            if isinstance(result, asyncio.TimeoutError):
+                _LOGGER.warning("timed out broadcasting to %s", ws.peer_info)
+            elif isinstance(result, BaseException):
+                _LOGGER.warning("error broadcasting to %s: %s", ws.peer_info, result)
+            else:
+                delivered += 1
+        if self._metrics is not None:
+            self._metrics.messages_sent.inc(envelope[MESSAGE_TYPE], amount=delivered)
+        return delivered
+
+    def _buffer_detached(self, envelope: Dict[str, Any], chunks: List[bytes], topic: Optional[str]) -> None:
+        """Keep a broadcast (topic None) or publish for the sessions whose client is away."""
+        frames: Dict[Codec, Union[str, bytes, List[Union[str, bytes]]]] = { }
+        for session in self._sessions.values():
+            if not session.away:
+                continue
+            # Until the connection is detached, its subscriptions are the current ones
+            topics = session.topics if session.ws is None else self._topics.get(session.ws, ())
+            if topic is not None and topic not in topics:
+                continue
+            frame = frames.get(session.codec)
+            if frame is None:
+                # Never compact: the client may come back to a server with other layouts
+                frame = session.codec.encode(envelope)
+                frame = frames[session.codec] = [frame, *chunks] if chunks else frame
+            session.replay.append(envelope[MESSAGE_ID], frame)
+
+    def _find_session(self, request: Request, codec: Codec) -> Tuple[Session, Optional[int]]:
+        """The session a connection belongs to, and the last id its client received.
+
+        The id is None when there's no session to resume, in which case the
+        session is a new one.
+        """
+        session = self._sessions.get(request.headers.get(SESSION_HEADER, ""))
+        last_id = request.headers.get(LAST_ID_HEADER, "")
+        if session is not None and last_id.isdigit() and type(session.codec) is type(codec):
+            return session, int(last_id)
+        if session is not None:
+            _LOGGER.info("session %s can't be resumed, starting a new one", session.id)
+            self._end_session(session)
+        assert self._session_buffer_size is not None
+        session = Session(uuid.uuid4().hex, self._session_buffer_size, codec)
+        self._sessions[session.id] = session
+        return session, None
+
+    async def _join_session(self, ws: WebSocket, session: Session, last_id: Optional[int]) -> None:
+        """Attach ws to its session, first replaying what its client missed."""
+        previous = session.ws
+        if previous is not None:
+            # The client noticed the connection dropped before we did
+            self._detach_session(previous)
+            await previous.close(flush=False)
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+
+        try:
+            replay = session.replay.since(last_id) if last_id is not None else None
+            resumed = replay is not None
+            await ws.send_message(WebSocketSessionMessage(session.id, resumed), message_id=0)
+            # Messages for the session are still buffered while we replay, so
+            # keep going until we've caught up
+            while replay:
+                for _, frame in replay:
+                    await ws.send_frame(frame)
+                replay = session.replay.since(replay[-1][0])
+        except:
+            # Lost this connection too; the session waits for the next one
+            self._schedule_expiry(session)
+            raise
+        _LOGGER.debug("session %s attached (resumed: %s)", session.id, resumed)
+        # No await from here until the socket is in self._clients, so nothing
+        # sent in the meantime can miss both the socket and the buffer
+        session.ws = ws
+        self.subscribe(ws, *session.topics)
+
+    def _detach_session(self, ws: WebSocket) -> None:
+        session = self._sessions.get(ws.session_id) if ws.session_id is not None else None
+        if session is None or session.ws is not ws:
+            return
+        session.ws = None
+        session.topics = set(self._topics.get(ws, ()))
+        self._schedule_expiry(session)
+
+    def _schedule_expiry(self, session: Session) -> None:
+        session.expiry = asyncio.get_running_loop().call_later(self._session_timeout, self._end_session, session)
+
+    def _end_session(self, session: Session) -> None:
+        if session.expiry is not None:
+            session.expiry.cancel()
+        if self._sessions.get(session.id) is session:
+            del self._sessions[session.id]
+
     async def handle_binary(self, data: bytes) -> None:
         _LOGGER.debug("received binary payload")
         _LOGGER.debug(data)
@@ -41,13 +423,24 @@ class WebSocketServer:
         assert self._callback is not None
 
         client_info = self.get_peer_info(request)
+        if self._max_connections is not None and len(self._clients) + self._handshakes >= self._max_connections:
+            # Refuse before upgrading: no WebSocket state gets allocated
+            _LOGGER.warning("refusing connection from %s:%d (%d connections open)",
+                client_info[0], client_info[1], len(self._clients))
+            if self._metrics is not None:
+                self._metrics.connections_refused.inc()
+            return web.Response(status=503, text="too many connections")
         _LOGGER.info(f"connection from %s:%d", client_info[0], client_info[1])
 
-        wsr = web.WebSocketResponse()
-        await wsr.prepare(request)
-        ws = WebSocket(self._factory, wsr=wsr, peer_info=client_info)
+        self._handshakes += 1
+        try:
+            ws, wsr = await self._accept(request, client_info)
+        finally:
+            self._handshakes -= 1
 
-        self.clients.append(ws)
+        self._clients[ws] = None
+        if self._metrics is not None:
+            self._metrics.active_connections.inc()
         self._callback.on_new_connection(ws)
 
         try:
@@ -57,22 +450,89 @@ class WebSocketServer:
             await ws.close()
         finally:
             await self._callback.on_closing(ws)
-            self.clients.remove(ws)
+            self._detach_session(ws)
+            self.unsubscribe(ws)
+            del self._clients[ws]
+            if self._metrics is not None:
+                self._metrics.active_connections.dec()
+            # Stops the socket's writer task, if it has one
+            await ws.close(flush=False)
 
         _LOGGER.info("connection closed")
 
         return wsr
 
-    async def start_listening(self, address: str, port: int, url: str) -> None:
+    async def _accept(self, request: Request, client_info: Tuple[str, int]) -> Tuple[WebSocket, web.WebSocketResponse]:
+        """Upgrade the connection and set up its WebSocket."""
+        wsr = web.WebSocketResponse(
+            protocols=[codec.subprotocol for codec in self._codecs],
+            compress=self._compress,
+            max_msg_size=self._max_msg_size,
+            heartbeat=self._heartbeat)
+        await wsr.prepare(request)
+        codec = select_codec(self._codecs, wsr.ws_protocol)
+        # Clients predating capability negotiation don't send the header
+        capabilities_header = request.headers.get(CAPABILITIES_HEADER)
+        peer_capabilities = [c.strip() for c in capabilities_header.split(",")] if capabilities_header else []
+        _LOGGER.debug("using codec %s (subprotocol: %s)", type(codec).__name__, wsr.ws_protocol)
+        session, last_id = None, None
+        if self._session_buffer_size is not None and CAPABILITY_RESUME in peer_capabilities:
+            session, last_id = self._find_session(request, codec)
+        ws = WebSocket(
+            self._factory,
+            wsr=wsr,
+            peer_info=client_info,
+            max_concurrency=self._max_concurrency,
+            ordering_key=self._ordering_key,
+            codecs=[codec],
+            message_ids=self._message_ids,
+            control_handler=self._handle_control_message,
+            batch_window=self._batch_window,
+            batch_max_bytes=self._batch_max_bytes,
+            peer_capabilities=peer_capabilities,
+            send_queue_size=self._send_queue_size,
+            overflow_policy=self._overflow_policy,
+            compress_min_size=self._compress_min_size,
+            metrics=self._metrics,
+            attachment_chunk_size=self._attachment_chunk_size,
+            attachment_stream_threshold=self._attachment_stream_threshold,
+            max_attachment_size=self._max_attachment_size,
+            max_pending_attachment_size=self._max_pending_attachment_size,
+            compact_envelopes=self._compact_envelopes,
+            rate_limit=self._rate_limit,
+            type_rate_limits=self._type_rate_limits,
+            in_flight_limit=self._in_flight_limit,
+            idle_timeout=self._idle_timeout,
+            session_id=session.id if session is not None else None,
+            replay_buffer=session.replay if session is not None else None)
+
+        if capabilities_header is not None:
+            await ws.send_capabilities()
+            if self._compact_envelopes and CAPABILITY_COMPACT in peer_capabilities:
+                await ws.send_registry()
+        if session is not None:
+            await self._join_session(ws, session, last_id)
+        return ws, wsr
+
+    async def metrics_handler(self, request: Request) -> StreamResponse:
+        assert self._metrics is not None
+        return web.Response(
+            body=self._metrics.render().encode(),
+            headers={ "Content-Type": PROMETHEUS_CONTENT_TYPE })
+
+    async def start_listening(self, address: str, port: int, url: str, *, reuse_port: bool = False) -> None:
         if self._callback is None:
             _LOGGER.error("No callback defined, canceling websocket")
             raise RuntimeError("Starting websocket without setting a callback")
 
         app = web.Application()
         app.router.add_get(url, self.websocket_handler)
+        if self._metrics is not None and self._metrics_path is not None:
+            app.router.add_get(self._metrics_path, self.metrics_handler)
 
         runner = web.AppRunner(app)
         await runner.setup()
-        self._site = web.TCPSite(runner, address, port)
+        # reuse_port lets several worker processes listen on the same port
+        self._site = web.TCPSite(runner, address, port, reuse_port=reuse_port or None)
         await self._site.start()
         _LOGGER.info("serving on %s:%d", address, port)
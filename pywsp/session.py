@@ -0,0 +1,102 @@
+"""Automatic reconnects and resumable sessions.
+
+A client socket given a ReconnectPolicy reconnects on its own when its
+connection drops, waiting between attempts for an exponentially growing delay
+with full jitter, so clients dropped together (e.g. by a server restart)
+don't all come back at the same moment.
+
+Servers with a session buffer give such clients a session and keep the last
+messages sent in it, keyed by their @id. A client that reconnects within the
+session timeout presents its session and the last @id it received; the server
+replays whatever came after that before sending anything new. Sessions live in
+the server's memory, so after a restart (or if the client was away long
+enough for the buffer to wrap around) the session isn't resumed and the
+client is told so.
+"""
+import random
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Deque, Iterator, List, Optional, Set, Tuple, Union
+
+if TYPE_CHECKING:
+    import asyncio
+    from .codec import Codec
+    from .socket import WebSocket
+
+DEFAULT_SESSION_TIMEOUT = 60.0
+
+Frame = Union[str, bytes]
+
+
+@dataclass(frozen=True)
+class ReconnectPolicy:
+    """How a client socket reconnects after losing its connection.
+
+    The n-th attempt waits a random time between 0 and
+    min(max_delay, initial_delay * multiplier ** n) seconds. After
+    max_attempts failed attempts (None to keep trying) the socket gives up
+    and closes.
+    """
+    initial_delay: float = 0.5
+    max_delay: float = 30.0
+    multiplier: float = 2.0
+    max_attempts: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if self.initial_delay <= 0 or self.max_delay < self.initial_delay:
+            raise ValueError("delays must be positive, with max_delay at least initial_delay")
+        if self.multiplier < 1:
+            raise ValueError("multiplier must be at least 1")
+        if self.max_attempts is not None and self.max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+
+    def delays(self) -> Iterator[float]:
+        ceiling = self.initial_delay
+        attempt = 0
+        while self.max_attempts is None or attempt < self.max_attempts:
+            yield random.uniform(0, ceiling)
+            ceiling = min(self.max_delay, ceiling * self.multiplier)
+            attempt += 1
+
+
+class ReplayBuffer:
+    """The last frames sent in a session, with the @id of their message."""
+    def __init__(self, size: int) -> None:
+        if size < 1:
+            raise ValueError("session buffer size must be at least 1")
+        self._frames: Deque[Tuple[int, Union[Frame, List[Frame]]]] = deque(maxlen=size)
+        # Highest id pushed out of the buffer so far
+        self._evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def append(self, message_id: int, frame: Union[Frame, List[Frame]]) -> None:
+        if len(self._frames) == self._frames.maxlen:
+            self._evicted = max(self._evicted, self._frames[0][0])
+        self._frames.append((message_id, frame))
+
+    def since(self, last_id: int) -> Optional[List[Tuple[int, Union[Frame, List[Frame]]]]]:
+        """The frames sent after message last_id, or None if some are gone already."""
+        if last_id < self._evicted:
+            return None
+        return [(message_id, frame) for message_id, frame in self._frames if message_id > last_id]
+
+
+class Session:
+    """Server side state of a client session, kept while the client is away."""
+    def __init__(self, session_id: str, buffer_size: int, codec: "Codec") -> None:
+        self.id = session_id
+        self.replay = ReplayBuffer(buffer_size)
+        # Frames in the buffer are encoded with this
+        self.codec = codec
+        # The connection the session is attached to, None while detached
+        self.ws: Optional["WebSocket"] = None
+        # Topics to subscribe the client to again when it comes back
+        self.topics: Set[str] = set()
+        self.expiry: Optional["asyncio.TimerHandle"] = None
+
+    @property
+    def away(self) -> bool:
+        """Whether the client is away (or its connection is going down)."""
+        return self.ws is None or not self.ws.connected()
@@ -1,18 +1,60 @@
 from aiohttp import web, ClientSession, ClientWebSocketResponse, WSMessage, WSMsgType
 import asyncio
-from dataclasses import asdict, is_dataclass
-import json
+import itertools
 import logging
-from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+import time
+from typing import (
+    Any, Awaitable, Callable, Dict, Hashable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set,
+    Tuple, Union
+)
 
+from .admission import InFlightLimit, RateLimit, TokenBucket
+from .attachment import (
+    DEFAULT_ATTACHMENT_CHUNK_SIZE, DEFAULT_MAX_ATTACHMENT_SIZE, DEFAULT_MAX_PENDING_ATTACHMENT_SIZE,
+    AttachmentStream, IncomingAttachment, PendingMessage, is_attachment_chunk, parse_chunk, split_attachments
+)
 from .callback import WebSocketMessageCallback
+from .codec import DEFAULT_CODEC, Codec, select_codec
 from .const import *
-from .exceptions import WebSocketInvalidMessage
+from .delta import DeltaDecoder, DeltaEncoder
+from .exceptions import (
+    WebSocketConnectionClosed, WebSocketInvalidMessage, WebSocketSendQueueFull, WebSocketUnsupportedMessageType
+)
 from .factory import MessageFactory
-from .message import deserialize_message
+from .metrics import Metrics
+from .session import ReconnectPolicy, ReplayBuffer
+from .message import (
+    RawData, WebSocketCapabilitiesMessage, WebSocketErrorMessage, WebSocketRegistryMessage, WebSocketSubscribeMessage,
+    WebSocketUnsubscribeMessage, compact_envelope, deserialize_message, is_control_message, message_to_dict
+)
 
 _LOGGER = logging.getLogger(__name__)
 
+# Optional protocol features this version understands when receiving
+SUPPORTED_CAPABILITIES = (CAPABILITY_BATCH,)
+
+DEFAULT_BATCH_MAX_BYTES = 64 * 1024
+DEFAULT_MAX_MSG_SIZE = 4 * 1024 * 1024
+# Smaller frames are decoded in one go: splitting off their header first
+# costs more than it could save
+HEADER_SPLIT_MIN_SIZE = 16 * 1024
+# How long close() waits for queued frames to go out
+CLOSE_FLUSH_TIMEOUT = 5.0
+
+# Window size requested when a client asks for permessage-deflate
+_DEFLATE_WBITS = 15
+
+# Handled by the socket itself on the fully decoded payload
+_SOCKET_MESSAGE_TYPES = (MESSAGE_TYPE_BATCH, MESSAGE_TYPE_CAPABILITIES, MESSAGE_TYPE_REGISTRY, MESSAGE_TYPE_SESSION)
+
+_OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT)
+
+Frame = Union[str, bytes]
+
+
+def _frame_size(frame: Union[Frame, List[Frame]]) -> int:
+    return sum(map(len, frame)) if isinstance(frame, list) else len(frame)
+
 class PeerInfo(NamedTuple):
     ip: str
     port: int
@@ -24,21 +66,218 @@ class WebSocket:
         *,
         wsr: Optional[Union[ClientWebSocketResponse, web.WebSocketResponse]] = None,
         peer_info: Optional[Tuple[str, int]] = None,
-        session: Optional[ClientSession] = None) -> None:
+        session: Optional[ClientSession] = None,
+        max_concurrency: Optional[int] = None,
+        ordering_key: Optional[Callable[[Any], Optional[Hashable]]] = None,
+        codecs: Optional[Sequence[Codec]] = None,
+        message_ids: Optional[Iterator[int]] = None,
+        control_handler: Optional[Callable[["WebSocket", Any], Awaitable[None]]] = None,
+        batch_window: Optional[float] = None,
+        batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+        peer_capabilities: Optional[Iterable[str]] = None,
+        send_queue_size: Optional[int] = None,
+        overflow_policy: str = OVERFLOW_BLOCK,
+        compress: bool = False,
+        compress_min_size: Optional[int] = None,
+        max_msg_size: int = DEFAULT_MAX_MSG_SIZE,
+        heartbeat: Optional[float] = None,
+        metrics: Optional[Metrics] = None,
+        attachment_chunk_size: int = DEFAULT_ATTACHMENT_CHUNK_SIZE,
+        attachment_stream_threshold: Optional[int] = None,
+        max_attachment_size: int = DEFAULT_MAX_ATTACHMENT_SIZE,
+        max_pending_attachment_size: int = DEFAULT_MAX_PENDING_ATTACHMENT_SIZE,
+        compact_envelopes: bool = False,
+        rate_limit: Optional[RateLimit] = None,
+        type_rate_limits: Optional[Dict[str, RateLimit]] = None,
+        in_flight_limit: Optional[InFlightLimit] = None,
+        idle_timeout: Optional[float] = None,
+        reconnect: Optional[ReconnectPolicy] = None,
+        session_id: Optional[str] = None,
+        replay_buffer: Optional[ReplayBuffer] = None) -> None:
 
         self._callback: Optional[WebSocketMessageCallback] = None
         self._handle_message_task: Optional[asyncio.Task[None]] = None
-        self._msg_id = 1
+        # Ids only need to be unique per socket. WebSocketServer hands all of its
+        # sockets a shared counter so a broadcast can use one id (and one
+        # encoded frame) for every recipient.
+        self._message_ids = message_ids or itertools.count(1)
+        # Receives pyWSP control messages instead of the registered callback
+        self._control_handler = control_handler
 
         self._factory = factory
         self._wsr = wsr
         self._peer_info = PeerInfo(peer_info[0], peer_info[1]) if peer_info else None
         self._session = session
+        # Only close sessions we created; shared ones belong to the caller
+        self._owns_session = False
+        # Codecs offered (in order of preference) when connecting. Server sockets
+        # get the codec already negotiated by WebSocketServer.
+        self._codecs = list(codecs) if codecs else [DEFAULT_CODEC]
+        self._codec = self._codecs[0]
+        self._negotiate_codec = bool(codecs)
+
+        # Concurrent dispatch (opt-in). When max_concurrency is set, each incoming
+        # message is handled in its own task, with at most max_concurrency handlers
+        # in flight. Messages for which ordering_key returns the same (non-None)
+        # key are still handled one at a time, in arrival order.
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self._max_concurrency = max_concurrency
+        self._ordering_key = ordering_key
+        self._dispatch_tasks: Set["asyncio.Task[None]"] = set()
+        self._ordering_tails: Dict[Hashable, "asyncio.Task[None]"] = { }
+
+        # Outbound batching (opt-in). Frames sent within batch_window seconds of
+        # each other (up to batch_max_bytes) go out as one batch frame, but only
+        # once the peer has said it can unpack them.
+        self._peer_capabilities: Set[str] = set(peer_capabilities or ())
+        self._batch_window = batch_window
+        self._batch_max_bytes = batch_max_bytes
+        self._batch: List[Union[str, bytes]] = []
+        self._batch_bytes = 0
+        self._batch_compress: Optional[bool] = None
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: Set["asyncio.Task[None]"] = set()
+        self._write_lock = asyncio.Lock()
+
+        # Bounded send queue (opt-in). Senders only enqueue; a writer task owned by
+        # the socket does the actual writes, so a slow peer can't hold up whoever
+        # is sending. overflow_policy decides what happens once the queue is full.
+        if send_queue_size is not None and send_queue_size < 1:
+            raise ValueError("send_queue_size must be at least 1")
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy '{overflow_policy}'")
+        self._send_queue: Optional["asyncio.Queue[Tuple[Union[Frame, List[Frame]], Optional[bool], Optional[str]]]"] = (
+            asyncio.Queue(send_queue_size) if send_queue_size is not None else None)
+        self._overflow_policy = overflow_policy
+        self._writer_task: Optional["asyncio.Task[None]"] = None
+        self._close_task: Optional["asyncio.Task[None]"] = None
+        self.dropped_messages = 0
+        # Size of the frames waiting in the send queue
+        self._queued_bytes = 0
+
+        # Connection settings. compress asks for permessage-deflate when
+        # connecting (server sockets get whatever WebSocketServer negotiated).
+        # Frames under compress_min_size bytes skip deflate, unless their
+        # message type says otherwise through @message(compress=...).
+        self._compress = compress
+        self._compress_min_size = compress_min_size
+        self._max_msg_size = max_msg_size
+        self._heartbeat = heartbeat
+        self._compress_wbits = 0
+        self._per_frame_compression = False
+        if wsr is not None:
+            self._setup_compression()
+
+        self._metrics = metrics
+
+        # Binary attachments. Outgoing ones are cut into attachment_chunk_size
+        # frames. Incoming ones are buffered until complete, unless they're at
+        # least attachment_stream_threshold bytes: those are handed to the
+        # callback right away as an AttachmentStream. Buffered ones still
+        # incomplete, plus whatever streams hold that hasn't been read yet,
+        # can't add up to more than max_pending_attachment_size.
+        if attachment_chunk_size < 1:
+            raise ValueError("attachment_chunk_size must be at least 1")
+        self._attachment_ids = itertools.count(1)
+        self._attachment_chunk_size = attachment_chunk_size
+        self._attachment_stream_threshold = attachment_stream_threshold
+        self._max_attachment_size = max_attachment_size
+        self._max_pending_attachment_size = max_pending_attachment_size
+        self._pending_attachment_size = 0
+        self._incoming_attachments: Dict[int, Union[IncomingAttachment, AttachmentStream]] = { }
+        # Streams with chunks their reader hasn't taken yet (or still arriving)
+        self._attachment_streams: Set[AttachmentStream] = set()
+
+        # Compact envelopes (opt-in, both peers). Each side announces its
+        # registry, i.e. an index and field order for every type it can
+        # receive; the other side then sends those types as positional arrays.
+        self._compact_envelopes = compact_envelopes
+        self._capabilities = SUPPORTED_CAPABILITIES + ((CAPABILITY_COMPACT,) if compact_envelopes else ())
+        # What the peer announced: type -> (index, field names)
+        self._peer_layouts: Optional[Dict[str, Tuple[int, Tuple[str, ...]]]] = None
+        # Registry version last announced, None until the first announcement
+        self._announced_version: Optional[int] = None
+
+        # Admission control (opt-in) for incoming application messages:
+        # token buckets for the connection as a whole and per message type,
+        # and a cap on handlers in flight, usually shared by all of a server's
+        # sockets. Messages over a limit are answered with an error right away.
+        self._rate_limiter = TokenBucket(rate_limit) if rate_limit is not None else None
+        self._type_rate_limits = type_rate_limits or { }
+        self._type_rate_limiters: Dict[str, TokenBucket] = { }
+        self._in_flight_limit = in_flight_limit
+        self._admission_control = (
+            rate_limit is not None or bool(self._type_rate_limits) or in_flight_limit is not None)
+
+        # Connections without message traffic (either way) for idle_timeout
+        # seconds are closed. Pings don't count: heartbeat covers dead peers.
+        self._idle_timeout = idle_timeout
+        self._last_activity = time.monotonic()
+        self._idle_timer: Optional[asyncio.TimerHandle] = None
+
+        # Reconnects and session resumption. Client sockets with a reconnect
+        # policy reconnect to the last url they connected to when the
+        # connection drops (but not after close()), and resume their session
+        # from the last message id they received. Server sockets record what
+        # they send in their session's replay buffer.
+        self._reconnect = reconnect
+        self._url: Optional[str] = None
+        self._closing = False
+        self._reconnecting = False
+        self._session_id = session_id
+        self._last_received_id = 0
+        self._replay_buffer = replay_buffer
+        if reconnect is not None or replay_buffer is not None:
+            self._capabilities += (CAPABILITY_RESUME,)
+
+        # What was last sent and received of each @message(delta=True) type
+        self._delta_encoder = DeltaEncoder()
+        self._delta_decoder = DeltaDecoder()
+        # So rejections (ours or the peer's) can always be decoded
+        factory.register_message_types(WebSocketErrorMessage)
 
     @property
     def peer_info(self) -> Optional[PeerInfo]:
         return self._peer_info
 
+    @property
+    def codec(self) -> Codec:
+        return self._codec
+
+    @property
+    def peer_capabilities(self) -> Set[str]:
+        return self._peer_capabilities
+
+    @property
+    def send_queue_depth(self) -> int:
+        return self._send_queue.qsize() if self._send_queue is not None else 0
+
+    @property
+    def buffered_bytes(self) -> int:
+        """Bytes this connection holds in memory: queued and batched frames, partial attachments."""
+        incoming = sum(
+            attachment.buffered for attachment in self._incoming_attachments.values()
+            if isinstance(attachment, IncomingAttachment))
+        return self._queued_bytes + self._batch_bytes + incoming + self._streamed_bytes()
+
+    def _streamed_bytes(self) -> int:
+        """Bytes streamed attachments hold that their readers haven't taken yet."""
+        done = [stream for stream in self._attachment_streams if stream.finished and not stream.buffered]
+        self._attachment_streams.difference_update(done)
+        return sum(stream.buffered for stream in self._attachment_streams)
+
+    @property
+    def session_id(self) -> Optional[str]:
+        """Id of the resumable session this connection belongs to, if any."""
+        return self._session_id
+
+    @property
+    def reconnecting(self) -> bool:
+        """Whether the connection dropped and the socket is trying to get it back."""
+        task = self._handle_message_task
+        return self._reconnect is not None and task is not None and not task.done() and not self.connected()
+
     def connected(self) -> bool:
         return self._wsr and not self._wsr.closed
 
@@ -52,20 +291,32 @@ class WebSocket:
         self._callback = callback
         self.try_start_handle_message_task()
 
-    async def close(self) -> None:
+    async def close(self, *, flush: bool = True) -> None:
+        self._closing = True
+        if flush and self.connected():
+            try:
+                await asyncio.wait_for(self.flush(), CLOSE_FLUSH_TIMEOUT)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("dropping %d queued messages on close (ws: %s)", self.send_queue_depth, self)
+        if self._writer_task:
+            self._writer_task.cancel()
         if self._handle_message_task:
             self._handle_message_task.cancel()
         if self._wsr:
             await self._wsr.close()
-        if self._session:
+        if self._session and self._owns_session:
             await self._session.close()
 
-    async def send_message(self, message: Any) -> None:
-        if self._wsr is None:
-            raise RuntimeError("invalid state (is the socket connected?)")
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
 
-        # print("message json: ", json.dumps(message, indent=2, default=lambda x: asdict(x) if is_dataclass(x) else x))
-        # print(dir(message))
+    @staticmethod
+    def make_envelope(
+            message: Any,
+            message_id: int,
+            *,
+            reply_to: Optional[int] = None,
+            credit: Optional[int] = None) -> Dict[str, Any]:
         if getattr(message, MESSAGE_ID, None):
             _LOGGER.error("invalid message received (missing 'id'). Discarding...")
             raise WebSocketInvalidMessage("missing required field 'id'")
@@ -73,17 +324,302 @@ class WebSocket:
             _LOGGER.error("invalid message received (missing 'type'). Discarding...")
             raise WebSocketInvalidMessage("missing required field 'type'")
 
-        message._pywsp_message_id = self._msg_id
-        self._msg_id += 1
+        message._pywsp_message_id = message_id
         envelope = {
             "@id": message._pywsp_message_id,
             "@type": message._pywsp_message_type,
-            "data": message
         }
-        message_text = json.dumps(envelope, default=lambda x: asdict(x) if is_dataclass(x) else x)
-        # print(f"envelope: {envelope}")
-        # print("json: ", message_text)
-        await self._wsr.send_str(message_text)
+        if reply_to is not None:
+            envelope[MESSAGE_REPLY_TO] = reply_to
+        if credit is not None:
+            envelope[MESSAGE_CREDIT] = credit
+        # Always last, so receivers can route on the header before decoding it
+        envelope["data"] = message_to_dict(message)
+        return envelope
+
+    async def send_message(
+            self,
+            message: Any,
+            *,
+            message_id: Optional[int] = None,
+            reply_to: Optional[int] = None,
+            credit: Optional[int] = None) -> int:
+        if self._wsr is None:
+            raise RuntimeError("invalid state (is the socket connected?)")
+
+        if message_id is None:
+            message_id = self.next_message_id()
+        if self._announced_version is not None and self._announced_version != self._factory.version:
+            # New types were registered since we last told the peer
+            await self.send_registry()
+        metrics = self._metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        envelope = self.make_envelope(message, message_id, reply_to=reply_to, credit=credit)
+        delta = getattr(message, PYWSP_DELTA, None)
+        if delta is not None:
+            self._delta_encoder.encode(envelope, delta)
+        chunks = split_attachments(envelope, self._attachment_ids, self._attachment_chunk_size)
+        frame = self._codec.encode(self._wire_envelope(envelope))
+        if metrics is not None:
+            message_type = message._pywsp_message_type
+            metrics.encode_seconds.observe(time.perf_counter() - start, message_type)
+            metrics.messages_sent.inc(message_type)
+        await self.send_frame(
+            [frame, *chunks] if chunks else frame,
+            compress=getattr(message, PYWSP_COMPRESS, None),
+            message_id=message_id,
+            delta_type=envelope[MESSAGE_TYPE] if delta is not None else None)
+        return message_id
+
+    async def send_encoded(
+            self,
+            message_type: str,
+            data: Frame,
+            *,
+            reply_to: Optional[int] = None,
+            compress: Optional[bool] = None) -> int:
+        """Send a message whose data section is already encoded with this socket's codec.
+
+        Lets one encoding of a message go to several sockets that need
+        different envelopes (e.g. replies to different requests). The data
+        can't hold binary fields, which have to go out as attachments.
+        """
+        if self._wsr is None:
+            raise RuntimeError("invalid state (is the socket connected?)")
+
+        message_id = self.next_message_id()
+        header = { MESSAGE_ID: message_id, MESSAGE_TYPE: message_type }
+        if reply_to is not None:
+            header[MESSAGE_REPLY_TO] = reply_to
+        frame = self._codec.splice(header, data)
+        # Sent in full, without us keeping track of it
+        self.reset_deltas(message_type)
+        if self._metrics is not None:
+            self._metrics.messages_sent.inc(message_type)
+        await self.send_frame(frame, compress=compress, message_id=message_id)
+        return message_id
+
+    async def send_frame(
+            self,
+            frame: Union[Frame, List[Frame]],
+            *,
+            compress: Optional[bool] = None,
+            message_id: Optional[int] = None,
+            delta_type: Optional[str] = None) -> None:
+        """Send a payload already encoded with this socket's codec.
+
+        A list of frames (a message followed by its attachment chunks) is
+        queued, and dropped, as a unit. message_id is the @id of the message
+        in it, which sockets keeping a replay buffer record it under.
+        delta_type is the message type of a delta encoded payload: if the
+        payload gets dropped, the next message of that type goes out in full.
+        """
+        if self._wsr is None:
+            raise RuntimeError("invalid state (is the socket connected?)")
+
+        if self._idle_timeout is not None:
+            # Every outgoing message goes through here, broadcasts included
+            self._last_activity = time.monotonic()
+        if message_id and self._replay_buffer is not None:
+            # Recorded even if the send fails: that's what the buffer is for
+            self._replay_buffer.append(message_id, frame)
+        if self._send_queue is not None:
+            await self._queue_frame(frame, compress, delta_type)
+        else:
+            await self._transmit_frame(frame, compress)
+
+    async def _transmit_frame(self, frame: Union[Frame, List[Frame]], compress: Optional[bool] = None) -> None:
+        if isinstance(frame, list):
+            for member in frame:
+                await self._transmit_frame(member, compress)
+            return
+        if self._batch_window is not None and CAPABILITY_BATCH in self._peer_capabilities:
+            if not is_attachment_chunk(frame):
+                self._enqueue_frame(frame, compress)
+                return
+            # Chunks can't go in a batch. Cut the pending one and wait for it,
+            # and for the batches cut before it, so the chunks follow their
+            # message (flush tasks may not have taken the write lock yet).
+            self._start_flush()
+            if self._flush_tasks:
+                await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+            async with self._write_lock:
+                await self._write_frame(frame, compress)
+            return
+        await self._write_frame(frame, compress)
+
+    async def _queue_frame(
+            self,
+            frame: Union[Frame, List[Frame]],
+            compress: Optional[bool],
+            delta_type: Optional[str]) -> None:
+        assert self._send_queue is not None
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._run_writer(), name="WebSocket_writer")
+
+        queue = self._send_queue
+        if not queue.full() or self._overflow_policy == OVERFLOW_BLOCK:
+            await queue.put((frame, compress, delta_type))
+            self._queued_bytes += _frame_size(frame)
+            return
+
+        if self._overflow_policy == OVERFLOW_DISCONNECT:
+            _LOGGER.warning("send queue full, disconnecting slow peer %s", self.peer_info)
+            self._close_task = asyncio.create_task(self.close(flush=False))
+            raise WebSocketSendQueueFull(f"send queue full ({queue.qsize()} messages)")
+
+        self.dropped_messages += 1
+        if self._overflow_policy == OVERFLOW_DROP_OLDEST:
+            dropped, _, dropped_type = queue.get_nowait()
+            queue.task_done()
+            queue.put_nowait((frame, compress, delta_type))
+            self._queued_bytes += _frame_size(frame) - _frame_size(dropped)
+        else:
+            dropped_type = delta_type
+        if dropped_type is not None:
+            # The encoder has moved on to the dropped message; the peer never sees it
+            self.reset_deltas(dropped_type)
+
+    async def _run_writer(self) -> None:
+        assert self._send_queue is not None
+        queue = self._send_queue
+        while True:
+            frame, compress, delta_type = await queue.get()
+            try:
+                await self._transmit_frame(frame, compress)
+            except Exception as e:
+                _LOGGER.error("error sending message: %s (ws: %s)", e, self)
+                if delta_type is not None:
+                    self.reset_deltas(delta_type)
+            finally:
+                self._queued_bytes -= _frame_size(frame)
+                queue.task_done()
+
+    async def _write_frame(self, frame: Frame, compress: Optional[bool] = None) -> None:
+        assert self._wsr is not None
+        level = self._compression_level(frame, compress)
+        if self._metrics is not None:
+            self._metrics.bytes_sent.inc(amount=len(frame))
+        if isinstance(frame, str):
+            await self._wsr.send_str(frame, compress=level)
+        else:
+            await self._wsr.send_bytes(frame, compress=level)
+
+    def _setup_compression(self) -> None:
+        assert self._wsr is not None
+        self._compress_wbits = int(self._wsr.compress or 0)
+        writer = getattr(self._wsr, "_writer", None)
+        if self._compress_wbits and writer is not None and hasattr(writer, "compress"):
+            # aiohttp can only force compression per frame, not skip it, so turn
+            # its default off and opt in frame by frame in _write_frame().
+            writer.compress = 0
+            self._per_frame_compression = True
+
+    def _compression_level(self, frame: Union[str, bytes], compress: Optional[bool]) -> Optional[int]:
+        if not self._per_frame_compression:
+            return None
+        if compress is None:
+            compress = len(frame) >= (self._compress_min_size or 0)
+        return self._compress_wbits if compress else None
+
+    def _enqueue_frame(self, frame: Union[str, bytes], compress: Optional[bool] = None) -> None:
+        self._batch.append(frame)
+        self._batch_bytes += len(frame)
+        if compress:
+            # One member asking for compression is enough for the whole batch
+            self._batch_compress = True
+        if self._batch_bytes >= self._batch_max_bytes:
+            self._start_flush()
+        elif self._batch_timer is None:
+            assert self._batch_window is not None
+            self._batch_timer = asyncio.get_running_loop().call_later(self._batch_window, self._start_flush)
+
+    def _start_flush(self) -> None:
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        if not self._batch:
+            return
+
+        frames, self._batch, self._batch_bytes = self._batch, [], 0
+        compress, self._batch_compress = self._batch_compress, None
+
+        async def write_batch() -> None:
+            frame = frames[0] if len(frames) == 1 else self._codec.join(frames)
+            # The lock is fair, so batches go out in the order they were cut
+            async with self._write_lock:
+                await self._write_frame(frame, compress)
+
+        def on_done(task: "asyncio.Task[None]") -> None:
+            self._flush_tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                _LOGGER.error("error sending batch of %d messages: %s (ws: %s)", len(frames), task.exception(), self)
+
+        task = asyncio.create_task(write_batch(), name="WebSocket_flush")
+        self._flush_tasks.add(task)
+        task.add_done_callback(on_done)
+
+    async def flush(self) -> None:
+        """Send any queued or batched frames now and wait until they're written."""
+        if self._send_queue is not None and self._writer_task is not None:
+            await self._send_queue.join()
+        self._start_flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    def reset_deltas(self, message_type: Optional[str] = None) -> None:
+        """Send the next message of message_type (or of every type) in full, not as a delta."""
+        self._delta_encoder.reset(message_type)
+
+    async def send_capabilities(self) -> None:
+        # Like batch frames, this sits outside the message id sequence
+        await self.send_message(WebSocketCapabilitiesMessage(list(self._capabilities)), message_id=0)
+
+    async def send_registry(self) -> None:
+        """Announce our message types so the peer can send them compactly."""
+        self._announced_version = self._factory.version
+        await self.send_message(WebSocketRegistryMessage(self._factory.layouts()), message_id=0)
+
+    def compact_layout(self, message_type: str) -> Optional[Tuple[int, Tuple[str, ...]]]:
+        """The peer's (index, field names) for message_type, if it takes it compact."""
+        if self._peer_layouts is None:
+            return None
+        return self._peer_layouts.get(message_type)
+
+    def _wire_envelope(self, envelope: Dict[str, Any]) -> Any:
+        layout = self.compact_layout(envelope[MESSAGE_TYPE])
+        if layout is None:
+            return envelope
+        return compact_envelope(envelope, layout) or envelope
+
+    def _expand_compact(self, payload: List[Any], size: Optional[int] = None) -> Dict[str, Any]:
+        """Turn a compact envelope back into a regular one (data stays a list).
+
+        size is the length of the frame it came in, checked against the
+        type's max_size.
+        """
+        if len(payload) < 3:
+            raise WebSocketInvalidMessage("truncated compact envelope")
+        message_type = self._factory.type_at(payload[0]) if isinstance(payload[0], int) else None
+        if message_type is None:
+            raise WebSocketInvalidMessage(f"unknown compact type index {payload[0]!r}")
+        max_size = getattr(self._factory.get_message_class(message_type), PYWSP_MAX_SIZE, None)
+        if size is not None and max_size is not None and size > max_size:
+            self._count_rejected(message_type, "too_large")
+            raise WebSocketInvalidMessage(
+                f"'{message_type}' message of {size} bytes exceeds its limit of {max_size}")
+        envelope = { MESSAGE_ID: payload[1], MESSAGE_TYPE: message_type, "data": payload[2] }
+        if len(payload) > 3:
+            envelope[MESSAGE_REPLY_TO] = payload[3]
+        return envelope
+
+    async def subscribe(self, *topics: str) -> None:
+        """Ask the server to start sending messages published to topics."""
+        await self.send_message(WebSocketSubscribeMessage(list(topics)))
+
+    async def unsubscribe(self, *topics: str) -> None:
+        await self.send_message(WebSocketUnsubscribeMessage(list(topics)))
 
     async def receive_message(self) -> Any:
         if self._wsr is None:
@@ -99,12 +635,17 @@ class WebSocket:
 
         async def handle_websocket_messages() -> None:
             try:
-                await self._handle_messages()
-            except Exception as e:
-                _LOGGER.error("closing websocket due to error handling message: %s (ws: %s)", e, self)
-                await self.close()
+                while True:
+                    try:
+                        await self._handle_messages()
+                    except Exception as e:
+                        _LOGGER.error("closing websocket due to error handling message: %s (ws: %s)", e, self)
+                        await self.close()
+                    if not await self._try_reconnect():
+                        break
             finally:
-                pass
+                if self._callback is not None:
+                    await self._callback.on_closing(self)
 
             _LOGGER.info("connection closed")
 
@@ -114,17 +655,341 @@ class WebSocket:
 
     async def _handle_messages(self) -> None:
         assert self._wsr is not None
-        async for msg in self._wsr:
-            _LOGGER.debug("new message %s", msg.__repr__())
+        semaphore = None
+        if self._max_concurrency is not None:
+            semaphore = asyncio.Semaphore(self._max_concurrency)
+        if self._idle_timeout is not None:
+            self._last_activity = time.monotonic()
+            self._idle_timer = asyncio.get_running_loop().call_later(self._idle_timeout, self._check_idle)
+
+        try:
+            async for msg in self._wsr:
+                _LOGGER.debug("new message %s", msg.__repr__())
+                if self._idle_timeout is not None:
+                    self._last_activity = time.monotonic()
+
+                if msg.type == WSMsgType.BINARY and is_attachment_chunk(msg.data):
+                    if self._metrics is not None:
+                        self._metrics.bytes_received.inc(amount=len(msg.data))
+                    pending = self._receive_chunk(msg.data)
+                    if pending is None:
+                        continue
+                    if self._reconnect is not None:
+                        self._received(pending.payload)
+                    if await self._admit(pending.payload):
+                        await self._dispatch(pending.payload, semaphore, background=pending.streaming)
+                    continue
+
+                if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    if self._metrics is not None:
+                        self._metrics.bytes_received.inc(amount=len(msg.data))
+                    payload = self._decode_frame(msg.data)
+                    if payload is None:
+                        continue
+                else:
+                    if msg.type == WSMsgType.ERROR:
+                        _LOGGER.error("error %s", self._wsr.exception())
+                    continue
+
+                for payload in self._unpack_payload(payload):
+                    if payload.__class__ is list:
+                        # Compact envelope inside a batch
+                        payload = self._expand_compact(payload)
+                    elif await self._handle_protocol_message(payload):
+                        continue
+
+                    if isinstance(payload, dict) and MESSAGE_ATTACHMENTS in payload:
+                        pending = self._expect_attachments(payload)
+                        if pending.remaining:
+                            # Dispatched (or refused) once the last chunk is in
+                            continue
+                        if self._reconnect is not None:
+                            self._received(payload)
+                        if await self._admit(payload):
+                            await self._dispatch(payload, semaphore, background=pending.streaming)
+                    else:
+                        if self._reconnect is not None:
+                            self._received(payload)
+                        if await self._admit(payload):
+                            await self._dispatch(payload, semaphore)
+        except asyncio.CancelledError:
+            for task in self._dispatch_tasks:
+                task.cancel()
+            raise
+        finally:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            # Handlers still reading a stream would wait forever otherwise
+            for incoming in self._incoming_attachments.values():
+                if isinstance(incoming, AttachmentStream):
+                    incoming.abort(WebSocketConnectionClosed("connection closed while receiving attachment"))
+            self._incoming_attachments.clear()
+            self._attachment_streams.clear()
+            self._pending_attachment_size = 0
+            if self._dispatch_tasks:
+                await asyncio.gather(*self._dispatch_tasks, return_exceptions=True)
+
+    def _received(self, payload: Any) -> None:
+        # A message counts as received once it's complete, attachments included
+        message_id = payload.get(MESSAGE_ID) if isinstance(payload, dict) else None
+        if isinstance(message_id, int) and message_id > self._last_received_id:
+            self._last_received_id = message_id
+
+    def _check_idle(self) -> None:
+        assert self._idle_timeout is not None
+        remaining = self._last_activity + self._idle_timeout - time.monotonic()
+        if remaining > 0:
+            # There was traffic since the timer was set; check again later
+            self._idle_timer = asyncio.get_running_loop().call_later(remaining, self._check_idle)
+            return
+        self._idle_timer = None
+        _LOGGER.info("closing connection idle for %.1fs (ws: %s)", self._idle_timeout, self)
+        if self._metrics is not None:
+            self._metrics.idle_closes.inc()
+        self._close_task = asyncio.create_task(self.close(flush=False))
+
+    async def _admit(self, payload: Dict[str, Any]) -> bool:
+        """Apply admission control to an incoming message; refuse it if over a limit.
+
+        Admitted messages hold a slot of the in-flight limit (if any) until
+        their handler is done.
+        """
+        if not self._admission_control:
+            return True
+        message_type = payload.get(MESSAGE_TYPE) if isinstance(payload, dict) else None
+        if not isinstance(message_type, str) or message_type.startswith(CONTROL_MESSAGE_PREFIX):
+            # Control messages (flow control, subscriptions) are always let in
+            return True
+
+        retry_after = self._rate_limiter.take() if self._rate_limiter is not None else 0.0
+        if not retry_after:
+            limit = self._type_rate_limits.get(message_type)
+            if limit is not None:
+                bucket = self._type_rate_limiters.get(message_type)
+                if bucket is None:
+                    bucket = self._type_rate_limiters[message_type] = TokenBucket(limit)
+                retry_after = bucket.take()
+        if retry_after:
+            await self._refuse(payload, "rate_limited", ERROR_RATE_LIMITED, retry_after)
+            return False
+
+        in_flight = self._in_flight_limit
+        if in_flight is not None and not in_flight.try_acquire():
+            await self._refuse(payload, "overloaded", ERROR_OVERLOADED, in_flight.retry_after)
+            return False
+        return True
+
+    async def _refuse(self, payload: Dict[str, Any], reason: str, error_code: int, retry_after: float) -> None:
+        message_type = payload[MESSAGE_TYPE]
+        _LOGGER.debug("refusing '%s' message (%s, ws: %s)", message_type, reason, self)
+        self._count_rejected(message_type, reason)
+        error = WebSocketErrorMessage(error_code, f"{reason.replace('_', ' ')}, retry later", retry_after)
+        await self.send_message(error, reply_to=payload.get(MESSAGE_ID))
+
+    def _release_admission(self) -> None:
+        if self._in_flight_limit is not None:
+            self._in_flight_limit.release()
+
+    async def _dispatch(
+            self,
+            payload: Dict[str, Any],
+            semaphore: Optional[asyncio.Semaphore],
+            *,
+            background: bool = False) -> None:
+        # Called for admitted messages only; the in-flight slot is released
+        # when the handler is done (or never runs)
+        if semaphore is None:
+            if background:
+                # The handler reads a stream fed by this loop, so it can't run inline
+                self._dispatch_concurrently(payload, None)
+                return
+            try:
+                await self._dispatch_callback(payload)
+            finally:
+                self._release_admission()
+            return
+
+        # Stop reading from the socket while we're at capacity
+        try:
+            await semaphore.acquire()
+        except:
+            self._release_admission()
+            raise
+        try:
+            self._dispatch_concurrently(payload, semaphore)
+        except:
+            semaphore.release()
+            raise
+
+    def _expect_attachments(self, payload: Dict[str, Any]) -> PendingMessage:
+        """Set up reception of the attachments announced by payload."""
+        pending = PendingMessage(payload)
+        data = payload["data"]
+        for field, attachment in payload.pop(MESSAGE_ATTACHMENTS).items():
+            attachment_id, size = attachment["id"], attachment["size"]
+            if size > self._max_attachment_size:
+                raise WebSocketInvalidMessage(
+                    f"attachment of {size} bytes exceeds the limit of {self._max_attachment_size}")
+            if attachment_id in self._incoming_attachments:
+                raise WebSocketInvalidMessage(f"duplicate attachment id {attachment_id}")
+            threshold = self._attachment_stream_threshold
+            if threshold is not None and size >= threshold:
+                stream = AttachmentStream(size)
+                data[field] = stream
+                pending.streaming = True
+                self._incoming_attachments[attachment_id] = stream
+                self._attachment_streams.add(stream)
+            else:
+                if self._pending_attachment_size + self._streamed_bytes() + size > self._max_pending_attachment_size:
+                    raise WebSocketInvalidMessage(
+                        f"attachments being received exceed the limit of {self._max_pending_attachment_size} bytes")
+                self._pending_attachment_size += size
+                pending.remaining += 1
+                self._incoming_attachments[attachment_id] = IncomingAttachment(pending, field, size)
+        return pending
 
-            if msg.type == WSMsgType.TEXT:
-                await self._dispatch_callback(msg.json())
-            elif msg.type == WSMsgType.BINARY:
-                await self._dispatch_callback(msg.data)
-            elif msg.type == WSMsgType.ERROR:
-                _LOGGER.error("error %s", self._wsr.exception())
+    def _receive_chunk(self, frame: bytes) -> Optional[PendingMessage]:
+        """Take in an attachment chunk; return its message if that was the last one missing."""
+        attachment_id, final, chunk = parse_chunk(frame)
+        incoming = self._incoming_attachments.get(attachment_id)
+        if incoming is None:
+            raise WebSocketInvalidMessage(f"chunk for unknown attachment {attachment_id}")
+
+        if isinstance(incoming, AttachmentStream):
+            if self._pending_attachment_size + self._streamed_bytes() + len(chunk) > self._max_pending_attachment_size:
+                raise WebSocketInvalidMessage(
+                    f"attachments being received exceed the limit of {self._max_pending_attachment_size} bytes "
+                    "(streams not read fast enough)")
+            incoming.feed(chunk)
+            if final:
+                del self._incoming_attachments[attachment_id]
+                incoming.close()
+            return None
+
+        value = incoming.feed(chunk, final)
+        if value is None:
+            return None
+        del self._incoming_attachments[attachment_id]
+        self._pending_attachment_size -= incoming.size
+        pending = incoming.message
+        pending.payload["data"][incoming.field] = value
+        pending.remaining -= 1
+        return pending if pending.remaining == 0 else None
+
+    @staticmethod
+    def _unpack_payload(payload: Any) -> Sequence[Any]:
+        if isinstance(payload, dict) and payload.get(MESSAGE_TYPE) == MESSAGE_TYPE_BATCH:
+            return payload["data"]["messages"]
+        return (payload,)
+
+    def _decode_frame(self, frame: Union[str, bytes]) -> Any:
+        """Decode a frame, checking its header before paying for its data.
+
+        Frames of unknown types, or bigger than their type's max_size, are
+        rejected; big frames (and frames for raw types) without decoding their
+        data. Returns None for frames nobody would look at.
+        """
+        size = len(frame)
+        split = None
+        if size >= HEADER_SPLIT_MIN_SIZE or self._factory.has_raw_types:
+            split = self._codec.decode_header(frame)
+        if split is None:
+            payload = self._codec.decode(frame)
+            if payload.__class__ is list:
+                return self._expand_compact(payload, size)
+            if payload.__class__ is dict and self._is_checked(payload) and self._has_receiver():
+                self._check_frame(payload[MESSAGE_TYPE], size)
+            return payload
+        header, data = split
+        if not self._is_checked(header):
+            # Batches, capabilities and malformed envelopes take the full path
+            return self._codec.decode(frame)
+
+        if not self._has_receiver():
+            return None
+        cls = self._check_frame(header[MESSAGE_TYPE], size)
+        if getattr(cls, PYWSP_RAW, False):
+            header["data"] = RawData(data, self._codec.decode_data)
+            return header
+        try:
+            header["data"] = self._codec.decode_data(data)
+        except ValueError:
+            # Not data-last (so not from pyWSP); decode it the long way
+            return self._codec.decode(frame)
+        return header
+
+    def _has_receiver(self) -> bool:
+        return self._callback is not None or self._control_handler is not None
+
+    @staticmethod
+    def _is_checked(header: Dict[str, Any]) -> bool:
+        """Whether an envelope is a regular message, checked against its type."""
+        message_type = header.get(MESSAGE_TYPE)
+        return MESSAGE_ID in header and isinstance(message_type, str) and message_type not in _SOCKET_MESSAGE_TYPES
+
+    def _check_frame(self, message_type: str, size: int) -> type:
+        """The class of message_type; raises if it's unknown or size is over its max_size."""
+        cls = self._factory.get_message_class(message_type)
+        if cls is None:
+            self._count_rejected(message_type, "unsupported")
+            raise WebSocketUnsupportedMessageType(message_type)
+        max_size = getattr(cls, PYWSP_MAX_SIZE, None)
+        if max_size is not None and size > max_size:
+            self._count_rejected(message_type, "too_large")
+            raise WebSocketInvalidMessage(
+                f"'{message_type}' message of {size} bytes exceeds its limit of {max_size}")
+        return cls
+
+    def _count_rejected(self, message_type: str, reason: str) -> None:
+        if self._metrics is not None:
+            self._metrics.messages_rejected.inc(message_type, reason)
+
+    async def _handle_protocol_message(self, payload: Any) -> bool:
+        """Handle control messages meant for the socket itself."""
+        if not isinstance(payload, dict):
+            return False
+        message_type = payload.get(MESSAGE_TYPE)
+        if message_type == MESSAGE_TYPE_CAPABILITIES:
+            self._peer_capabilities = set(payload["data"]["capabilities"])
+            _LOGGER.debug("peer capabilities: %s (ws: %s)", self._peer_capabilities, self)
+            if self._compact_envelopes and CAPABILITY_COMPACT in self._peer_capabilities:
+                await self.send_registry()
+            if self._reconnecting and CAPABILITY_RESUME not in self._peer_capabilities:
+                # No sessions on this server, so nothing to resume
+                await self._reconnected(False)
+            return True
+        if message_type == MESSAGE_TYPE_SESSION:
+            data = payload["data"]
+            self._session_id = data["session"]
+            if not data["resumed"]:
+                # Ids in a new session (maybe from a restarted server) start over
+                self._last_received_id = 0
+            _LOGGER.debug("session %s (resumed: %s, ws: %s)", self._session_id, data["resumed"], self)
+            if self._reconnecting:
+                await self._reconnected(data["resumed"])
+            return True
+        if message_type == MESSAGE_TYPE_REGISTRY:
+            self._peer_layouts = {
+                name: (index, tuple(names))
+                for index, (name, names) in enumerate(payload["data"]["types"])
+                if names is not None
+            }
+            _LOGGER.debug("peer registry: %d message types (ws: %s)", len(self._peer_layouts), self)
+            return True
+        return False
+
+    async def _reconnected(self, resumed: bool) -> None:
+        self._reconnecting = False
+        if self._callback is not None:
+            await self._callback.on_reconnected(self, resumed)
 
     async def _dispatch_callback(self, payload: Dict[str, Any]) -> None:
+        message = self._decode_payload(payload)
+        if message is not None:
+            await self._invoke_callback(message)
+
+    def _decode_payload(self, payload: Dict[str, Any]) -> Any:
         if MESSAGE_ID not in payload:
             _LOGGER.error("invalid message received (missing 'id'). Discarding...")
             raise WebSocketInvalidMessage("missing required field 'id'")
@@ -132,9 +997,79 @@ class WebSocket:
             _LOGGER.error("invalid message received (missing 'type'). Discarding...")
             raise WebSocketInvalidMessage("missing required field 'type'")
 
-        if self._callback:
-            message = deserialize_message(payload, self._factory)
-            await self._callback.on_new_message(self, message)
+        if not self._has_receiver():
+            return None
+
+        metrics = self._metrics
+        if metrics is None:
+            return deserialize_message(payload, self._factory, self._delta_decoder)
+
+        start = time.perf_counter()
+        message = deserialize_message(payload, self._factory, self._delta_decoder)
+        message_type = payload[MESSAGE_TYPE]
+        if message is None:
+            self._count_rejected(message_type, "stale_delta")
+            return None
+        metrics.decode_seconds.observe(time.perf_counter() - start, message_type)
+        metrics.messages_received.inc(message_type)
+        return message
+
+    async def _invoke_callback(self, message: Any) -> None:
+        metrics = self._metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        try:
+            if self._control_handler is not None and is_control_message(message):
+                await self._control_handler(self, message)
+            elif self._callback is not None:
+                await self._callback.on_new_message(self, message)
+        except Exception:
+            if metrics is not None:
+                metrics.handler_errors.inc(getattr(message, MESSAGE_TYPE))
+            raise
+        finally:
+            if metrics is not None:
+                metrics.handler_seconds.observe(time.perf_counter() - start, getattr(message, MESSAGE_TYPE))
+
+    def _dispatch_concurrently(self, payload: Dict[str, Any], semaphore: Optional[asyncio.Semaphore]) -> None:
+        # Decoding stays inline so malformed input is still fatal to the connection
+        try:
+            message = self._decode_payload(payload)
+        except:
+            self._release_admission()
+            raise
+        if message is None:
+            if semaphore is not None:
+                semaphore.release()
+            self._release_admission()
+            return
+
+        key = self._ordering_key(message) if self._ordering_key else None
+        previous = self._ordering_tails.get(key) if key is not None else None
+
+        async def run() -> None:
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                await self._invoke_callback(message)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+                self._release_admission()
+
+        task = asyncio.create_task(run(), name="WebSocket_dispatch")
+        self._dispatch_tasks.add(task)
+        if key is not None:
+            self._ordering_tails[key] = task
+
+        def on_done(task: "asyncio.Task[None]") -> None:
+            self._dispatch_tasks.discard(task)
+            if key is not None and self._ordering_tails.get(key) is task:
+                del self._ordering_tails[key]
+            if not task.cancelled() and task.exception() is not None:
+                _LOGGER.error("error handling message %s: %s (ws: %s)", message, task.exception(), self)
+
+        task.add_done_callback(on_done)
 
     @staticmethod
     def _get_peer_info(wsr: ClientWebSocketResponse) -> Tuple[str, int]:
@@ -145,17 +1080,65 @@ class WebSocket:
             client_ip, client_port = peername
         return client_ip, client_port
 
+    async def _try_reconnect(self) -> bool:
+        """Reconnect after the connection dropped, if there's a policy for it.
+
+        Returns whether we're connected again.
+        """
+        if self._reconnect is None or self._closing or self._url is None:
+            return False
+        for attempt, delay in enumerate(self._reconnect.delays(), 1):
+            _LOGGER.info("connection lost, reconnecting in %.2fs (attempt %d, ws: %s)", delay, attempt, self)
+            await asyncio.sleep(delay)
+            if self._closing:
+                return False
+            if await self._open(self._url):
+                # The callback hears about it once we know if the session was resumed
+                self._reconnecting = True
+                return True
+        _LOGGER.warning("giving up reconnecting to %s", self._url)
+        return False
+
     async def connect(self, url: str) -> None:
+        self._url = url
+        self._closing = False
+        if await self._open(url):
+            self.try_start_handle_message_task()
+
+    async def _open(self, url: str) -> bool:
         if self._session is None:
             self._session = ClientSession()
+            self._owns_session = True
 
         ws = None
         try:
-            wsr = await self._session.ws_connect(url)
-            _LOGGER.info("connected to %s", url)
+            # Only negotiate when codecs were given, so servers predating
+            # subprotocol support see the same handshake as before.
+            protocols = [codec.subprotocol for codec in self._codecs] if self._negotiate_codec else []
+            headers = { CAPABILITIES_HEADER: ",".join(self._capabilities) }
+            if self._session_id is not None and self._reconnect is not None:
+                headers[SESSION_HEADER] = self._session_id
+                headers[LAST_ID_HEADER] = str(self._last_received_id)
+            wsr = await self._session.ws_connect(
+                url,
+                protocols=protocols,
+                headers=headers,
+                compress=_DEFLATE_WBITS if self._compress else 0,
+                max_msg_size=self._max_msg_size,
+                heartbeat=self._heartbeat)
+            _LOGGER.info("connected to %s (subprotocol: %s)", url, wsr.protocol)
             self._wsr = wsr
+            self._codec = select_codec(self._codecs, wsr.protocol)
+            self._setup_compression()
             self._peer_info = PeerInfo(*self._get_peer_info(wsr))
-            self.try_start_handle_message_task()
+            # Whatever we knew about the previous connection's peer is stale
+            self._peer_capabilities = set()
+            self._peer_layouts = None
+            self._announced_version = None
+            # The peer's new socket has no deltas to build on
+            self._delta_encoder.reset()
+            return True
         except:
             if ws is not None:
                 await ws.close()
+            return False
@@ -0,0 +1,259 @@
+"""Run a WebSocketServer in several processes sharing one port.
+
+Each worker is a forked process with its own event loop that listens on the
+same address with SO_REUSEPORT, so the kernel spreads new connections across
+them. Workers are connected to each other over Unix sockets: a broadcast or
+publish on one worker is forwarded to the others, which deliver it to their
+own clients.
+"""
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import time
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from .api import WebSocketApiServer
+from .message import json_default
+from .server import WebSocketServer
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SHUTDOWN_TIMEOUT = 10.0
+# Don't respawn a worker slot more often than this (seconds), so a worker that
+# crashes on startup doesn't turn into a fork loop
+RESPAWN_INTERVAL = 1.0
+# A peer that doesn't take a forwarded record within this long (seconds) is
+# dropped, so one stalled worker can't hold up forwarding to the others
+FORWARD_TIMEOUT = 5.0
+
+_FRAME_HEADER = struct.Struct("!I")
+
+Server = Union[WebSocketServer, WebSocketApiServer]
+ServerSetup = Callable[[], Awaitable[Server]]
+
+
+class WorkerChannel:
+    """Unix socket mesh between the workers of a WorkerPool.
+
+    Every worker listens on its own socket in a shared directory and opens a
+    connection to each peer the first time it forwards something. Records are
+    length-prefixed JSON. Delivery is best effort: a peer that is down (e.g.
+    being respawned) misses what was forwarded in the meantime.
+    """
+    def __init__(self, directory: str, index: int, workers: int, server: WebSocketServer) -> None:
+        self._directory = directory
+        self._index = index
+        self._workers = workers
+        self._server = server
+        self._unix_server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[int, asyncio.StreamWriter] = { }
+        # Connections from peers and the tasks reading them
+        self._inbound: Dict[asyncio.StreamWriter, "asyncio.Task[None]"] = { }
+        self._peer_locks = [asyncio.Lock() for _ in range(workers)]
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self._directory, f"worker-{index}.sock")
+
+    async def start(self) -> None:
+        path = self._path(self._index)
+        if os.path.exists(path):
+            # Left behind by the worker we're replacing
+            os.unlink(path)
+        self._unix_server = await asyncio.start_unix_server(self._handle_peer, path)
+
+    async def close(self) -> None:
+        if self._unix_server is not None:
+            self._unix_server.close()
+            await self._unix_server.wait_closed()
+        for writer in self._peers.values():
+            writer.close()
+        self._peers.clear()
+        # Closing the connections ends the readers with EOF
+        readers = list(self._inbound.values())
+        for writer in list(self._inbound):
+            writer.close()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+    async def forward(
+            self,
+            envelope: Dict[str, Any],
+            chunks: List[bytes],
+            *,
+            topic: Optional[str],
+            compress: Optional[bool],
+            timeout: Optional[float]) -> None:
+        """Hand an outgoing broadcast (topic None) or publish to every other worker."""
+        record = {
+            "envelope": envelope,
+            "chunks": [base64.b64encode(chunk).decode() for chunk in chunks],
+            "topic": topic,
+            "compress": compress,
+            "timeout": timeout,
+        }
+        data = json.dumps(record, default=json_default).encode()
+        frame = _FRAME_HEADER.pack(len(data)) + data
+        await asyncio.gather(*[
+            self._send(index, frame) for index in range(self._workers) if index != self._index
+        ])
+
+    async def _send(self, index: int, frame: bytes) -> None:
+        async with self._peer_locks[index]:
+            writer = self._peers.get(index)
+            try:
+                if writer is None or writer.is_closing():
+                    _, writer = await asyncio.open_unix_connection(self._path(index))
+                    self._peers[index] = writer
+                writer.write(frame)
+                await asyncio.wait_for(writer.drain(), FORWARD_TIMEOUT)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("worker %d not reading, dropping its connection", index)
+                self._drop_peer(index)
+            except OSError as e:
+                _LOGGER.debug("worker %d unreachable: %s", index, e)
+                self._drop_peer(index)
+
+    def _drop_peer(self, index: int) -> None:
+        writer = self._peers.pop(index, None)
+        if writer is not None:
+            writer.close()
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._inbound[writer] = task
+        try:
+            while True:
+                header = await reader.readexactly(_FRAME_HEADER.size)
+                data = await reader.readexactly(_FRAME_HEADER.unpack(header)[0])
+                record = json.loads(data)
+                await self._server.deliver_forwarded(
+                    record["envelope"],
+                    [base64.b64decode(chunk) for chunk in record["chunks"]],
+                    topic=record["topic"],
+                    compress=record["compress"],
+                    timeout=record["timeout"])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._inbound[writer]
+            writer.close()
+
+
+class WorkerPool:
+    """Supervise `workers` processes, each running the server built by setup.
+
+    setup is a coroutine function called in every worker; it must build the
+    server, start it with reuse_port=True and return it. The supervisor
+    restarts workers that die and, on SIGTERM or SIGINT, asks all of them to
+    shut down gracefully (stop accepting, close open connections) before
+    killing the ones still running after shutdown_timeout seconds.
+
+    Workers are forked, so this only works where fork() is available.
+    """
+    def __init__(
+            self,
+            setup: ServerSetup,
+            *,
+            workers: Optional[int] = None,
+            shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT) -> None:
+        self._setup = setup
+        self._workers = workers or os.cpu_count() or 1
+        self._shutdown_timeout = shutdown_timeout
+        self._context = multiprocessing.get_context("fork")
+        self._processes: List[Optional[BaseProcess]] = [None] * self._workers
+        self._started_at = [0.0] * self._workers
+        self._stopping = False
+        self._directory = ""
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def stop(self) -> None:
+        """Ask run() to shut the workers down and return."""
+        self._stopping = True
+
+    def run(self) -> None:
+        """Start the workers and supervise them until stop() or a signal."""
+        self._directory = tempfile.mkdtemp(prefix="pywsp-")
+        previous = {
+            sig: signal.signal(sig, lambda *_: self.stop())
+            for sig in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            while not self._stopping:
+                for index, process in enumerate(self._processes):
+                    if process is not None and process.is_alive():
+                        continue
+                    if process is not None:
+                        _LOGGER.warning("worker %d exited with %s", index, process.exitcode)
+                        self._processes[index] = None
+                    if time.monotonic() - self._started_at[index] >= RESPAWN_INTERVAL:
+                        self._spawn(index)
+                sentinels = [p.sentinel for p in self._processes if p is not None and p.is_alive()]
+                wait(sentinels, timeout=RESPAWN_INTERVAL)
+        finally:
+            self._shutdown()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self._setup, index, self._workers, self._directory),
+            name=f"pywsp-worker-{index}",
+            daemon=True)
+        process.start()
+        _LOGGER.info("started worker %d (pid %d)", index, process.pid)
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def _shutdown(self) -> None:
+        running = [p for p in self._processes if p is not None and p.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self._shutdown_timeout
+        for process in running:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                _LOGGER.warning("killing worker %s (pid %d) after shutdown timeout", process.name, process.pid)
+                process.kill()
+                process.join()
+        self._processes = [None] * self._workers
+
+
+def _worker_main(setup: ServerSetup, index: int, workers: int, directory: str) -> None:
+    # The supervisor's handlers were inherited; the worker's event loop installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    asyncio.run(_run_worker(setup, index, workers, directory))
+
+
+async def _run_worker(setup: ServerSetup, index: int, workers: int, directory: str) -> None:
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    app = await setup()
+    server = app.server if isinstance(app, WebSocketApiServer) else app
+    channel = WorkerChannel(directory, index, workers, server)
+    await channel.start()
+    server.attach_channel(channel)
+    _LOGGER.info("worker %d ready (pid %d)", index, os.getpid())
+
+    await stopping.wait()
+    _LOGGER.info("worker %d shutting down", index)
+    # An ApiServer also shuts down its executors
+    await app.shutdown()
+    await channel.close()
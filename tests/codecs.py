@@ -0,0 +1,14 @@
+from pywsp import JsonCodec, MsgpackCodec, OrjsonCodec
+from typing import Any, List
+
+
+def available_codecs() -> List[Any]:
+    """The codec classes whose optional dependencies are installed."""
+    codecs: List[Any] = [JsonCodec]
+    for module, codec in [("orjson", OrjsonCodec), ("msgpack", MsgpackCodec)]:
+        try:
+            __import__(module)
+            codecs.append(codec)
+        except ImportError:
+            pass
+    return codecs
@@ -1,9 +1,12 @@
 import asyncio
 import logging
+import os
 import pytest
+import threading
 
 from pywsp import *
 from pywsp import debug
+from pywsp.exceptions import WebSocketConnectionClosed
 from typing import Any, List
 
 WS_HOST = "127.0.0.1"
@@ -45,13 +48,45 @@ class Server(WebSocketConnectionCallback, WebSocketMessageCallback):
 
 
 class SimpleApiClient(WebSocketApiClient):
-    def __init__(self, url):
-        super().__init__(url)
+    def __init__(self, url, **kwargs):
+        super().__init__(url, **kwargs)
 
     async def ping(self, request):
         return await self.api_call(PingMessage, PongMessage, request)
 
 
+@message(type="count")
+class CountMessage:
+    limit: int
+
+@message(type="count_item")
+class CountItemMessage:
+    value: int
+
+
+class StreamingApiClient(WebSocketApiClient):
+    def count(self, limit, **kwargs):
+        return self.api_stream(CountMessage, CountItemMessage, limit, **kwargs)
+
+
+class StreamingApiServer(WebSocketApiServer):
+    def __init__(self):
+        super().__init__(WS_HOST, WS_PORT, WS_URL)
+        self.produced = 0
+        self.closed = asyncio.Event()
+
+    @api(input=CountMessage, output=CountItemMessage)
+    async def count(self, limit):
+        try:
+            for value in range(abs(limit)):
+                self.produced += 1
+                yield value
+            if limit < 0:
+                raise ValueError("negative limit")
+        finally:
+            self.closed.set()
+
+
 class SimpleApiServer(WebSocketApiServer):
     def __init__(self):
         # method_map = {
@@ -64,6 +99,101 @@ class SimpleApiServer(WebSocketApiServer):
         return "received: " + request
 
 
+class CachingApiServer(WebSocketApiServer):
+    def __init__(self, **kwargs):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, **kwargs)
+        self.calls = 0
+
+    @api(input=PingMessage, output=PongMessage, cache=CachePolicy(max_size=2, ttl=0.5))
+    async def ping(self, request):
+        self.calls += 1
+        return f"received: {request} ({self.calls})"
+
+
+class CoalescingApiServer(WebSocketApiServer):
+    def __init__(self):
+        super().__init__(WS_HOST, WS_PORT, WS_URL)
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    @api(input=PingMessage, output=PongMessage, coalesce=True)
+    async def ping(self, request):
+        self.calls += 1
+        await self.release.wait()
+        if request == "fail":
+            raise ValueError("failed")
+        return f"received: {request} ({self.calls})"
+
+
+@message(type="report")
+class ReportMessage:
+    rows: List[int]
+
+@message(type="report_result")
+class ReportResultMessage:
+    result: Any
+
+
+class OffloadingApiServer(WebSocketApiServer):
+    def __init__(self):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, thread_pool_size=2, process_pool_size=1)
+        self.release = threading.Event()
+        self.ping_thread = None
+
+    @api(input=PingMessage, output=PongMessage, executor="thread")
+    def ping(self, request):
+        # Blocking call: only ties up a pool thread until the test releases it
+        self.ping_thread = threading.current_thread()
+        self.release.wait(5)
+        return "received: " + request
+
+    @staticmethod
+    @api(input=ReportMessage, output=ReportResultMessage, executor="process")
+    def report(rows):
+        return { "total": sum(rows), "pid": os.getpid() }
+
+
+class OffloadingApiClient(SimpleApiClient):
+    async def report(self, rows):
+        return await self.api_call(ReportMessage, ReportResultMessage, rows)
+
+
+@message(type="notice")
+class NoticeMessage:
+    text: str
+
+
+class DelayingApiServer(WebSocketApiServer):
+    def __init__(self, **kwargs):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, **kwargs)
+
+    @api(input=PingMessage, output=PongMessage)
+    async def ping(self, request):
+        # Later requests are answered first
+        await asyncio.sleep(0.5 - int(request) * 0.01)
+        return "received: " + request
+
+
+class NoticeCollector(WebSocketMessageCallback):
+    def __init__(self):
+        self.notices = []
+
+    async def on_new_message(self, ws, message):
+        self.notices.append(message)
+
+
+class LimitedApiServer(WebSocketApiServer):
+    def __init__(self, **kwargs):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, **kwargs)
+        self.release = asyncio.Event()
+        self.release.set()
+
+    @api(input=PingMessage, output=PongMessage)
+    async def ping(self, request):
+        await self.release.wait()
+        return "received: " + request
+
+
 class TestApis:
     @pytest.mark.asyncio
     async def test_simple_api(self):
@@ -105,3 +235,256 @@ class TestApis:
         await api.close()
         await server.close()
         await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_concurrent_api_calls(self):
+        server = DelayingApiServer(max_concurrency=50)
+        await server.start()
+
+        factory = MessageFactory()
+        factory.register_message_types(NoticeMessage)
+        api = SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", message_factory=factory)
+        collector = NoticeCollector()
+        api.register_callback(collector)
+
+        requests = [str(i) for i in range(50)]
+        calls = asyncio.gather(*[api.ping(request) for request in requests])
+        await asyncio.sleep(0.1)
+        # Pushed while the calls are in flight: must not be taken for a response
+        assert await server.broadcast(NoticeMessage("hello")) == 1
+        pongs = await calls
+        for request, pong in zip(requests, pongs):
+            assert pong.response == "received: " + request
+        # Responses came back out of order
+        assert [getattr(pong, "@id") for pong in pongs] != sorted(getattr(pong, "@id") for pong in pongs)
+        assert [notice.text for notice in collector.notices] == ["hello"]
+        assert api.in_flight == 0
+        await api.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_pooled_api_calls(self):
+        server = SimpleApiServer()
+        await server.start()
+
+        api = SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", pool_size=4)
+        requests = [f"request {i}" for i in range(100)]
+        pongs = await asyncio.gather(*[api.ping(request) for request in requests])
+        for request, pong in zip(requests, pongs):
+            assert pong.response == "received: " + request
+
+        sockets = [ws for ws in api._sockets if ws is not None]
+        assert 1 < len(sockets) <= 4
+        assert len({id(ws._session) for ws in sockets}) == 1
+
+        # Dead sockets get replaced on demand
+        await sockets[0].close()
+        pongs = await asyncio.gather(*[api.ping(request) for request in requests[:8]])
+        assert [pong.response for pong in pongs] == ["received: " + r for r in requests[:8]]
+        assert api.in_flight == 0
+
+        await api.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_streaming_api(self):
+        server = StreamingApiServer()
+        await server.start()
+
+        api = StreamingApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        values = [item.value async for item in api.count(100, window=8)]
+        assert values == list(range(100))
+
+        # The generator never runs more than a window ahead of the consumer
+        server.produced = 0
+        server.closed.clear()
+        stream = api.count(100, window=4)
+        assert (await stream.__anext__()).value == 0
+        await asyncio.sleep(0.1)
+        assert server.produced <= 5
+
+        # Leaving early cancels the stream on the server
+        await stream.aclose()
+        await asyncio.wait_for(server.closed.wait(), 1)
+        assert server.produced < 100
+
+        with pytest.raises(WebSocketError):
+            async for _ in api.count(-3):
+                pass
+
+        await api.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_cached_api(self):
+        metrics = Metrics()
+        server = CachingApiServer(metrics=metrics)
+        await server.start()
+
+        api = SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        for _ in range(3):
+            assert (await api.ping("a")).response == "received: a (1)"
+        assert (await api.ping("b")).response == "received: b (2)"
+        cache = server.get_cache(PingMessage)
+        assert (cache.hits, cache.misses) == (2, 2)
+        assert metrics.api_cache_requests.get("ping", "hit") == 2
+
+        # Invalidation by key, then by type
+        server.invalidate_cache(PingMessage("a"))
+        assert (await api.ping("a")).response == "received: a (3)"
+        assert (await api.ping("b")).response == "received: b (2)"
+        server.invalidate_cache(PingMessage)
+        assert (await api.ping("b")).response == "received: b (4)"
+
+        # Least recently used entries go first, and entries expire
+        assert (await api.ping("c")).response == "received: c (5)"
+        assert (await api.ping("d")).response == "received: d (6)"
+        assert len(cache) == 2
+        assert (await api.ping("b")).response == "received: b (7)"
+        await asyncio.sleep(0.6)
+        assert (await api.ping("b")).response == "received: b (8)"
+
+        await api.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_coalesced_api(self):
+        server = CoalescingApiServer()
+        await server.start()
+
+        clients = [SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}") for _ in range(6)]
+        calls = [asyncio.create_task(client.ping("a")) for client in clients[:5]]
+        calls.append(asyncio.create_task(clients[5].ping("b")))
+        while server.calls < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        server.release.set()
+        responses = [pong.response for pong in await asyncio.gather(*calls)]
+        # Identical requests shared one call; a different one got its own
+        assert server.calls == 2
+        assert len(set(responses[:5])) == 1
+        assert responses[0].startswith("received: a")
+        assert responses[5].startswith("received: b")
+
+        # Once a call is over, the next request starts a new one
+        assert (await clients[1].ping("a")).response == "received: a (3)"
+
+        await asyncio.gather(*[client.close() for client in clients])
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_executor_api(self):
+        server = OffloadingApiServer()
+        await server.start()
+
+        slow = OffloadingApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        fast = OffloadingApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        # Connect first, so the concurrent calls below don't race the handshake
+        result = (await fast.report([1, 2, 3])).result
+        assert result["total"] == 6
+        assert result["pid"] != os.getpid()
+
+        ping = asyncio.create_task(slow.ping("hello"))
+        for _ in range(500):
+            if server.ping_thread is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert server.ping_thread is not threading.main_thread()
+        # The blocking handler is still running, yet other clients are served
+        assert (await fast.report(list(range(10)))).result["total"] == 45
+        assert not ping.done()
+        server.release.set()
+        assert (await ping).response == "received: hello"
+
+        with pytest.raises(TypeError):
+            class InvalidServer(WebSocketApiServer):
+                @api(input=ReportMessage, output=ReportResultMessage, executor="process")
+                def report(self, rows):
+                    return sum(rows)
+            InvalidServer(WS_HOST, WS_PORT, WS_URL)
+
+        await slow.close()
+        await fast.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_rate_limits(self):
+        server = LimitedApiServer(
+            rate_limit=RateLimit(rate=100, burst=5),
+            type_rate_limits={ "ping": RateLimit(rate=2, burst=2) })
+        await server.start()
+
+        api = SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await api.ping("1")
+        await api.ping("2")
+        with pytest.raises(WebSocketError) as info:
+            await api.ping("3")
+        assert info.value.error.error_code == 429
+        assert 0 < info.value.retry_after <= 0.5
+
+        # Refused requests don't cost the connection, which keeps working
+        await asyncio.sleep(info.value.retry_after)
+        assert (await api.ping("4")).response == "received: 4"
+
+        await api.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_in_flight_limit(self):
+        server = LimitedApiServer(max_in_flight=1)
+        await server.start()
+
+        first = SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        second = SimpleApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await first.ping("warm up")
+        await second.ping("warm up")
+
+        server.release.clear()
+        call = asyncio.create_task(first.ping("slow"))
+        await asyncio.sleep(0.1)
+        # The server is at capacity: other requests are shed right away
+        with pytest.raises(WebSocketError) as info:
+            await second.ping("shed")
+        assert info.value.error.error_code == 503
+        assert info.value.retry_after is not None
+
+        server.release.set()
+        assert (await call).response == "received: slow"
+        assert (await second.ping("again")).response == "received: again"
+
+        await first.close()
+        await second.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_calls_fail_on_reconnect(self):
+        server = LimitedApiServer(session_buffer_size=10)
+        await server.start()
+
+        api = SimpleApiClient(
+            f"http://{WS_HOST}:{WS_PORT}{WS_URL}", reconnect=ReconnectPolicy(initial_delay=0.05, max_delay=0.1))
+        await api.ping("warm up")
+
+        server.release.clear()
+        call = asyncio.create_task(api.ping("slow"))
+        await asyncio.sleep(0.1)
+        # The session is resumed, but nothing says the request got through
+        await server._wss.clients[0].close(flush=False)
+        with pytest.raises(WebSocketConnectionClosed):
+            await asyncio.wait_for(call, 5)
+        assert api.in_flight == 0
+
+        server.release.set()
+        assert (await api.ping("again")).response == "received: again"
+
+        await api.close()
+        await server.close()
+        await asyncio.sleep(0.25)
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import json
+import logging
+import pytest
+import struct
+from pywsp import *
+from pywsp.attachment import ATTACHMENT_MAGIC, IncomingAttachment, PendingMessage
+from typing import Any, List
+
+from .codecs import available_codecs
+
+WS_HOST = "127.0.0.1"
+WS_PORT = 11116
+WS_URL = "/api/websocket"
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+_LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+@message(type="upload")
+class UploadMessage:
+    name: str
+    data: bytes
+
+@message(type="upload_result")
+class UploadResultMessage:
+    digest: str
+
+@message(type="download")
+class DownloadMessage:
+    size: int
+
+@message(type="blob")
+class BlobMessage:
+    data: bytes
+
+
+def digest(data) -> str:
+    return f"{len(data)}:{hashlib.sha256(data).hexdigest()}"
+
+
+class BlobApiServer(WebSocketApiServer):
+    def __init__(self, **kwargs):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, attachment_chunk_size=CHUNK_SIZE, **kwargs)
+        self.received: List[Any] = []
+
+    @api(input=UploadMessage, output=UploadResultMessage)
+    async def upload(self, name, data):
+        self.received.append(data)
+        if isinstance(data, AttachmentStream):
+            chunks = [bytes(chunk) async for chunk in data]
+            assert all(len(chunk) <= CHUNK_SIZE for chunk in chunks)
+            data = b"".join(chunks)
+        return digest(data)
+
+    @api(input=DownloadMessage, output=BlobMessage)
+    async def download(self, size):
+        return bytes(i % 251 for i in range(size))
+
+
+class BlobApiClient(WebSocketApiClient):
+    async def upload(self, name, data):
+        return await self.api_call(UploadMessage, UploadResultMessage, name, data)
+
+    async def download(self, size):
+        return await self.api_call(DownloadMessage, BlobMessage, size)
+
+
+def chunk_frame(attachment_id: int, data: bytes) -> bytes:
+    """A non-final chunk of an attachment."""
+    return ATTACHMENT_MAGIC + struct.pack("!IB", attachment_id, 0) + data
+
+
+class TestAttachments:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    async def test_buffered_attachments(self, codec_class) -> None:
+        server = BlobApiServer(codecs=[codec_class()])
+        await server.start()
+
+        client = BlobApiClient(
+            f"http://{WS_HOST}:{WS_PORT}{WS_URL}", codecs=[codec_class()], attachment_chunk_size=CHUNK_SIZE)
+        for size in (0, 10, CHUNK_SIZE, 5 * CHUNK_SIZE + 7):
+            data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+            result = await client.upload("blob", data)
+            assert result.digest == digest(data)
+            assert isinstance(server.received[-1], memoryview)
+
+            blob = await client.download(size)
+            assert isinstance(blob.data, memoryview)
+            assert bytes(blob.data) == bytes(i % 251 for i in range(size))
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_streamed_attachments(self) -> None:
+        server = BlobApiServer(attachment_stream_threshold=2 * CHUNK_SIZE)
+        await server.start()
+
+        client = BlobApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", attachment_chunk_size=CHUNK_SIZE)
+        small = b"x" * 100
+        large = bytes(range(256)) * 40
+        assert (await client.upload("small", small)).digest == digest(small)
+        assert (await client.upload("large", large)).digest == digest(large)
+        assert isinstance(server.received[0], memoryview)
+        assert isinstance(server.received[1], AttachmentStream)
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_attachments_with_batching(self) -> None:
+        server = BlobApiServer(batch_window=0.01)
+        await server.start()
+
+        client = BlobApiClient(
+            f"http://{WS_HOST}:{WS_PORT}{WS_URL}", batch_window=0.01, attachment_chunk_size=CHUNK_SIZE)
+        payloads = [bytes([i]) * (i * 300) for i in range(10)]
+        results = await asyncio.gather(*[client.upload(f"blob {i}", p) for i, p in enumerate(payloads)])
+        assert [r.digest for r in results] == [digest(p) for p in payloads]
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_attachments_after_batching_negotiated(self) -> None:
+        server = BlobApiServer(batch_window=0.01)
+        await server.start()
+
+        client = BlobApiClient(
+            f"http://{WS_HOST}:{WS_PORT}{WS_URL}", batch_window=0.01, attachment_chunk_size=CHUNK_SIZE)
+        assert (await client.upload("first", b"")).digest == digest(b"")
+        ws = client._sockets[0]
+        while "batch" not in ws.peer_capabilities:
+            await asyncio.sleep(0.01)
+
+        # Envelopes now go through the batch; their chunks must still follow them
+        payloads = [bytes([i]) * (i * 300) for i in range(10)]
+        for i, payload in enumerate(payloads):
+            assert (await client.upload(f"blob {i}", payload)).digest == digest(payload)
+        results = await asyncio.gather(*[client.upload(f"blob {i}", p) for i, p in enumerate(payloads)])
+        assert [r.digest for r in results] == [digest(p) for p in payloads]
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_pending_attachment_limit(self) -> None:
+        server = BlobApiServer(max_pending_attachment_size=4 * CHUNK_SIZE)
+        await server.start()
+
+        client = BlobApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", attachment_chunk_size=CHUNK_SIZE)
+        data = b"x" * (3 * CHUNK_SIZE)
+        assert (await client.upload("fits", data)).digest == digest(data)
+
+        # Announce attachments that together exceed the limit, but send
+        # only a sliver of them: the server hangs up instead of buffering
+        ws = client._sockets[0]
+        envelope = {
+            "@id": ws.next_message_id(),
+            "@type": "upload",
+            "@attachments": { "data": { "id": 1000, "size": 3 * CHUNK_SIZE } },
+            "data": { "name": "sliver", "data": None },
+        }
+        for i in range(2):
+            envelope["@attachments"]["data"]["id"] = 1000 + i
+            await ws.send_frame(json.dumps(envelope))
+            await ws.send_frame(chunk_frame(1000 + i, b"x"))
+        while ws.connected():
+            await asyncio.sleep(0.01)
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_unread_stream_limit(self) -> None:
+        server = BlobApiServer()
+        await server.start()
+
+        client = BlobApiClient(
+            f"http://{WS_HOST}:{WS_PORT}{WS_URL}",
+            attachment_stream_threshold=2 * CHUNK_SIZE,
+            max_pending_attachment_size=4 * CHUNK_SIZE)
+        blob = await client.download(3 * CHUNK_SIZE)
+        ws = client._sockets[0]
+        while ws.buffered_bytes < 3 * CHUNK_SIZE:
+            await asyncio.sleep(0.01)
+        assert bytes(await blob.data.read()) == bytes(i % 251 for i in range(3 * CHUNK_SIZE))
+        assert ws.buffered_bytes == 0
+
+        # Nobody reads this one: the client hangs up instead of buffering it all
+        blob = await client.download(10 * CHUNK_SIZE)
+        assert isinstance(blob.data, AttachmentStream)
+        while ws.connected():
+            await asyncio.sleep(0.01)
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    def test_stream_counts_unread_bytes(self) -> None:
+        stream = AttachmentStream(3)
+        stream.feed(memoryview(b"ab"))
+        stream.feed(memoryview(b"c"))
+        stream.close()
+        assert stream.buffered == 3 and stream.finished
+        assert asyncio.run(stream.read()) == b"abc"
+        assert stream.buffered == 0
+
+    def test_buffer_grows_with_chunks(self) -> None:
+        incoming = IncomingAttachment(PendingMessage({ }), "data", 10 * CHUNK_SIZE)
+        assert incoming.feed(memoryview(b"x" * CHUNK_SIZE), False) is None
+        assert incoming.buffered == CHUNK_SIZE
@@ -2,12 +2,13 @@ import sys
 sys.path += [".", ".."]
 
 import asyncio
+import json
 import logging
 import pytest
 from pywsp import *
 from typing import Any, List
 
-from pywsp.const import MESSAGE_ID
+from pywsp.const import MESSAGE_ID, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST
 
 WS_HOST = "127.0.0.1"
 WS_PORT = 11111
@@ -25,6 +26,21 @@ class RequestMessage:
 class ResponseMessage:
     response: str
 
+@message(type="snapshot", compress=True)
+class SnapshotMessage:
+    state: str
+
+@message(type="control", compress=False)
+class ControlMessage:
+    command: str
+
+@message(type="telemetry", delta=True, delta_key="device", keyframe_interval=4)
+class TelemetryMessage:
+    device: str
+    temperature: float
+    status: str
+    tags: List[str]
+
 
 class Server(WebSocketConnectionCallback, WebSocketMessageCallback):
     def __init__(self, parent: "TestBasicProtocol") -> None:
@@ -63,6 +79,32 @@ class Client(WebSocketConnectionCallback, WebSocketMessageCallback):
         self.new_message_event.set()
 
 
+class ReconnectingClient(Client):
+    def __init__(self, parent: "TestBasicProtocol") -> None:
+        super().__init__(parent)
+        self.reconnects: List[bool] = []
+        self.reconnected_event = asyncio.Event()
+
+    async def on_reconnected(self, ws: WebSocket, resumed: bool) -> None:
+        _LOGGER.info("client: reconnected (resumed: %s)", resumed)
+        self.reconnects.append(resumed)
+        self.reconnected_event.set()
+
+
+class BlockingServer(Server):
+    """Holds 'wait' requests until a 'release' request shows up."""
+    def __init__(self, parent: "TestBasicProtocol") -> None:
+        super().__init__(parent)
+        self.released = asyncio.Event()
+
+    async def on_new_message(self, ws: WebSocket, message: Any) -> None:
+        if message.request.startswith("wait"):
+            await self.released.wait()
+        elif message.request == "release":
+            self.released.set()
+        await super().on_new_message(ws, message)
+
+
 class TestBasicProtocol:
     @pytest.mark.asyncio
     async def test_single_call(self) -> None:
@@ -141,6 +183,500 @@ class TestBasicProtocol:
         await server.close()
         await asyncio.sleep(0.25)
 
+    @pytest.mark.asyncio
+    async def test_concurrent_dispatch(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage)
+
+        # Requests sharing a key are serialized; everything else runs in parallel
+        server = WebSocketServer(
+            factory,
+            max_concurrency=4,
+            ordering_key=lambda message: message.request.split(":")[0])
+        server_callback = BlockingServer(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory)
+        client.register_callback(Client(self))
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        # With sequential dispatch the first request would block the release forever
+        for request in ["wait:1", "wait:2", "wait:3", "release"]:
+            await client.send_message(RequestMessage(request))
+
+        await asyncio.wait_for(server_callback.released.wait(), 5)
+        while len(server_callback.messages) < 4:
+            await asyncio.wait_for(server_callback.new_message_event.wait(), 5)
+            server_callback.new_message_event.clear()
+
+        requests = [msg.request for msg in server_callback.messages]
+        assert requests[0] == "release"
+        assert requests[1:] == ["wait:1", "wait:2", "wait:3"]
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_broadcast(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        server = WebSocketServer(factory)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        clients = []
+        for _ in range(3):
+            client = WebSocket(factory)
+            client_callback = Client(self)
+            client.register_callback(client_callback)
+            await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+            clients.append((client, client_callback))
+        while len(server.clients) < 3:
+            await asyncio.sleep(0.01)
+
+        excluded = server.clients[0]
+        delivered = await server.broadcast(
+            ResponseMessage("to everyone"),
+            filter=lambda ws: ws is not excluded)
+        assert delivered == 2
+
+        received = []
+        for client, client_callback in clients[1:]:
+            await asyncio.wait_for(client_callback.new_message_event.wait(), 5)
+            received.extend(client_callback.messages)
+        assert [msg.response for msg in received] == ["to everyone"] * 2
+        # Everyone got the same frame, id included
+        assert len({getattr(msg, MESSAGE_ID) for msg in received}) == 1
+        assert not clients[0][1].messages
+
+        for client, _ in clients:
+            await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_publish_subscribe(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        server = WebSocketServer(factory)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        subscriber = WebSocket(factory)
+        subscriber_callback = Client(self)
+        subscriber.register_callback(subscriber_callback)
+        await subscriber.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+
+        bystander = WebSocket(factory)
+        bystander_callback = Client(self)
+        bystander.register_callback(bystander_callback)
+        await bystander.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+
+        await subscriber.subscribe("news", "weather")
+        await subscriber.unsubscribe("weather")
+        while len(server.subscribers("news")) < 1 or server.subscribers("weather"):
+            await asyncio.sleep(0.01)
+
+        assert await server.publish("weather", ResponseMessage("sunny")) == 0
+        assert await server.publish("news", ResponseMessage("extra")) == 1
+        await asyncio.wait_for(subscriber_callback.new_message_event.wait(), 5)
+        assert [msg.response for msg in subscriber_callback.messages] == ["extra"]
+        assert not bystander_callback.messages
+        # Control messages never reach the application
+        assert not server_callback.messages
+
+        await subscriber.close()
+        while server.subscribers("news"):
+            await asyncio.sleep(0.01)
+
+        await bystander.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_batching(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        server = WebSocketServer(factory, batch_window=0.05)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory)
+        client_callback = Client(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+        while not client.peer_capabilities:
+            await asyncio.sleep(0.01)
+
+        ws = server_callback.ws
+        frames = []
+        write_frame = ws._write_frame
+        async def counting_write_frame(frame, *args):
+            frames.append(frame)
+            await write_frame(frame, *args)
+        ws._write_frame = counting_write_frame
+
+        ids = [await ws.send_message(ResponseMessage(f"status {i}")) for i in range(20)]
+        await ws.flush()
+        while len(client_callback.messages) < 20:
+            await asyncio.sleep(0.01)
+
+        assert len(frames) == 1
+        assert [msg.response for msg in client_callback.messages] == [f"status {i}" for i in range(20)]
+        assert [getattr(msg, MESSAGE_ID) for msg in client_callback.messages] == ids
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_send_queue_drop_oldest(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        server = WebSocketServer(factory, send_queue_size=2, overflow_policy=OVERFLOW_DROP_OLDEST)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory)
+        client_callback = Client(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        # Stall the writer to simulate a peer that stopped reading
+        ws = server_callback.ws
+        unstalled = asyncio.Event()
+        write_frame = ws._write_frame
+        async def stalled_write_frame(frame, *args):
+            await unstalled.wait()
+            await write_frame(frame, *args)
+        ws._write_frame = stalled_write_frame
+
+        await ws.send_message(ResponseMessage("status 0"))
+        await asyncio.sleep(0.01)
+        # Status 0 is stuck in the writer; the queue keeps only the newest two
+        for i in range(1, 5):
+            await ws.send_message(ResponseMessage(f"status {i}"))
+        assert ws.send_queue_depth == 2
+        assert ws.dropped_messages == 2
+        queued = ws.buffered_bytes
+        assert queued > 0
+
+        unstalled.set()
+        await ws.flush()
+        assert ws.buffered_bytes < queued
+        while len(client_callback.messages) < 3:
+            await asyncio.sleep(0.01)
+        assert [msg.response for msg in client_callback.messages] == ["status 0", "status 3", "status 4"]
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_connection_lifecycle(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        metrics = Metrics()
+        server = WebSocketServer(factory, max_connections=1, idle_timeout=0.3, metrics=metrics)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        first = WebSocket(factory)
+        first.register_callback(Client(self))
+        await first.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        # Over the cap: refused before the upgrade
+        second = WebSocket(factory)
+        second.register_callback(Client(self))
+        await second.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        assert not second.connected()
+        assert metrics.connections_refused.get() == 1
+
+        # Traffic keeps the connection open...
+        for i in range(4):
+            await asyncio.sleep(0.1)
+            await first.send_message(RequestMessage(f"request {i}"))
+        assert len(server.clients) == 1
+        # ...and without it, it's closed
+        while server.clients:
+            await asyncio.sleep(0.05)
+        assert metrics.idle_closes.get() == 1
+
+        # Which frees a slot
+        await second.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        assert second.connected()
+
+        await first.close()
+        await second.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_broadcasts_keep_connection_open(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        server = WebSocketServer(factory, idle_timeout=0.3)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory)
+        client_callback = Client(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        # The client never sends anything, it only receives
+        for i in range(10):
+            await asyncio.sleep(0.1)
+            assert await server.broadcast(ResponseMessage(f"news {i}")) == 1
+        assert len(server.clients) == 1 and client.connected()
+        while len(client_callback.messages) < 10:
+            await asyncio.sleep(0.01)
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_compression_policy(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage, SnapshotMessage, ControlMessage)
+
+        server = WebSocketServer(factory, compress_min_size=256)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory, compress=True)
+        client_callback = Client(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        ws = server_callback.ws
+        levels = []
+        writer = ws._wsr._writer
+        send_frame = writer.send_frame
+        async def recording_send_frame(message, opcode, compress=None):
+            levels.append(compress)
+            await send_frame(message, opcode, compress)
+        writer.send_frame = recording_send_frame
+
+        messages = [
+            ResponseMessage("small"),
+            ResponseMessage("large" * 100),
+            SnapshotMessage("small"),
+            ControlMessage("large" * 100),
+        ]
+        for msg in messages:
+            await ws.send_message(msg)
+        while len(client_callback.messages) < len(messages):
+            await asyncio.sleep(0.01)
+
+        assert levels == [None, 15, 15, None]
+        assert client_callback.messages == messages
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_session_resume(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage)
+
+        server = WebSocketServer(factory, session_buffer_size=3)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory, reconnect=ReconnectPolicy(initial_delay=0.05, max_delay=0.1))
+        client_callback = ReconnectingClient(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await client.subscribe("news")
+        while not server.subscribers("news"):
+            await asyncio.sleep(0.01)
+        session_id = client.session_id
+        assert session_id is not None
+
+        await server.publish("news", ResponseMessage("one"))
+        while len(client_callback.messages) < 1:
+            await asyncio.sleep(0.01)
+
+        # Drop the connection; what's published meanwhile is replayed on resume
+        await server_callback.ws.close(flush=False)
+        await server.publish("news", ResponseMessage("two"))
+        await asyncio.wait_for(client_callback.reconnected_event.wait(), 5)
+        assert client_callback.reconnects == [True]
+        assert client.session_id == session_id
+        # Subscriptions are restored too
+        await server.publish("news", ResponseMessage("three"))
+        while len(client_callback.messages) < 3:
+            await asyncio.sleep(0.01)
+        assert [msg.response for msg in client_callback.messages] == ["one", "two", "three"]
+
+        # More than the buffer holds: the session can't be resumed
+        client_callback.reconnected_event.clear()
+        await server_callback.ws.close(flush=False)
+        for i in range(5):
+            await server.broadcast(ResponseMessage(f"missed {i}"))
+        await asyncio.wait_for(client_callback.reconnected_event.wait(), 5)
+        assert client_callback.reconnects == [True, False]
+
+        # close() doesn't reconnect
+        await client.close()
+        await asyncio.sleep(0.25)
+        assert not client.connected() and not client.reconnecting
+        assert len(server.clients) == 0
+
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_delta_encoding(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage, TelemetryMessage)
+
+        server = WebSocketServer(factory, compact_envelopes=True)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory, compact_envelopes=True)
+        client_callback = Client(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        ws = server_callback.ws
+        frames = []
+        writer = ws._wsr._writer
+        send_frame = writer.send_frame
+        async def recording_send_frame(message, opcode, compress=None):
+            frames.append(json.loads(bytes(message)))
+            await send_frame(message, opcode, compress)
+        writer.send_frame = recording_send_frame
+
+        tags = ["lab"]
+        messages = [
+            TelemetryMessage("a", 20.0, "ok", tags),
+            TelemetryMessage("b", 30.0, "ok", ["roof"]),
+            TelemetryMessage("a", 20.5, "ok", tags),
+            TelemetryMessage("a", 20.5, "ok", tags),
+            TelemetryMessage("a", 21.0, "ok", tags),
+            # Fourth "a" message: a keyframe
+            TelemetryMessage("a", 21.0, "ok", tags),
+        ]
+        for i, msg in enumerate(messages):
+            if i == 3:
+                # Changed in place after being sent, still noticed
+                tags.append("north")
+            await ws.send_message(msg)
+        while len(client_callback.messages) < len(messages):
+            await asyncio.sleep(0.01)
+
+        assert client_callback.messages == [
+            TelemetryMessage("a", 20.0, "ok", ["lab"]),
+            TelemetryMessage("b", 30.0, "ok", ["roof"]),
+            TelemetryMessage("a", 20.5, "ok", ["lab"]),
+            TelemetryMessage("a", 20.5, "ok", ["lab", "north"]),
+            TelemetryMessage("a", 21.0, "ok", ["lab", "north"]),
+            TelemetryMessage("a", 21.0, "ok", ["lab", "north"]),
+        ]
+        data = [frame["data"] for frame in frames]
+        assert [frame.get("@delta") for frame in frames] == [
+            None, None, frames[0]["@id"], frames[2]["@id"], frames[3]["@id"], None]
+        assert data[2] == { "device": "a", "temperature": 20.5 }
+        assert data[3] == { "device": "a", "tags": ["lab", "north"] }
+        assert data[4] == { "device": "a", "temperature": 21.0 }
+        assert len(data[5]) == 4
+
+        # A broadcast goes out in full and becomes the new base
+        await server.broadcast(TelemetryMessage("b", 31.0, "ok", ["roof"]))
+        await ws.send_message(TelemetryMessage("b", 32.0, "ok", ["roof"]))
+        while len(client_callback.messages) < len(messages) + 2:
+            await asyncio.sleep(0.01)
+        assert [msg.temperature for msg in client_callback.messages[-2:]] == [31.0, 32.0]
+        assert "@delta" not in frames[-1]
+
+        # A delta whose base never arrived is discarded
+        ws._delta_encoder._sent["telemetry"]["b"].message_id = 12345
+        await ws.send_message(TelemetryMessage("b", 33.0, "ok", ["roof"]))
+        await ws.send_message(ResponseMessage("done"))
+        while not isinstance(client_callback.messages[-1], ResponseMessage):
+            await asyncio.sleep(0.01)
+        assert len(client_callback.messages) == len(messages) + 3
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("policy, received", [
+        (OVERFLOW_DROP_NEWEST, [20.0, 21.0, 24.0]),
+        (OVERFLOW_DROP_OLDEST, [20.0, 23.0, 24.0]),
+    ])
+    async def test_delta_encoding_dropped_frames(self, policy, received) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(RequestMessage, ResponseMessage, TelemetryMessage)
+
+        server = WebSocketServer(factory, send_queue_size=1, overflow_policy=policy)
+        server_callback = Server(self)
+        server.register_callback(server_callback)
+        await server.start_listening(WS_HOST, WS_PORT, WS_URL)
+
+        client = WebSocket(factory)
+        client_callback = Client(self)
+        client.register_callback(client_callback)
+        await client.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        await server_callback.new_connection_event.wait()
+
+        ws = server_callback.ws
+        unstalled = asyncio.Event()
+        write_frame = ws._write_frame
+        async def stalled_write_frame(frame, *args):
+            await unstalled.wait()
+            await write_frame(frame, *args)
+        ws._write_frame = stalled_write_frame
+
+        await ws.send_message(TelemetryMessage("a", 20.0, "ok", ["lab"]))
+        await asyncio.sleep(0.01)
+        for temperature in (21.0, 22.0, 23.0):
+            await ws.send_message(TelemetryMessage("a", temperature, "ok", ["lab"]))
+        assert ws.dropped_messages == 2
+
+        unstalled.set()
+        await ws.flush()
+        # The peer never saw what the encoder last based its deltas on
+        await ws.send_message(TelemetryMessage("a", 24.0, "ok", ["lab"]))
+        while len(client_callback.messages) < 3:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        assert [msg.temperature for msg in client_callback.messages] == received
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
 if __name__ == "__main__":
 
     test = TestBasicProtocol()
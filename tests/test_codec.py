@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import pytest
+from pywsp import *
+from pywsp.exceptions import WebSocketConnectionClosed, WebSocketInvalidMessage, WebSocketUnsupportedMessageType
+from typing import Any, List
+
+from .codecs import available_codecs
+
+WS_HOST = "127.0.0.1"
+WS_PORT = 11113
+WS_URL = "/api/websocket"
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+_LOGGER = logging.getLogger(__name__)
+
+@message(type="ping")
+class PingMessage:
+    request: str
+
+@message(type="pong")
+class PongMessage:
+    response: str
+
+
+@message(type="query", raw=True)
+class QueryMessage:
+    query: Any
+
+@message(type="upload", max_size=200)
+class UploadMessage:
+    content: str
+
+
+class EchoApiServer(WebSocketApiServer):
+    def __init__(self, codecs, **kwargs):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, codecs=codecs, **kwargs)
+        self.queries: List[Any] = []
+
+    @api(input=PingMessage, output=PongMessage)
+    async def ping(self, request):
+        return "received: " + request
+
+    @api(input=QueryMessage, output=PongMessage)
+    async def query(self, query):
+        self.queries.append(query)
+        return f"{query.decode()['sql']}"
+
+    @api(input=UploadMessage, output=PongMessage)
+    async def upload(self, content):
+        return f"{len(content)}"
+
+
+class EchoApiClient(WebSocketApiClient):
+    async def ping(self, request):
+        return await self.api_call(PingMessage, PongMessage, request)
+
+    async def query(self, query):
+        return await self.api_call(QueryMessage, PongMessage, query)
+
+    async def upload(self, content):
+        return await self.api_call(UploadMessage, PongMessage, content)
+
+
+class Receiver(WebSocketMessageCallback):
+    async def on_new_message(self, ws: WebSocket, message: Any) -> None:
+        pass
+
+
+class TestCodecs:
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    def test_round_trip(self, codec_class) -> None:
+        codec = codec_class()
+        envelope = { "@id": 1, "@type": "ping", "data": { "request": "ping", "values": [1, 2.5, None] } }
+        frame = codec.encode(envelope)
+        assert isinstance(frame, bytes if codec.binary else str)
+        assert codec.decode(frame) == envelope
+
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    def test_splice(self, codec_class) -> None:
+        codec = codec_class()
+        data = { "response": "pong", "values": [1, 2.5, None] }
+        frame = codec.splice({ "@id": 7, "@type": "pong", "@reply_to": 3 }, codec.encode(data))
+        assert codec.decode(frame) == { "@id": 7, "@type": "pong", "@reply_to": 3, "data": data }
+
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    def test_decode_header(self, codec_class) -> None:
+        codec = codec_class()
+        envelope = { "@id": 1, "@type": "ping", "@reply_to": 7, "data": { "request": "}, {" } }
+        header, data = codec.decode_header(codec.encode(envelope))
+        assert header == { "@id": 1, "@type": "ping", "@reply_to": 7 }
+        assert codec.decode_data(data) == envelope["data"]
+
+    def test_decode_header_data_not_last(self) -> None:
+        # Only the data-last layout can be split; the rest fails in decode_data()
+        codec = JsonCodec()
+        header, data = codec.decode_header('{"@id": 1, "@type": "ping", "data": {}, "@reply_to": 7}')
+        assert header == { "@id": 1, "@type": "ping" }
+        with pytest.raises(ValueError):
+            codec.decode_data(data)
+
+    def test_decode_header_escaped_member(self) -> None:
+        # Headers the split can't read exactly take the full path
+        codec = JsonCodec()
+        assert codec.decode_header('{"@id": 1, "@type": "p\\"ing", "data": {}}') is None
+
+    def test_small_frames_decoded_once(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(PingMessage, UploadMessage)
+        codec = JsonCodec()
+        ws = WebSocket(factory, codecs=[codec])
+        ws.register_callback(Receiver())
+        calls = []
+        decode_header = codec.decode_header
+        codec.decode_header = lambda frame: calls.append(frame) or decode_header(frame)
+
+        frame = codec.encode({ "@id": 1, "@type": "ping", "data": { "request": "hello" } })
+        assert ws._decode_frame(frame)["data"] == { "request": "hello" }
+        assert calls == []
+        # Size limits still apply
+        with pytest.raises(WebSocketInvalidMessage):
+            ws._decode_frame(codec.encode({ "@id": 2, "@type": "upload", "data": { "content": "x" * 300 } }))
+        with pytest.raises(WebSocketUnsupportedMessageType):
+            ws._decode_frame(codec.encode({ "@id": 3, "@type": "unknown", "data": { } }))
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    async def test_header_first_decoding(self, codec_class) -> None:
+        metrics = Metrics()
+        server = EchoApiServer(codecs=[codec_class()], metrics=metrics)
+        await server.start()
+
+        client = EchoApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", codecs=[codec_class()])
+        pong = await client.query({ "sql": "select 1", "rows": list(range(100)) })
+        assert pong.response == "select 1"
+        assert isinstance(server.queries[0], RawData)
+        assert server.queries[0].raw is not None
+
+        assert (await client.upload("x" * 10)).response == "10"
+        # Over the type's max_size: the server drops the connection
+        with pytest.raises(WebSocketConnectionClosed):
+            await client.upload("x" * 1000)
+        assert metrics.messages_rejected.get("upload", "too_large") == 1
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    async def test_negotiation(self, codec_class) -> None:
+        server = EchoApiServer(codecs=[MsgpackCodec(), JsonCodec()] if codec_class is MsgpackCodec else [JsonCodec()])
+        await server.start()
+
+        client = EchoApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", codecs=[codec_class()])
+        pong = await client.ping("hello")
+        assert pong.response == "received: hello"
+        assert isinstance(client._sockets[0].codec, codec_class)
+        assert server._wss.clients[0].codec.subprotocol == codec_class.subprotocol
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_fallback_without_subprotocol(self) -> None:
+        server = EchoApiServer(codecs=[JsonCodec()])
+        await server.start()
+
+        # Clients that don't negotiate still get JSON
+        client = EchoApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        pong = await client.ping("hello")
+        assert pong.response == "received: hello"
+        assert client._sockets[0]._wsr.protocol is None
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("codec_class", available_codecs())
+    async def test_compact_envelopes(self, codec_class) -> None:
+        server = EchoApiServer(codecs=[codec_class()], compact_envelopes=True)
+        await server.start()
+
+        client = EchoApiClient(
+            f"http://{WS_HOST}:{WS_PORT}{WS_URL}", codecs=[codec_class()], compact_envelopes=True)
+        assert (await client.ping("hello")).response == "received: hello"
+        ws = client._sockets[0]
+        # Both registries are exchanged right after the handshake
+        while ws.compact_layout("ping") is None or server._wss.clients[0].compact_layout("pong") is None:
+            await asyncio.sleep(0.01)
+
+        sent: List[Any] = []
+        encode = ws._codec.encode
+        ws._codec.encode = lambda envelope: sent.append(envelope) or encode(envelope)
+        assert (await client.ping("again")).response == "received: again"
+        assert sent[0][0] == ws.compact_layout("ping")[0]
+        assert sent[0][2] == ["again"]
+        # Raw types keep their data section as is
+        assert (await client.query({ "sql": "select 2" })).response == "select 2"
+        assert isinstance(sent[1], dict)
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
+
+    @pytest.mark.asyncio
+    async def test_compact_envelopes_one_side(self) -> None:
+        server = EchoApiServer(codecs=[JsonCodec()], compact_envelopes=True)
+        await server.start()
+
+        # The client doesn't ask for compact envelopes, so neither side uses them
+        client = EchoApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}", codecs=[JsonCodec()])
+        assert (await client.ping("hello")).response == "received: hello"
+        assert (await client.ping("again")).response == "received: again"
+        assert client._sockets[0].compact_layout("ping") is None
+        assert server._wss.clients[0].compact_layout("pong") is None
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
@@ -0,0 +1,70 @@
+import json
+import logging
+import pytest
+from dataclasses import asdict
+from pywsp import *
+from pywsp.message import json_default, message_to_dict
+from typing import Any, Dict, List, Optional, Tuple
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+_LOGGER = logging.getLogger(__name__)
+
+@message(type="foo")
+class FooMessage:
+    foo: str
+
+@message(type="bar")
+class BarMessage:
+    bar: List[FooMessage]
+
+@message(type="zoo")
+class ZooMessage:
+    zoo: Dict[str, BarMessage]
+    foo: FooMessage
+    maybe: Optional[FooMessage] = None
+    extra: Any = None
+
+
+class TestMessageEncoding():
+    def test_flat_message(self) -> None:
+        foo = FooMessage("foo")
+        assert message_to_dict(foo) == asdict(foo)
+
+    def test_nested_message(self) -> None:
+        bar = BarMessage([FooMessage("foo1"), FooMessage("foo2")])
+        assert message_to_dict(bar) == asdict(bar)
+
+        zoo = ZooMessage(
+            { "bar": bar },
+            FooMessage("foo3"),
+            maybe=FooMessage("foo4"))
+        assert message_to_dict(zoo) == asdict(zoo)
+
+    def test_untyped_nested_message(self) -> None:
+        zoo = ZooMessage({ }, FooMessage("foo"), extra=[FooMessage("any")])
+        text = json.dumps(message_to_dict(zoo), default=json_default)
+        assert json.loads(text) == asdict(zoo)
+
+    def test_plain_values_are_not_copied(self) -> None:
+        @message(type="plain")
+        class PlainMessage:
+            values: List[int]
+
+        plain = PlainMessage([1, 2, 3])
+        assert message_to_dict(plain)["values"] is plain.values
+
+    def test_tuple_round_trip(self) -> None:
+        @message(type="pair")
+        class PairMessage:
+            pair: Tuple[FooMessage, int]
+            foos: Tuple[FooMessage, ...]
+            plain: Tuple[int, str]
+
+        pair = PairMessage((FooMessage("foo1"), 1), (FooMessage("foo2"), FooMessage("foo3")), (2, "two"))
+        text = json.dumps(message_to_dict(pair), default=json_default)
+        assert json.loads(text) == json.loads(json.dumps(asdict(pair)))
+
+        factory = MessageFactory()
+        factory.register_message_types(PairMessage)
+        assert factory.decode("pair", json.loads(text)) == pair
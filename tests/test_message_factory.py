@@ -1,7 +1,9 @@
 import logging
 import pytest
 from pywsp import *
-from typing import List
+from typing import Dict, List, Optional
+
+from pywsp.exceptions import WebSocketInvalidMessage
 
 logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
 
@@ -15,6 +17,11 @@ class FooMessage:
 class BarMessage:
     bar: List[FooMessage]
 
+@message(type="zoo")
+class ZooMessage:
+    zoo: Dict[str, BarMessage]
+    foo: Optional[FooMessage] = None
+
 
 class TestMessageFactory():
     def test_simple_message_serialization(self) -> None:
@@ -60,3 +67,73 @@ class TestMessageFactory():
         # This should work now
         NowGoodMessage = message(BadMessage, type="bad")
         factory.register_message_types(NowGoodMessage)
+
+    def test_nested_message_decoding(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(ZooMessage)
+
+        data = {
+            "zoo": { "bar": { "bar": [{ "foo": "foo1" }, { "foo": "foo2" }] } },
+            "foo": { "foo": "foo3" },
+        }
+        zoomsg = factory.decode("zoo", data)
+        assert zoomsg == ZooMessage(
+            { "bar": BarMessage([FooMessage("foo1"), FooMessage("foo2")]) },
+            FooMessage("foo3"))
+
+        assert factory.decode("zoo", { "zoo": { }, "foo": None }) == ZooMessage({ })
+
+    def test_nested_message_fallbacks(self) -> None:
+        @message(type="defaults")
+        class DefaultsMessage:
+            foo: str
+            extra: int = 7
+
+        @message(type="holder")
+        class HolderMessage:
+            items: List[DefaultsMessage]
+            maybe: Optional[DefaultsMessage] = None
+
+        factory = MessageFactory()
+        factory.register_message_types(HolderMessage, ZooMessage)
+        # Missing nested fields fall back to the class defaults
+        holder = factory.decode("holder", { "items": [{ "foo": "a" }, { "foo": "b", "extra": 1 }], "maybe": { "foo": "c" } })
+        assert holder == HolderMessage(
+            [DefaultsMessage("a"), DefaultsMessage("b", 1)], DefaultsMessage("c"))
+        # Nested messages may come as field lists, or already built
+        built = FooMessage("foo2")
+        zoomsg = factory.decode("zoo", { "zoo": { "bar": { "bar": [["foo1"], built] } }, "foo": ["foo3"] })
+        assert zoomsg == ZooMessage({ "bar": BarMessage([FooMessage("foo1"), built]) }, FooMessage("foo3"))
+        with pytest.raises(WebSocketInvalidMessage):
+            factory.decode("zoo", { "zoo": { "bar": "not an object" } })
+
+    def test_strict_decoding(self) -> None:
+        lenient = MessageFactory()
+        lenient.register_message_types(BarMessage)
+        barmsg = lenient.decode("bar", { "bar": [{ "foo": "foo", "new": 1 }], "new": 2 })
+        assert barmsg == BarMessage([FooMessage("foo")])
+
+        strict = MessageFactory(strict=True)
+        strict.register_message_types(BarMessage)
+        with pytest.raises(WebSocketInvalidMessage):
+            strict.decode("bar", { "bar": [], "new": 2 })
+        with pytest.raises(WebSocketInvalidMessage):
+            strict.decode("bar", { "bar": [{ "foo": "foo", "new": 1 }] })
+
+    def test_positional_decoding(self) -> None:
+        factory = MessageFactory()
+        factory.register_message_types(FooMessage, ZooMessage)
+        assert factory.layouts() == [("foo", ["foo"]), ("zoo", ["zoo", "foo"])]
+        assert factory.type_at(1) == "zoo"
+        assert factory.type_at(2) is None
+
+        zoomsg = factory.decode("zoo", [{ }, { "foo": "foo1" }])
+        assert zoomsg == ZooMessage({ }, FooMessage("foo1"))
+        with pytest.raises(WebSocketInvalidMessage):
+            factory.decode("zoo", [{ }])
+
+        version = factory.version
+        factory.register_message_types(FooMessage)
+        assert factory.version == version
+        factory.register_message_types(BarMessage)
+        assert factory.version == version + 1
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import pytest
+from aiohttp import ClientSession
+from pywsp import *
+
+WS_HOST = "127.0.0.1"
+WS_PORT = 11114
+WS_URL = "/api/websocket"
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+_LOGGER = logging.getLogger(__name__)
+
+@message(type="ping")
+class PingMessage:
+    request: str
+
+@message(type="pong")
+class PongMessage:
+    response: str
+
+
+class MeteredApiServer(WebSocketApiServer):
+    def __init__(self, metrics):
+        super().__init__(WS_HOST, WS_PORT, WS_URL, metrics=metrics)
+
+    @api(input=PingMessage, output=PongMessage)
+    async def ping(self, request):
+        return "received: " + request
+
+
+class MeteredApiClient(WebSocketApiClient):
+    async def ping(self, request):
+        return await self.api_call(PingMessage, PongMessage, request)
+
+
+class TestMetrics:
+    def test_histogram_buckets(self) -> None:
+        metrics = Metrics()
+        metrics.encode_seconds.observe(0.00002, "ping")
+        metrics.encode_seconds.observe(2, "ping")
+        text = metrics.render()
+        assert 'pywsp_encode_seconds_bucket{type="ping",le="5e-05"} 1' in text
+        assert 'pywsp_encode_seconds_bucket{type="ping",le="+Inf"} 2' in text
+        assert 'pywsp_encode_seconds_count{type="ping"} 2' in text
+
+    def test_shared_metrics(self) -> None:
+        metrics = Metrics()
+        MeteredApiServer(metrics)
+        WebSocketServer(MessageFactory(), metrics=metrics)
+        text = metrics.render()
+        assert text.count("# TYPE pywsp_send_queue_depth gauge") == 1
+        assert text.count("pywsp_buffered_bytes 0") == 1
+
+    @pytest.mark.asyncio
+    async def test_metrics_endpoint(self) -> None:
+        metrics = Metrics()
+        server = MeteredApiServer(metrics)
+        await server.start()
+
+        client = MeteredApiClient(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+        for i in range(3):
+            await client.ping(f"request {i}")
+
+        assert metrics.messages_received.get("ping") == 3
+        assert metrics.messages_sent.get("pong") == 3
+        assert metrics.api_handler_seconds.count("ping") == 3
+        assert metrics.active_connections.get() == 1
+
+        async with ClientSession() as session:
+            async with session.get(f"http://{WS_HOST}:{WS_PORT}/metrics") as response:
+                assert response.status == 200
+                text = await response.text()
+        assert 'pywsp_messages_received_total{type="ping"} 3' in text
+        assert "pywsp_active_connections 1" in text
+        assert "pywsp_send_queue_depth 0" in text
+
+        await client.close()
+        await server.close()
+        await asyncio.sleep(0.25)
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import pytest
+import tempfile
+
+from pywsp import *
+from pywsp import workers
+from pywsp.workers import WorkerChannel
+from typing import Any, List
+
+WS_HOST = "127.0.0.1"
+WS_PORT = 11115
+WS_URL = "/ws"
+
+logging.basicConfig(level=logging.DEBUG, format="%(name)s: %(message)s")
+
+_LOGGER = logging.getLogger(__name__)
+
+@message(type="whoami")
+class WhoAmIMessage:
+    pid: int = 0
+
+@message(type="shout")
+class ShoutMessage:
+    text: str
+
+@message(type="notice")
+class NoticeMessage:
+    text: str
+
+
+def make_factory() -> MessageFactory:
+    factory = MessageFactory()
+    factory.register_message_types(WhoAmIMessage, ShoutMessage, NoticeMessage)
+    return factory
+
+
+class WorkerCallback(WebSocketConnectionCallback, WebSocketMessageCallback):
+    def __init__(self, server: WebSocketServer) -> None:
+        self.server = server
+
+    def on_new_connection(self, ws: WebSocket) -> None:
+        ws.register_callback(self)
+
+    async def on_new_message(self, ws: WebSocket, message: Any) -> None:
+        if isinstance(message, WhoAmIMessage):
+            await ws.send_message(WhoAmIMessage(os.getpid()))
+        elif isinstance(message, ShoutMessage):
+            await self.server.broadcast(NoticeMessage(message.text))
+
+
+async def setup_worker() -> WebSocketServer:
+    server = WebSocketServer(make_factory())
+    server.register_callback(WorkerCallback(server))
+    await server.start_listening(WS_HOST, WS_PORT, WS_URL, reuse_port=True)
+    return server
+
+
+class Client(WebSocketMessageCallback):
+    def __init__(self) -> None:
+        self.messages: List[Any] = []
+        self.new_message_event = asyncio.Event()
+
+    async def on_new_message(self, ws: WebSocket, message: Any) -> None:
+        self.messages.append(message)
+        self.new_message_event.set()
+
+    async def wait_for(self, message_type: type) -> Any:
+        while True:
+            for message in self.messages:
+                if isinstance(message, message_type):
+                    self.messages.remove(message)
+                    return message
+            self.new_message_event.clear()
+            await self.new_message_event.wait()
+
+
+class TestWorkers:
+    @pytest.mark.asyncio
+    async def test_worker_pool(self):
+        pool = WorkerPool(setup_worker, workers=2, shutdown_timeout=5)
+        supervisor = multiprocessing.get_context("fork").Process(target=pool.run)
+        supervisor.start()
+
+        factory = make_factory()
+        clients = []
+        pids = set()
+        try:
+            # Keep connecting until both workers have picked up connections
+            for _ in range(200):
+                ws = WebSocket(factory)
+                client = Client()
+                ws.register_callback(client)
+                await ws.connect(f"http://{WS_HOST}:{WS_PORT}{WS_URL}")
+                if not ws.connected():
+                    await ws.close()
+                    await asyncio.sleep(0.1)
+                    continue
+                clients.append((ws, client))
+                await ws.send_message(WhoAmIMessage())
+                reply = await asyncio.wait_for(client.wait_for(WhoAmIMessage), 5)
+                pids.add(reply.pid)
+                if len(pids) > 1 and len(clients) >= 4:
+                    break
+            assert len(pids) == 2
+
+            # A broadcast on one worker reaches the clients of the other one too
+            await clients[0][0].send_message(ShoutMessage("hello"))
+            for _, client in clients:
+                notice = await asyncio.wait_for(client.wait_for(NoticeMessage), 5)
+                assert notice.text == "hello"
+        finally:
+            for ws, _ in clients:
+                await ws.close()
+            supervisor.terminate()
+            supervisor.join(15)
+
+        assert supervisor.exitcode == 0
+
+    @pytest.mark.asyncio
+    async def test_stalled_peer_is_dropped(self, monkeypatch):
+        monkeypatch.setattr(workers, "FORWARD_TIMEOUT", 0.2)
+        with tempfile.TemporaryDirectory() as directory:
+            channel = WorkerChannel(directory, 0, 3, WebSocketServer(make_factory()))
+            await channel.start()
+            # Worker 1 accepts connections but never reads them; worker 2 is down
+            stalled = []
+            async def never_read(reader, writer):
+                stalled.append(writer)
+            peer = await asyncio.start_unix_server(never_read, os.path.join(directory, "worker-1.sock"))
+
+            envelope = { "@id": 1, "@type": "notice", "data": { "text": "x" * (8 * 1024 * 1024) } }
+            await asyncio.wait_for(
+                channel.forward(envelope, [], topic=None, compress=None, timeout=None), 5)
+            assert channel._peers == { }
+
+            await channel.close()
+            for writer in stalled:
+                writer.close()
+            peer.close()
+            await peer.wait_closed()
+
+    @pytest.mark.asyncio
+    async def test_broken_peer_is_closed(self):
+        class BrokenWriter:
+            closed = False
+
+            def is_closing(self):
+                return self.closed
+
+            def write(self, data):
+                raise BrokenPipeError("peer went away")
+
+            def close(self):
+                self.closed = True
+
+        with tempfile.TemporaryDirectory() as directory:
+            channel = WorkerChannel(directory, 0, 2, WebSocketServer(make_factory()))
+            writer = BrokenWriter()
+            channel._peers[1] = writer
+            await channel.forward({ "@id": 1, "@type": "notice", "data": { } }, [], topic=None, compress=None, timeout=None)
+            assert writer.closed
+            assert channel._peers == { }